@@ -701,7 +701,6 @@ class RelevanceCalculator:
     ):
         self.dense_model = dense_model
         self.sparse_model = sparse_model
-        self._cache: Dict[str, torch.Tensor] = {}
         self.chunk_size = 512
 
     def chunk_text(self, text: str) -> List[str]:
@@ -748,13 +747,11 @@ class RelevanceCalculator:
     async def _get_chunked_embedding(
         self, chunks: List[str], embed_type: str
     ) -> torch.Tensor:
-        embeddings = []
-        for chunk in chunks:
-            cache_key = f"{embed_type}_{hash(chunk)}"
-            if cache_key not in self._cache:
-                embedding = await self.dense_model.aembed_query(chunk)
-                self._cache[cache_key] = torch.tensor(embedding)
-            embeddings.append(self._cache[cache_key])
+        # The dense model caches the embedding of every chunk it has seen
+        embeddings = [
+            torch.tensor(embedding)
+            for embedding in await self.dense_model.aembed_documents(chunks)
+        ]
 
         # Average embeddings if multiple chunks
         if embeddings:
@@ -0,0 +1,141 @@
+"""
+Batch benchmark for the RAG pipeline against stubbed backends.
+
+Answers the same list of distinct questions three ways: one `stream_answer` after
+the other (what a client looping over `/rag/query` gets), all `stream_answer` calls
+at once, and a single `batch_query`, whose answer generation is capped at
+`--generation-concurrency` while the per-question calls are not. The stubs model
+the models' fixed per-call cost separately from their per-item cost, so batching
+the classifier and the embedding models shows up in the numbers, while LLM and
+database calls only sleep.
+
+    python -m rag.benchmarks.batch --batch-size 1 10 50 --generation-concurrency 8
+"""
+import asyncio
+import time
+from argparse import ArgumentParser
+from threading import Lock
+
+from rag.benchmarks.common import print_table
+from rag.benchmarks.concurrency import build_rag
+from rag.benchmarks.concurrency import CLASSIFICATION_LATENCY
+from rag.benchmarks.concurrency import DATABASE_LATENCY
+from rag.benchmarks.concurrency import DOCUMENTS
+from rag.benchmarks.concurrency import EMBEDDING_LATENCY
+from rag.benchmarks.concurrency import PREPROCESSING_LLM_LATENCY
+from rag.benchmarks.concurrency import PREPROCESSING_RESULT
+from rag.benchmarks.concurrency import RERANKING_LATENCY
+from rag.benchmarks.concurrency import StubPreprocessing
+from rag.benchmarks.concurrency import StubRetriever
+from rag.main import BATCH_GENERATION_CONCURRENCY
+from rag.main import RAG
+from rag.utils.executors import run_in_executor
+
+# Share of a model call that is per item rather than fixed (tokenization, kernel
+# launches, python overhead) when the items are batched together.
+BATCH_ITEM_FRACTION = 0.1
+
+
+# The models share the CPU, so their calls are serialized instead of overlapping
+# the way plain sleeps on the executor would.
+MODEL_LOCK = Lock()
+
+
+def batched_latency(latency: float, batch_size: int) -> float:
+    return latency * (1 - BATCH_ITEM_FRACTION + BATCH_ITEM_FRACTION * batch_size)
+
+
+def model_call(latency: float):
+    with MODEL_LOCK:
+        time.sleep(latency)
+
+
+class StubBatchPreprocessing(StubPreprocessing):
+    async def aprocess_query(self, query, method_names=("all",)):
+        await asyncio.gather(
+            asyncio.sleep(PREPROCESSING_LLM_LATENCY),
+            run_in_executor(model_call, CLASSIFICATION_LATENCY),
+        )
+        return PREPROCESSING_RESULT
+
+    async def aprocess_queries(self, queries, method_names=("all",)):
+        await asyncio.gather(
+            asyncio.sleep(PREPROCESSING_LLM_LATENCY),
+            run_in_executor(
+                model_call, batched_latency(CLASSIFICATION_LATENCY, len(queries))
+            ),
+        )
+        return [PREPROCESSING_RESULT for _ in queries]
+
+
+class StubBatchRetriever(StubRetriever):
+    async def aquery(self, query, topk, metadata_filter={}):
+        await run_in_executor(model_call, EMBEDDING_LATENCY)
+        await asyncio.sleep(DATABASE_LATENCY + RERANKING_LATENCY)
+        return DOCUMENTS
+
+    async def abatch_query(self, queries, topk, metadata_filters):
+        await run_in_executor(
+            model_call, batched_latency(EMBEDDING_LATENCY, len(queries))
+        )
+        await asyncio.gather(
+            *(asyncio.sleep(DATABASE_LATENCY + RERANKING_LATENCY) for _ in queries)
+        )
+        return [DOCUMENTS for _ in queries]
+
+
+def build_batch_rag() -> RAG:
+    rag = build_rag()
+    rag.preprocessing = StubBatchPreprocessing()
+    rag.retriever = StubBatchRetriever()
+    return rag
+
+
+async def consume(stream) -> int:
+    chunks = 0
+    async for _ in stream:
+        chunks += 1
+    return chunks
+
+
+async def run(mode: str, batch_size: int, generation_concurrency: int) -> dict:
+    rag = build_batch_rag()
+    queries = [f"quantos dias posso faltar na situação {i}?" for i in range(batch_size)]
+
+    start = time.perf_counter()
+    if mode == "sequential":
+        for query in queries:
+            await consume(rag.stream_answer(query))
+    elif mode == "concurrent":
+        await asyncio.gather(*(consume(rag.stream_answer(query)) for query in queries))
+    else:
+        await consume(
+            rag.batch_query(queries, generation_concurrency=generation_concurrency)
+        )
+    wall_time = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "batch_size": batch_size,
+        "wall_time_s": wall_time,
+        "throughput_qps": batch_size / wall_time,
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument(
+        "--generation-concurrency", type=int, default=BATCH_GENERATION_CONCURRENCY
+    )
+    args = parser.parse_args()
+
+    rows = []
+    for batch_size in args.batch_size:
+        for mode in ("sequential", "concurrent", "batch"):
+            rows.append(asyncio.run(run(mode, batch_size, args.generation_concurrency)))
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
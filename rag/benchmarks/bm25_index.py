@@ -0,0 +1,126 @@
+"""
+BM25 index benchmark.
+
+Builds the BM25 index over the given legislation, memory-maps it and times, per
+question of `qa_trabalho.json`: a search over the whole corpus with the index, the
+same search with `BM25Okapi` from rank_bm25 (which scores every document on each
+query), and the scoring of the top 5 candidates with corpus-level statistics.
+
+    python -m rag.benchmarks.bm25_index --data_path rag/data --repetitions 20
+"""
+import json
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.retriever.database.bin.data_loader import iter_documents
+from rag.retriever.database.models.BM25Index import BM25Index
+from rag.retriever.database.models.BM25Index import tokenize
+from rag.retriever.database.models.DocumentStore import DocumentStore
+from rank_bm25 import BM25Okapi
+
+QA_PATH = Path("rag/prompt_specialists/testing/qa_trabalho.json")
+
+
+def load_questions() -> list:
+    with open(QA_PATH, "r", encoding="utf-8") as f:
+        splits = json.load(f)
+    return [qa["question"] for split in splits.values() for qa in split]
+
+
+def timed(func, questions: list, repetitions: int) -> dict:
+    latencies = []
+    for _ in range(repetitions):
+        for question in questions:
+            start = time.perf_counter()
+            func(question)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return percentiles(latencies)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--data_path", type=str, default="rag/data")
+    parser.add_argument("--repetitions", type=int, default=20)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    documents = list(iter_documents(args.data_path))
+    questions = load_questions()
+
+    with tempfile.TemporaryDirectory() as path:
+        # The index returns the documents it finds from the document store
+        document_store = DocumentStore(os.path.join(path, "documents"))
+        for document in documents:
+            document_store.put(document.id, document.metadata, [])
+        document_store.save()
+
+        start = time.perf_counter()
+        BM25Index.build(documents, path)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = BM25Index(path, document_store)
+        index.load()
+        load_time = time.perf_counter() - start
+
+        okapi = BM25Okapi(
+            [
+                tokenize(
+                    f"{document.metadata.get('title', '')} "
+                    f"{document.metadata.get('epigrafe', '')} "
+                    f"{document.metadata.get('text', '')}"
+                )
+                for document in documents
+            ]
+        )
+
+        def okapi_search(question):
+            scores = okapi.get_scores(tokenize(question))
+            return np.argsort(-scores)[:5]
+
+        def rescore(question):
+            candidates = index.search(question, 5)
+            index.score_texts(question, [c["metadata"]["text"] for c in candidates])
+
+        rows = [
+            {
+                "operation": name,
+                **{
+                    f"{point}_ms": value
+                    for point, value in timed(func, questions, args.repetitions).items()
+                },
+            }
+            for name, func in (
+                ("index_search_top5", lambda question: index.search(question, 5)),
+                ("bm25okapi_search_top5", okapi_search),
+                ("index_search_and_rescore", rescore),
+            )
+        ]
+
+    print(
+        f"{len(documents)} documents, {len(index.vocabulary)} terms, "
+        f"built in {build_time:.2f}s, loaded in {load_time * 1000:.1f}ms"
+    )
+    print_table(rows)
+
+    if args.output:
+        write_results(
+            args.output,
+            {
+                "documents": len(documents),
+                "build_time_s": build_time,
+                "load_time_ms": load_time * 1000,
+                "latency": rows,
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import json
+import logging
+from typing import Dict
+from typing import List
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+LOG = logging.getLogger("BENCHMARKS")
+
+
+def percentiles(values: List[float], points=(50, 95, 99)) -> Dict[str, float]:
+    if not values:
+        return {f"p{point}": 0.0 for point in points}
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        index = min(len(ordered) - 1, int(round(point / 100 * (len(ordered) - 1))))
+        result[f"p{point}"] = ordered[index]
+    return result
+
+
+def print_table(rows: List[dict]):
+    if not rows:
+        return
+    headers = list(rows[0].keys())
+    formatted = [
+        [f"{row[h]:.4f}" if isinstance(row[h], float) else str(row[h]) for h in headers]
+        for row in rows
+    ]
+    widths = [
+        max(len(h), *(len(line[i]) for line in formatted))
+        for i, h in enumerate(headers)
+    ]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for line in formatted:
+        print("  ".join(v.ljust(w) for v, w in zip(line, widths)))
+
+
+def write_results(path: str, results: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    LOG.info(f"Results written to {path}")
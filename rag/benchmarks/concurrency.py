@@ -0,0 +1,158 @@
+"""
+Concurrency benchmark for the RAG pipeline against stubbed backends.
+
+Runs N simultaneous `stream_answer` consumers in one event loop, once with the
+previous blocking pipeline (preprocessing, retrieval and generation called
+synchronously inside the coroutine) and once with the asyncio pipeline, and reports
+throughput and time-to-first-token. The stubs only sleep, so the numbers isolate
+the scheduling behaviour of the pipeline from model and network latency.
+
+    python -m rag.benchmarks.concurrency --concurrency 1 8 32
+"""
+import asyncio
+import time
+from argparse import ArgumentParser
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.main import RAG
+from rag.utils.executors import run_in_executor
+from rag.utils.singleflight import SingleFlight
+
+PREPROCESSING_LLM_LATENCY = 0.4
+CLASSIFICATION_LATENCY = 0.02
+EMBEDDING_LATENCY = 0.05
+DATABASE_LATENCY = 0.08
+RERANKING_LATENCY = 0.3
+TOKEN_INTERVAL = 0.01
+ANSWER_TOKENS = 50
+
+PREPROCESSING_RESULT = {
+    "metadata_filter": {
+        "expanded_queries": [],
+        "data_legislacao": "2024",
+        "theme": None,
+    },
+    "additional_data": {"resumo": None, "assunto": "Faltas"},
+}
+
+DOCUMENTS = [
+    {
+        "metadata": {
+            "title": "Artigo 251.º",
+            "link": "https://diariodarepublica.pt/dr/legislacao-consolidada/lei/2009-34546475",
+            "epigrafe": "Faltas por motivo de falecimento de cônjuge, parente ou afim",
+            "text": "O trabalhador pode faltar justificadamente...",
+        }
+    }
+]
+
+
+class StubPreprocessing:
+    def process_query(self, query, method_names=("all",)):
+        time.sleep(PREPROCESSING_LLM_LATENCY)
+        time.sleep(CLASSIFICATION_LATENCY)
+        return PREPROCESSING_RESULT
+
+    async def aprocess_query(self, query, method_names=("all",)):
+        await asyncio.gather(
+            asyncio.sleep(PREPROCESSING_LLM_LATENCY),
+            run_in_executor(time.sleep, CLASSIFICATION_LATENCY),
+        )
+        return PREPROCESSING_RESULT
+
+
+class StubRetriever:
+    def query(self, query, topk, queue=None, metadata_filter={}):
+        time.sleep(EMBEDDING_LATENCY + DATABASE_LATENCY + RERANKING_LATENCY)
+        if queue:
+            queue.put({query: DOCUMENTS})
+        return DOCUMENTS
+
+    async def aquery(self, query, topk, metadata_filter={}):
+        await run_in_executor(time.sleep, EMBEDDING_LATENCY)
+        await asyncio.sleep(DATABASE_LATENCY + RERANKING_LATENCY)
+        return DOCUMENTS
+
+    async def aspeculative_query(self, query, topk):
+        return DOCUMENTS, await self.aquery(query, topk)
+
+    async def aresolve_speculative_query(
+        self, query, topk, speculative_results, metadata_filter={}
+    ):
+        return speculative_results[1]
+
+
+class StubStreamingRAG:
+    async def astream_answer(self, context_rag, user_question, code_rag, trace=None):
+        for i in range(ANSWER_TOKENS):
+            await asyncio.sleep(TOKEN_INTERVAL)
+            yield f"token{i} "
+
+
+def build_rag() -> RAG:
+    rag = RAG.__new__(RAG)
+    rag.preprocessing = StubPreprocessing()
+    rag.retriever = StubRetriever()
+    rag.streaming_rag = StubStreamingRAG()
+    rag.single_flight = SingleFlight()
+    rag.semantic_cache = None
+    return rag
+
+
+async def blocking_stream_answer(rag: RAG, query: str, topk: int = 3):
+    payload, additional_data = rag._retrieve(query, topk, ("all",))
+    yield {"type": "metadata", "summary": additional_data.get("assunto")}
+    async for token in rag.streaming_rag.astream_answer(
+        payload.get("context_rag"), query, None
+    ):
+        yield {"type": "token", "answer": token}
+
+
+async def consume(stream) -> tuple:
+    start = time.perf_counter()
+    first_token = None
+    async for chunk in stream:
+        if first_token is None and chunk.get("type") == "token":
+            first_token = time.perf_counter() - start
+    return first_token, time.perf_counter() - start
+
+
+async def run(mode: str, concurrency: int) -> dict:
+    rag = build_rag()
+    query = "quantos dias posso faltar se o meu marido morrer?"
+
+    def stream():
+        if mode == "blocking":
+            return blocking_stream_answer(rag, query)
+        return rag.stream_answer(query)
+
+    start = time.perf_counter()
+    answers = await asyncio.gather(*(consume(stream()) for _ in range(concurrency)))
+    wall_time = time.perf_counter() - start
+
+    ttft = percentiles([first_token for first_token, _ in answers])
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "wall_time_s": wall_time,
+        "throughput_qps": concurrency / wall_time,
+        "ttft_p50_s": ttft["p50"],
+        "ttft_p99_s": ttft["p99"],
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    rows = []
+    for concurrency in args.concurrency:
+        for mode in ("blocking", "async"):
+            rows.append(asyncio.run(run(mode, concurrency)))
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Reranker comparison on the Código do Trabalho questions.
+
+Every question in `rag/prompt_specialists/testing/qa_trabalho.json` retrieves
+`--candidates` articles of the Código do Trabalho with BM25, which are then
+reranked by the cross-encoder with each backend (and optionally by the listwise LLM
+reranker, which needs TOGETHER_AI_API_KEY). Reports recall@k, MRR and reranking
+latency per question.
+
+The relevant article is the one cited in the reference answer ("artigo 251.º")
+when there is one. Most answers cite none, so for those the article that best
+matches the reference answer under BM25 is used instead.
+
+    python -m rag.benchmarks.cross_encoder --backends torch int8 onnx --llm
+"""
+import json
+import re
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.retriever.database.bin.utils import BM250RerankingModel
+from rag.retriever.database.bin.utils import CrossEncoderRerankingModel
+from rank_bm25 import BM25Okapi
+
+QA_PATH = Path("rag/prompt_specialists/testing/qa_trabalho.json")
+DATA_PATH = Path("rag/data/Codigo_do_Trabalho/CT_data.json")
+ARTICLE_REGEX = re.compile(r"artigos?\s+(\d+)\.?\s*º", re.IGNORECASE)
+RECALL_AT = (1, 5, 10)
+
+
+def load_articles() -> list:
+    with open(DATA_PATH, "r", encoding="utf-8") as f:
+        sections = json.load(f).get("sections", {})
+    return [
+        {
+            "id": section_key,
+            "title": section.get("title", ""),
+            "text": f"{section.get('epigrafe', '')}\n{section.get('text', '')}",
+        }
+        for section_key, section in sections.items()
+        if section.get("text")
+    ]
+
+
+def load_questions() -> list:
+    with open(QA_PATH, "r", encoding="utf-8") as f:
+        splits = json.load(f)
+    return [qa for split in splits.values() for qa in split]
+
+
+def gold_articles(answer: str, articles: list, bm25: BM25Okapi, tokenize) -> set:
+    cited = {f"Artigo {number}.º" for number in ARTICLE_REGEX.findall(answer)}
+    if cited:
+        gold = {article["id"] for article in articles if article["title"] in cited}
+        if gold:
+            return gold
+    scores = bm25.get_scores(tokenize(answer))
+    return {articles[max(range(len(articles)), key=lambda i: scores[i])]["id"]}
+
+
+def evaluate(rankings: list, golds: list) -> dict:
+    metrics = {f"recall@{k}": 0.0 for k in RECALL_AT}
+    reciprocal_ranks = 0.0
+    for ranking, gold in zip(rankings, golds):
+        for k in RECALL_AT:
+            metrics[f"recall@{k}"] += bool(gold & set(ranking[:k]))
+        rank = next((i for i, doc_id in enumerate(ranking) if doc_id in gold), None)
+        reciprocal_ranks += 1 / (rank + 1) if rank is not None else 0.0
+    metrics = {name: value / len(golds) for name, value in metrics.items()}
+    metrics["mrr"] = reciprocal_ranks / len(golds)
+    return metrics
+
+
+def rank_by(candidates: list, scores: list) -> list:
+    ordered = sorted(zip(candidates, scores), key=lambda pair: pair[1], reverse=True)
+    return [candidate["id"] for candidate, _ in ordered]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--candidates", type=int, default=30)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["torch", "int8"],
+        choices=["torch", "int8", "onnx"],
+    )
+    parser.add_argument("--llm", action="store_true", help="also rerank with the LLM")
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    articles = load_articles()
+    questions = load_questions()
+    tokenize = BM250RerankingModel().preprocess_text
+    bm25 = BM25Okapi([tokenize(article["text"]) for article in articles])
+
+    golds = []
+    candidate_lists = []
+    for qa in questions:
+        golds.append(gold_articles(qa["answer"], articles, bm25, tokenize))
+        scores = bm25.get_scores(tokenize(qa["question"]))
+        top = sorted(range(len(articles)), key=lambda i: scores[i], reverse=True)
+        candidate_lists.append([articles[i] for i in top[: args.candidates]])
+
+    rerankers = {"bm25": None}
+    for backend in args.backends:
+        model = CrossEncoderRerankingModel(backend=backend)
+        rerankers[f"cross_encoder_{backend}"] = model.rerank
+    if args.llm:
+        from rag.retriever.main import Retriever
+        from rag.retriever.main import TOGETHER_API_KEY
+        from together import Together
+
+        # Only the reranking part of the retriever is used, so it is built without
+        # connecting to the database.
+        retriever = Retriever.__new__(Retriever)
+        retriever.reranking_llm = Together(api_key=TOGETHER_API_KEY)
+
+        def llm_rerank(query, documents):
+            documents = [
+                {"id": str(i), "text": text} for i, text in enumerate(documents)
+            ]
+            scores = {
+                r["id"]: r["score"]
+                for r in retriever.listwise_llm_rerank(query, documents)
+            }
+            return [scores.get(document["id"], 0.0) for document in documents]
+
+        rerankers["llm_listwise"] = llm_rerank
+
+    rows = []
+    for name, rerank in rerankers.items():
+        rankings = []
+        latencies = []
+        for qa, candidates in zip(questions, candidate_lists):
+            if rerank is None:
+                rankings.append([candidate["id"] for candidate in candidates])
+                continue
+            # An untimed first call loads the model
+            if not latencies:
+                rerank(qa["question"], [c["text"] for c in candidates[:1]])
+            start = time.perf_counter()
+            scores = rerank(qa["question"], [c["text"] for c in candidates])
+            latencies.append(time.perf_counter() - start)
+            rankings.append(rank_by(candidates, scores))
+
+        latency = percentiles(latencies)
+        rows.append(
+            {
+                "reranker": name,
+                **evaluate(rankings, golds),
+                "latency_p50_s": latency["p50"],
+                "latency_p95_s": latency["p95"],
+            }
+        )
+    print_table(rows)
+
+    if args.output:
+        write_results(args.output, {"candidates": args.candidates, "rerankers": rows})
+
+
+if __name__ == "__main__":
+    main()
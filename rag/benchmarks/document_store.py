@@ -0,0 +1,107 @@
+"""
+Chunk metadata size and document store benchmark.
+
+Chunks the documents under `--data_path` as the vector databases do and compares
+the metadata stored with every chunk, in full and compact, by its JSON size: in
+total (the index storage) and for the `--top-k` chunks a query returns (the query
+payload). Builds a document store with the documents in a temporary directory and
+reports its size and the latency of hydrating a chunk, with the document's record
+decompressed from the memory-mapped file and with it already cached.
+
+    python -m rag.benchmarks.document_store --data_path rag/data --top-k 5
+"""
+import json
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.retriever.database.bin.data_loader import iter_documents
+from rag.retriever.database.models.DocumentStore import compact_metadata
+from rag.retriever.database.models.DocumentStore import DocumentStore
+from rag.retriever.database.models.HybridDatabase import HybridDatabase
+
+
+def json_size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False).encode())
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--data_path", type=str, default="rag/data")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    # Only the chunking of the databases is used, so they are built without
+    # loading the embedding models.
+    store = DocumentStore(tempfile.mkdtemp())
+    database = HybridDatabase.__new__(HybridDatabase)
+    database.document_store = store
+    chunk_ids = []
+    full_sizes = []
+    compact_sizes = []
+    for document in iter_documents(args.data_path):
+        chunks, _ = database.chunk_payload(document)
+        full_size = json_size(document.metadata)
+        compact_size = json_size(compact_metadata(document.metadata))
+        for i in range(len(chunks)):
+            chunk_ids.append(f"{document.id}_part{i}")
+            full_sizes.append(full_size)
+            compact_sizes.append(compact_size)
+    if not chunk_ids:
+        raise SystemExit(f"No documents found under {args.data_path}")
+    stored_size = sum(len(record) for record in store.pending.values())
+    store.save()
+
+    rows = []
+    for name, sizes in (("full", full_sizes), ("compact", compact_sizes)):
+        rows.append(
+            {
+                "metadata": name,
+                "index_mb": sum(sizes) / 2**20,
+                "chunk_bytes": sum(sizes) / len(sizes),
+                f"top{args.top_k}_kb": sum(sizes) / len(sizes) * args.top_k / 1024,
+            }
+        )
+    rows[1]["index_mb"] += stored_size / 2**20
+
+    sample = random.Random(0).sample(chunk_ids, min(args.samples, len(chunk_ids)))
+    latencies = {"cold": [], "cached": []}
+    for chunk_id in sample:
+        store.cache.clear()
+        for mode in latencies:
+            start = time.perf_counter()
+            store.hydrate(chunk_id, {})
+            latencies[mode].append((time.perf_counter() - start) * 1000)
+    hydration = {
+        f"hydrate_{mode}_p50_ms": percentiles(values)["p50"]
+        for mode, values in latencies.items()
+    }
+
+    print(
+        f"{len(store)} documents, {len(chunk_ids)} chunks, document store "
+        f"{stored_size / 2**20:.2f} MB (counted in the compact index size)"
+    )
+    print_table(rows)
+    print_table([hydration])
+
+    if args.output:
+        write_results(
+            args.output,
+            {
+                "documents": len(store),
+                "chunks": len(chunk_ids),
+                "document_store_bytes": stored_size,
+                "metadata": rows,
+                **hydration,
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
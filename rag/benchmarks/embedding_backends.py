@@ -0,0 +1,153 @@
+"""
+Embedding backend parity and latency benchmark.
+
+Embeds the questions of `qa_trabalho.json` and a sample of Código do Trabalho
+articles with the dense and the SPLADE sparse models on each backend ("torch",
+"int8" and "onnx"). Every backend is compared to "torch": the cosine similarity of
+the dense vectors and of the sparse vectors of each text, and the overlap of the 10
+articles closest to each question by the dense vectors. Reports the single-query
+latency of both models and the time to embed the articles in batches.
+
+Exits with status 1 when the lowest dense cosine similarity of a backend is below
+`--min-cosine`, so it can be run as a parity test after changing a backend.
+
+The embedding cache is disabled, so every encoding runs.
+
+    python -m rag.benchmarks.embedding_backends --backends torch int8 onnx --threads 4
+"""
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.benchmarks.cross_encoder import load_articles
+from rag.benchmarks.cross_encoder import load_questions
+from rag.retriever.database.bin.utils import DenseEmbeddingModel
+from rag.retriever.database.bin.utils import EMBEDDING_BACKENDS
+from rag.retriever.database.bin.utils import SparseEmbeddingModel
+from rag.utils.embedding_cache import embedding_cache
+
+
+def sparse_cosine(a: dict, b: dict) -> float:
+    dot = sum(weight * b.get(term, 0.0) for term, weight in a.items())
+    norm = np.sqrt(sum(w * w for w in a.values()) * sum(w * w for w in b.values()))
+    return dot / norm if norm else float(a == b)
+
+
+def top_articles(questions: np.ndarray, articles: np.ndarray, k: int = 10) -> list:
+    scores = questions @ articles.T
+    return [set(np.argsort(-row)[:k]) for row in scores]
+
+
+def timed(function, texts: list) -> list:
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        function(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=list(EMBEDDING_BACKENDS),
+        choices=EMBEDDING_BACKENDS,
+    )
+    parser.add_argument("--articles", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    embedding_cache.enabled = False
+    questions = [qa["question"] for qa in load_questions()]
+    articles = [
+        f"{article['title']}\n{article['text']}"
+        for article in load_articles()[: args.articles]
+    ]
+
+    rows = []
+    reference = None
+    for backend in ["torch"] + [b for b in args.backends if b != "torch"]:
+        dense_model = DenseEmbeddingModel(backend=backend)
+        sparse_model = SparseEmbeddingModel(encoding="splade", backend=backend)
+        # Untimed first calls load the models
+        dense_model.embed_query(questions[0])
+        sparse_model.embed_query(questions[0])
+
+        dense_latencies = timed(dense_model.embed_query, questions)
+        sparse_latencies = timed(sparse_model.embed_query, questions)
+        start = time.perf_counter()
+        article_vecs = np.asarray(dense_model.embed_documents(articles))
+        documents_time = time.perf_counter() - start
+
+        result = {
+            "questions": np.asarray(dense_model.embed_documents(questions)),
+            "articles": article_vecs,
+            "sparse": sparse_model.embed_queries(questions),
+        }
+        result["top"] = top_articles(result["questions"], result["articles"])
+        if reference is None:
+            reference = result
+        if backend not in args.backends:
+            continue
+
+        vecs = np.concatenate([result["questions"], result["articles"]])
+        reference_vecs = np.concatenate([reference["questions"], reference["articles"]])
+        cosines = np.sum(vecs * reference_vecs, axis=1) / (
+            np.linalg.norm(vecs, axis=1) * np.linalg.norm(reference_vecs, axis=1)
+        )
+        sparse_cosines = [
+            sparse_cosine(a, b) for a, b in zip(result["sparse"], reference["sparse"])
+        ]
+        dense_latency = percentiles(dense_latencies)
+        sparse_latency = percentiles(sparse_latencies)
+        rows.append(
+            {
+                "backend": backend,
+                "dense_cosine_min": float(cosines.min()),
+                "dense_cosine_mean": float(cosines.mean()),
+                "sparse_cosine_min": float(min(sparse_cosines)),
+                "top10_overlap": float(
+                    np.mean(
+                        [
+                            len(a & b) / len(b)
+                            for a, b in zip(result["top"], reference["top"])
+                        ]
+                    )
+                ),
+                "dense_p50_ms": dense_latency["p50"],
+                "dense_p95_ms": dense_latency["p95"],
+                "sparse_p50_ms": sparse_latency["p50"],
+                "sparse_p95_ms": sparse_latency["p95"],
+                "articles_s": documents_time,
+            }
+        )
+
+    print(f"{torch.get_num_threads()} threads")
+    print_table(rows)
+
+    if args.output:
+        write_results(
+            args.output, {"threads": torch.get_num_threads(), "backends": rows}
+        )
+
+    failed = [
+        row["backend"] for row in rows if row["dense_cosine_min"] < args.min_cosine
+    ]
+    if failed:
+        print(f"Dense embeddings differ from torch on: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
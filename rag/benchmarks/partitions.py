@@ -0,0 +1,138 @@
+"""
+Metadata filter and legal code partition benchmark on the local vector database.
+
+Searches the local database (built with `RAG_VECTOR_DATABASE=local python -m
+rag.retriever.database.bin.data_loader --data_path rag/data`) with every question
+of `qa_trabalho.json`:
+
+- without a metadata filter,
+- with the legal code filter from the query classifier, applied to the whole index,
+- with the same filter routed to the legal code's partition.
+
+The questions are classified and embedded once, so only the search is timed.
+Questions the classifier is not confident about have no filter in either mode.
+Recall is measured against the same relevant articles as the reranker benchmark.
+
+    python -m rag.benchmarks.partitions --top-k 10 --repetitions 20
+"""
+import time
+from argparse import ArgumentParser
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.benchmarks.cross_encoder import evaluate
+from rag.benchmarks.cross_encoder import gold_articles
+from rag.benchmarks.cross_encoder import load_articles
+from rag.benchmarks.cross_encoder import load_questions
+from rag.prompt_specialists.specialists import SpecialistPrompts
+from rag.query_enhancement.main import Preprocessing
+from rag.retriever.database.bin.data_loader import hash_id
+from rag.retriever.database.bin.utils import BM250RerankingModel
+from rag.retriever.database.models.FAISSDatabase import FAISSDatabase
+from rag.retriever.database.models.HybridDatabase import HYBRID_ALPHA
+from rag.retriever.main import Retriever
+from rank_bm25 import BM25Okapi
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--repetitions", type=int, default=20)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    database = FAISSDatabase()
+    if not database.get_embedding_count():
+        raise SystemExit("The local database is empty, build it first")
+
+    articles = load_articles()
+    questions = load_questions()
+    tokenize = BM250RerankingModel().preprocess_text
+    bm25 = BM25Okapi([tokenize(article["text"]) for article in articles])
+    golds = [
+        {hash_id(section_key) for section_key in gold}
+        for gold in (
+            gold_articles(qa["answer"], articles, bm25, tokenize) for qa in questions
+        )
+    ]
+
+    # Only the filter construction of the retriever is used, so it is built without
+    # connecting to the database.
+    retriever = Retriever.__new__(Retriever)
+    retriever.specialist = SpecialistPrompts()
+    retriever.legal_code_filter = True
+    preprocessing = Preprocessing()
+    texts = [qa["question"] for qa in questions]
+    filters = [
+        retriever.database_filter(
+            preprocessing.parse_results(result)["metadata_filter"]
+        )
+        for result in preprocessing.classify_queries(texts)
+    ]
+    dense_vecs = database.dense_embeddings.embed_documents(texts)
+    sparse_vecs = database.sparse_embeddings.embed_queries(texts)
+
+    rows = []
+    for mode, partitions in (
+        ("no_filter", False),
+        ("filter", False),
+        ("partition", True),
+    ):
+        database.legal_code_partitions = partitions
+        latencies = []
+        rankings = []
+        for dense_vec, sparse_vec, metadata_filter in zip(
+            dense_vecs, sparse_vecs, filters
+        ):
+            metadata_filter = {} if mode == "no_filter" else metadata_filter
+            for _ in range(args.repetitions):
+                start = time.perf_counter()
+                matches = database.hybrid_query_vectors(
+                    dense_vec, sparse_vec, args.top_k, HYBRID_ALPHA, metadata_filter
+                )
+                latencies.append((time.perf_counter() - start) * 1000)
+            # Chunk ids are the section id followed by the chunk number
+            ranking = []
+            for match in matches:
+                section_id = match["id"].rsplit("_part", 1)[0]
+                if section_id not in ranking:
+                    ranking.append(section_id)
+            rankings.append(ranking)
+
+        latency = percentiles(latencies)
+        rows.append(
+            {
+                "mode": mode,
+                **evaluate(rankings, golds),
+                "latency_p50_ms": latency["p50"],
+                "latency_p95_ms": latency["p95"],
+            }
+        )
+
+    routed = sum(bool(metadata_filter) for metadata_filter in filters)
+    partition_sizes = {
+        code: end - start for code, (start, end) in database.partitions.items()
+    }
+    print(
+        f"{database.get_embedding_count()} chunks, partitions: {partition_sizes}, "
+        f"{routed}/{len(questions)} questions classified confidently"
+    )
+    print_table(rows)
+
+    if args.output:
+        write_results(
+            args.output,
+            {
+                "chunks": database.get_embedding_count(),
+                "partitions": partition_sizes,
+                "routed_questions": routed,
+                "questions": len(questions),
+                "top_k": args.top_k,
+                "modes": rows,
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Quantized first-stage benchmark on the local vector database.
+
+Searches the local database (built with `RAG_VECTOR_DATABASE=local python -m
+rag.retriever.database.bin.data_loader --data_path rag/data`) with every question
+of `qa_trabalho.json`, once per first-stage configuration:
+
+- `none`: the float32 vectors, every row scored exactly,
+- `int8` and `binary`: quantized vectors whose best candidates are rescored with
+  the float32 ones (the local database only serves `int8`),
+- `int8:512`, `binary:256`, ...: the same, truncated to the first dimensions.
+
+Reports the size of the first-stage vectors and how much smaller they are than the
+float32 ones, the recall of the exact top-k (the results of `none`), recall@k and
+MRR against the same relevant articles as the reranker benchmark, and the search
+latency. The questions are embedded once, so only the search is timed.
+
+    python -m rag.benchmarks.quantization --configs none int8 binary int8:512
+"""
+import time
+from argparse import ArgumentParser
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.benchmarks.cross_encoder import evaluate
+from rag.benchmarks.cross_encoder import gold_articles
+from rag.benchmarks.cross_encoder import load_articles
+from rag.benchmarks.cross_encoder import load_questions
+from rag.retriever.database.bin.data_loader import hash_id
+from rag.retriever.database.bin.utils import BM250RerankingModel
+from rag.retriever.database.models.DenseQuantizer import DenseQuantizer
+from rag.retriever.database.models.FAISSDatabase import CANDIDATE_FACTOR
+from rag.retriever.database.models.FAISSDatabase import FAISSDatabase
+from rag.retriever.database.models.FAISSDatabase import MIN_CANDIDATES
+from rag.retriever.database.models.HybridDatabase import HYBRID_ALPHA
+from rank_bm25 import BM25Okapi
+
+
+def parse_config(config: str) -> tuple:
+    kind, _, dimensions = config.partition(":")
+    return kind, int(dimensions or 0)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=["none", "int8", "binary", "int8:512", "binary:512"],
+    )
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--candidate-factor", type=int, default=CANDIDATE_FACTOR)
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    # The exact search is the reference, so the HNSW graph is not used
+    database = FAISSDatabase(quantization="none")
+    if not database.get_embedding_count():
+        raise SystemExit("The local database is empty, build it first")
+    database.hnsw = None
+    database.candidate_factor = args.candidate_factor
+
+    articles = load_articles()
+    questions = load_questions()
+    tokenize = BM250RerankingModel().preprocess_text
+    bm25 = BM25Okapi([tokenize(article["text"]) for article in articles])
+    golds = [
+        {hash_id(section_key) for section_key in gold}
+        for gold in (
+            gold_articles(qa["answer"], articles, bm25, tokenize) for qa in questions
+        )
+    ]
+    texts = [qa["question"] for qa in questions]
+    dense_vecs = database.dense_embeddings.embed_documents(texts)
+    sparse_vecs = database.sparse_embeddings.embed_queries(texts)
+
+    def search() -> tuple:
+        latencies = []
+        results = []
+        for dense_vec, sparse_vec in zip(dense_vecs, sparse_vecs):
+            for _ in range(args.repetitions):
+                start = time.perf_counter()
+                matches = database.hybrid_query_vectors(
+                    dense_vec, sparse_vec, args.top_k, HYBRID_ALPHA, {}
+                )
+                latencies.append((time.perf_counter() - start) * 1000)
+            results.append([match["id"] for match in matches])
+        return results, latencies
+
+    database.quantizer = None
+    exact, _ = search()
+
+    rows = []
+    for config in args.configs:
+        kind, dimensions = parse_config(config)
+        if kind == "none":
+            database.quantizer = None
+            nbytes = database.dense.nbytes
+        else:
+            database.quantizer = DenseQuantizer(kind, dimensions).load(
+                database.path, database.dense
+            )
+            nbytes = database.quantizer.nbytes
+        results, latencies = search()
+
+        # Chunk ids are the section id followed by the chunk number
+        rankings = []
+        for ids in results:
+            ranking = []
+            for chunk_id in ids:
+                section_id = chunk_id.rsplit("_part", 1)[0]
+                if section_id not in ranking:
+                    ranking.append(section_id)
+            rankings.append(ranking)
+
+        latency = percentiles(latencies)
+        rows.append(
+            {
+                "config": config,
+                "first_stage_mb": nbytes / 2**20,
+                "compression": database.dense.nbytes / nbytes,
+                f"exact_recall@{args.top_k}": sum(
+                    len(set(ids) & set(reference)) / max(len(reference), 1)
+                    for ids, reference in zip(results, exact)
+                )
+                / len(exact),
+                **evaluate(rankings, golds),
+                "latency_p50_ms": latency["p50"],
+                "latency_p95_ms": latency["p95"],
+            }
+        )
+
+    n_candidates = max(args.top_k * args.candidate_factor, MIN_CANDIDATES)
+    print(
+        f"{database.get_embedding_count()} chunks of {database.dense.shape[1]} "
+        f"dimensions, {n_candidates} dense candidates per query"
+    )
+    print_table(rows)
+
+    if args.output:
+        write_results(
+            args.output,
+            {
+                "chunks": database.get_embedding_count(),
+                "dimensions": database.dense.shape[1],
+                "top_k": args.top_k,
+                "candidate_factor": args.candidate_factor,
+                "configs": rows,
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
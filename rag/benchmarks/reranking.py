@@ -0,0 +1,180 @@
+"""
+LLM reranking benchmark against a local stand-in for the Together API.
+
+Reranks the first `top_k` articles of the Código do Trabalho with the pointwise
+(one call per candidate) and listwise (one call per batch of candidates) modes and
+reports latency and token usage. The stand-in server answers chat completions with
+a well-formed rerank answer after a delay that grows with the prompt and answer
+lengths, approximating a hosted model:
+
+    latency = base + prompt_tokens * prefill + completion_tokens * decode
+
+    python -m rag.benchmarks.reranking --top-k 5 10 20 --repetitions 5
+"""
+import asyncio
+import json
+import re
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock
+from threading import Thread
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.retriever.main import Retriever
+from together import AsyncTogether
+
+DATA_PATH = Path("rag/data/Codigo_do_Trabalho/CT_data.json")
+QUERY = "Quantos dias posso faltar se o meu marido morrer?"
+
+BASE_LATENCY = 0.25
+PREFILL_LATENCY_PER_TOKEN = 0.00005
+DECODE_LATENCY_PER_TOKEN = 0.01
+CHARS_PER_TOKEN = 4
+
+
+class StandInLLM(BaseHTTPRequestHandler):
+    usage_lock = Lock()
+    calls = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = "".join(message["content"] for message in request["messages"])
+        # Score every document id in the prompt, skipping the one in the example
+        ids = [
+            document_id
+            for document_id in re.findall(r'"id":\s*"([^"]+)"', prompt)
+            if document_id != "document_id"
+        ]
+        content = (
+            "<function=rerank>"
+            + json.dumps(
+                {
+                    "results": {
+                        "documents": [
+                            {"id": document_id, "score": 80} for document_id in ids
+                        ]
+                    }
+                }
+            )
+            + "</function>"
+        )
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+        completion_tokens = len(content) // CHARS_PER_TOKEN
+        time.sleep(
+            BASE_LATENCY
+            + prompt_tokens * PREFILL_LATENCY_PER_TOKEN
+            + completion_tokens * DECODE_LATENCY_PER_TOKEN
+        )
+        with self.usage_lock:
+            StandInLLM.calls += 1
+            StandInLLM.prompt_tokens += prompt_tokens
+            StandInLLM.completion_tokens += completion_tokens
+
+        body = json.dumps(
+            {
+                "id": "stand-in",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    @classmethod
+    def reset(cls):
+        with cls.usage_lock:
+            cls.calls = cls.prompt_tokens = cls.completion_tokens = 0
+
+
+def load_documents(count: int) -> list:
+    with open(DATA_PATH, "r", encoding="utf-8") as f:
+        sections = json.load(f).get("sections", {})
+    documents = [
+        {"id": section_key, "text": section.get("text", "")}
+        for section_key, section in sections.items()
+        if section.get("text")
+    ]
+    return documents[:count]
+
+
+async def run(base_url: str, mode: str, top_k: int, repetitions: int) -> dict:
+    # Only the reranking part of the retriever is exercised, so it is built without
+    # connecting to the database.
+    retriever = Retriever.__new__(Retriever)
+    retriever.async_reranking_llm = AsyncTogether(api_key="stand-in", base_url=base_url)
+    documents = load_documents(top_k)
+    rerank = (
+        retriever.alistwise_llm_rerank
+        if mode == "listwise"
+        else retriever.apointwise_llm_rerank
+    )
+
+    StandInLLM.reset()
+    latencies = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        await rerank(QUERY, documents)
+        latencies.append(time.perf_counter() - start)
+
+    latency = percentiles(latencies)
+    return {
+        "mode": mode,
+        "top_k": top_k,
+        "latency_p50_s": latency["p50"],
+        "latency_p95_s": latency["p95"],
+        "calls": StandInLLM.calls // repetitions,
+        "prompt_tokens": StandInLLM.prompt_tokens // repetitions,
+        "completion_tokens": StandInLLM.completion_tokens // repetitions,
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--top-k", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInLLM)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    rows = []
+    for top_k in args.top_k:
+        for mode in ("pointwise", "listwise"):
+            rows.append(asyncio.run(run(base_url, mode, top_k, args.repetitions)))
+    server.shutdown()
+    print_table(rows)
+
+    if args.output:
+        write_results(args.output, {"reranking": rows})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+End-to-end retrieval benchmark and regression check.
+
+Runs every question of `qa_trabalho.json` through `Retriever.query` against the
+local vector database (built with `RAG_VECTOR_DATABASE=local python -m
+rag.retriever.database.bin.data_loader --data_path rag/data`), once per
+configuration. A configuration is a comma-separated list of settings applied to the
+retriever before its questions run, everything else keeping its default:
+
+- `reranking=none|cross_encoder|listwise|pointwise`: the reranking mode (the LLM
+  modes need TOGETHER_AI_API_KEY),
+- `fusion=weighted|rrf` and `normalization=none|minmax|zscore`: the score fusion,
+- `backend=torch|int8|onnx`: the embedding models' backend,
+- `quantization=none|int8|binary`, or `int8:512`, ...: the dense first stage.
+
+Reports recall@k and MRR of the same relevant articles as the reranker benchmark,
+the latency of the whole query and of each traced stage (embedding, search, BM25,
+reranking, fusion), and the process memory after the configuration's questions.
+The embedding cache is disabled, so every question is embedded.
+
+The results are written with `--output` and two result files, from different
+commits, are compared with `--compare`, which exits with status 1 when recall or
+MRR dropped by more than `--tolerance` in any configuration both files have.
+
+    python -m rag.benchmarks.retrieval --configs reranking=none \\
+        reranking=cross_encoder reranking=none,fusion=rrf --output after.json
+    python -m rag.benchmarks.retrieval --compare before.json after.json
+"""
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.benchmarks.cross_encoder import evaluate
+from rag.benchmarks.cross_encoder import gold_articles
+from rag.benchmarks.cross_encoder import load_articles
+from rag.benchmarks.cross_encoder import load_questions
+from rag.benchmarks.workers import memory_mb
+from rag.retriever.database.bin.data_loader import hash_id
+from rag.retriever.database.bin.utils import BM250RerankingModel
+from rag.retriever.database.bin.utils import DenseEmbeddingModel
+from rag.retriever.database.bin.utils import SparseEmbeddingModel
+from rag.retriever.database.models.DenseQuantizer import DenseQuantizer
+from rag.retriever.fusion import ScoreFusion
+from rag.retriever.main import Retriever
+from rag.utils.embedding_cache import embedding_cache
+from rag.utils.tracing import tracer
+from rank_bm25 import BM25Okapi
+
+# Stages reported per configuration, in pipeline order, when they were traced
+STAGES = (
+    "embedding.dense",
+    "embedding.sparse",
+    "local_db.query",
+    "bm25_index.search",
+    "bm25_rerank",
+    "cross_encoder",
+    "llm_rerank.call",
+    "fusion",
+)
+QUALITY_METRICS = ("recall@", "mrr")
+SETTINGS = ("reranking", "fusion", "normalization", "backend", "quantization")
+
+
+def parse_config(config: str) -> dict:
+    settings = {}
+    for setting in config.split(","):
+        key, _, value = setting.partition("=")
+        if not value:
+            raise ValueError(f"Settings are key=value pairs, got: {setting}")
+        if key.strip() not in SETTINGS:
+            raise ValueError(f"Unknown setting: {key}")
+        settings[key.strip()] = value.strip()
+    return settings
+
+
+def configure(retriever: Retriever, defaults: dict, settings: dict):
+    """
+    Reset the retriever to its defaults and apply the configuration's settings.
+    """
+    database = retriever.databasecontroller.vector_db
+    retriever.reranking_mode = defaults["reranking_mode"]
+    retriever.fusion = defaults["fusion"]
+    database.dense_embeddings = defaults["dense_embeddings"]
+    database.sparse_embeddings = defaults["sparse_embeddings"]
+    database.quantizer = defaults["quantizer"]
+
+    if "reranking" in settings:
+        retriever.reranking_mode = settings["reranking"]
+    if "fusion" in settings or "normalization" in settings:
+        retriever.fusion = ScoreFusion(
+            method=settings.get("fusion", retriever.fusion.method),
+            normalization=settings.get("normalization", retriever.fusion.normalization),
+        )
+    if "backend" in settings:
+        database.dense_embeddings = DenseEmbeddingModel(backend=settings["backend"])
+        # The sparse encoding has to stay the one the index was built with
+        database.sparse_embeddings = SparseEmbeddingModel(
+            encoding=database.sparse_embeddings.encoding, backend=settings["backend"]
+        )
+    if "quantization" in settings:
+        kind, _, dimensions = settings["quantization"].partition(":")
+        database.quantizer = (
+            DenseQuantizer(kind, int(dimensions or 0)).load(
+                database.path, database.dense
+            )
+            if kind != "none"
+            else None
+        )
+
+
+def run(retriever: Retriever, questions: list, top_k: int) -> tuple:
+    """
+    The section ids each question retrieved, best first, the latency of each
+    query, and the time spent in each stage per query.
+    """
+    rankings = []
+    latencies = []
+    stages = defaultdict(list)
+    for qa in questions:
+        trace = tracer.start_trace()
+        with tracer.activate(trace):
+            results = retriever.query(qa["question"], top_k)
+        tracer.finish_trace(trace)
+        latencies.append(trace.root.duration * 1000)
+        # A stage can run several times per query, e.g. one LLM call per batch
+        durations = defaultdict(float)
+        for span in trace.spans[1:]:
+            durations[span.name] += span.duration * 1000
+        for name, duration in durations.items():
+            stages[name].append(duration)
+
+        # Chunk ids are the section id followed by the chunk number
+        ranking = []
+        for result in results:
+            section_id = result["id"].rsplit("_part", 1)[0]
+            if section_id not in ranking:
+                ranking.append(section_id)
+        rankings.append(ranking)
+    return rankings, latencies, stages
+
+
+def compare(before_path: str, after_path: str, tolerance: float) -> bool:
+    with open(before_path, "r", encoding="utf-8") as f:
+        before = {row["config"]: row for row in json.load(f)["configs"]}
+    with open(after_path, "r", encoding="utf-8") as f:
+        after = {row["config"]: row for row in json.load(f)["configs"]}
+
+    rows = []
+    regressions = []
+    for config in (config for config in after if config in before):
+        for metric, value in after[config].items():
+            previous = before[config].get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(
+                previous, (int, float)
+            ):
+                continue
+            delta = value - previous
+            rows.append(
+                {
+                    "config": config,
+                    "metric": metric,
+                    "before": float(previous),
+                    "after": float(value),
+                    "delta": float(delta),
+                }
+            )
+            if metric.startswith(QUALITY_METRICS) and delta < -tolerance:
+                regressions.append(f"{config} {metric}")
+    print(f"{before_path} -> {after_path}")
+    print_table(rows)
+    for config in sorted(set(before) ^ set(after)):
+        print(f"Only in {'after' if config in after else 'before'}: {config}")
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+    return not regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--configs", nargs="+", default=["reranking=none", "reranking=cross_encoder"]
+    )
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--questions", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--tolerance", type=float, default=0.01)
+    args = parser.parse_args()
+
+    if args.compare:
+        if not compare(*args.compare, args.tolerance):
+            sys.exit(1)
+        return
+
+    configs = [(config, parse_config(config)) for config in args.configs]
+    retriever = Retriever()
+    database = retriever.databasecontroller.vector_db
+    if not getattr(database, "get_embedding_count", lambda: 0)():
+        raise SystemExit(
+            "The local database is empty or not in use, build it and set "
+            "RAG_VECTOR_DATABASE=local"
+        )
+    embedding_cache.enabled = False
+    defaults = {
+        "reranking_mode": retriever.reranking_mode,
+        "fusion": retriever.fusion,
+        "dense_embeddings": database.dense_embeddings,
+        "sparse_embeddings": database.sparse_embeddings,
+        "quantizer": database.quantizer,
+    }
+
+    articles = load_articles()
+    questions = load_questions()[: args.questions]
+    tokenize = BM250RerankingModel().preprocess_text
+    bm25 = BM25Okapi([tokenize(article["text"]) for article in articles])
+    golds = [
+        {hash_id(section_key) for section_key in gold}
+        for gold in (
+            gold_articles(qa["answer"], articles, bm25, tokenize) for qa in questions
+        )
+    ]
+
+    rows = []
+    for config, settings in configs:
+        configure(retriever, defaults, settings)
+        # An untimed first query loads the configuration's models
+        retriever.query(questions[0]["question"], args.top_k)
+        rankings, latencies, stages = run(retriever, questions, args.top_k)
+        latency = percentiles(latencies)
+        row = {
+            "config": config,
+            **evaluate(rankings, golds),
+            "latency_p50_ms": latency["p50"],
+            "latency_p95_ms": latency["p95"],
+        }
+        for stage in STAGES:
+            if stage in stages:
+                stage_latency = percentiles(stages[stage])
+                row[f"{stage}_p50_ms"] = stage_latency["p50"]
+                row[f"{stage}_p95_ms"] = stage_latency["p95"]
+        memory = memory_mb()
+        row["rss_mb"] = memory.get("rss", 0.0)
+        row["pss_mb"] = memory.get("pss", 0.0)
+        rows.append(row)
+
+    print(
+        f"{len(questions)} questions, {database.get_embedding_count()} chunks, "
+        f"top {args.top_k}"
+    )
+    for row in rows:
+        print_table([row])
+
+    if args.output:
+        write_results(
+            args.output,
+            {
+                "commit": git_commit(),
+                "questions": len(questions),
+                "chunks": database.get_embedding_count(),
+                "top_k": args.top_k,
+                "configs": rows,
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
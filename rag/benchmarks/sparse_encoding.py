@@ -0,0 +1,103 @@
+"""
+Sparse encoding benchmark on the Código do Trabalho questions.
+
+Encodes the articles of the Código do Trabalho with the document side of each sparse
+encoding ("tokens" and "splade"), then encodes every question of `qa_trabalho.json`
+and ranks the articles by the sparse dot product alone. Reports recall@k and MRR
+against the same relevant articles as the reranker benchmark, the query encoding
+latency and the average number of non-zero weights per query and document.
+
+The embedding cache is disabled, so every encoding runs.
+
+    python -m rag.benchmarks.sparse_encoding --encodings tokens splade
+"""
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+
+from rag.benchmarks.common import percentiles
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+from rag.benchmarks.cross_encoder import evaluate
+from rag.benchmarks.cross_encoder import gold_articles
+from rag.benchmarks.cross_encoder import load_articles
+from rag.benchmarks.cross_encoder import load_questions
+from rag.retriever.database.bin.utils import BM250RerankingModel
+from rag.retriever.database.bin.utils import SparseEmbeddingModel
+from rag.utils.embedding_cache import embedding_cache
+from rank_bm25 import BM25Okapi
+
+
+def rank(query_vec: dict, postings: dict, articles: list) -> list:
+    scores = defaultdict(float)
+    for term, weight in query_vec.items():
+        for doc, doc_weight in postings.get(term, ()):
+            scores[doc] += weight * doc_weight
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return [articles[doc]["id"] for doc in ordered]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--encodings",
+        nargs="+",
+        default=["tokens", "splade"],
+        choices=["tokens", "splade"],
+    )
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    embedding_cache.enabled = False
+    articles = load_articles()
+    questions = load_questions()
+    tokenize = BM250RerankingModel().preprocess_text
+    bm25 = BM25Okapi([tokenize(article["text"]) for article in articles])
+    golds = [gold_articles(qa["answer"], articles, bm25, tokenize) for qa in questions]
+
+    rows = []
+    for encoding in args.encodings:
+        model = SparseEmbeddingModel(encoding=encoding)
+        start = time.perf_counter()
+        document_vecs = model.embed_documents(
+            [f"{article['title']}\n{article['text']}" for article in articles]
+        )
+        document_time = time.perf_counter() - start
+        postings = defaultdict(list)
+        for doc, vec in enumerate(document_vecs):
+            for term, weight in vec.items():
+                postings[term].append((doc, weight))
+
+        # An untimed first call loads the query model
+        model.embed_query(questions[0]["question"])
+        latencies = []
+        rankings = []
+        query_terms = 0
+        for qa in questions:
+            start = time.perf_counter()
+            query_vec = model.embed_query(qa["question"])
+            latencies.append((time.perf_counter() - start) * 1000)
+            query_terms += len(query_vec)
+            rankings.append(rank(query_vec, postings, articles))
+
+        latency = percentiles(latencies)
+        rows.append(
+            {
+                "encoding": encoding,
+                **evaluate(rankings, golds),
+                "query_p50_ms": latency["p50"],
+                "query_p95_ms": latency["p95"],
+                "query_terms": query_terms / len(questions),
+                "document_terms": sum(len(vec) for vec in document_vecs)
+                / len(document_vecs),
+                "documents_s": document_time,
+            }
+        )
+    print_table(rows)
+
+    if args.output:
+        write_results(args.output, {"encodings": rows})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Startup benchmark for the RAG service.
+
+Each mode runs in a fresh interpreter, constructs `RAG()` the way the API does at
+import time and reports how long that took and the process' peak RSS:
+
+- lazy: construct only, models load on first use
+- warm: construct and warm up the models on the query path
+- eager: construct and load every registered model, which is what construction
+  used to do before models were loaded through the registry
+
+    python -m rag.benchmarks.startup --output startup.json
+"""
+import json
+import resource
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+
+MODES = ("lazy", "warm", "eager")
+
+
+def rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(mode: str) -> dict:
+    start = time.perf_counter()
+    from rag.main import RAG
+    from rag.utils.registry import registry
+
+    import_time = time.perf_counter() - start
+    rag = RAG()
+    construct_time = time.perf_counter() - start
+
+    if mode == "warm":
+        rag.warm_up()
+    elif mode == "eager":
+        registry.load_all()
+    ready_time = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "import_s": import_time,
+        "construct_s": construct_time,
+        "ready_s": ready_time,
+        "peak_rss_mb": rss_mb(),
+        "models_loaded": sum(
+            model["loaded"] for model in registry.metrics()["models"].values()
+        ),
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--child", choices=MODES, default=None, help="internal")
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return
+
+    rows = []
+    for mode in args.modes:
+        output = subprocess.run(
+            [sys.executable, "-m", "rag.benchmarks.startup", "--child", mode],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        rows.append(json.loads(output.strip().splitlines()[-1]))
+    print_table(rows)
+
+    if args.output:
+        write_results(args.output, {"startup": rows})
+
+
+if __name__ == "__main__":
+    main()
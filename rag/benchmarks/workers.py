@@ -0,0 +1,137 @@
+"""
+Multi-worker memory and throughput benchmark for the query-path models.
+
+Forks N workers that each embed (dense and sparse) and classify questions in a loop
+for a fixed duration, either after loading the models in the parent process, as
+`rag_api/gunicorn_conf.py` does, or with every worker loading its own copy. Each
+worker reports its RSS, which counts shared pages in full, and its PSS, which splits
+them between the processes sharing them, so the sum of PSS is the real footprint.
+
+    python -m rag.benchmarks.workers --workers 1 2 4 --duration 20
+"""
+import gc
+import multiprocessing
+import time
+from argparse import ArgumentParser
+
+from rag.benchmarks.common import print_table
+from rag.benchmarks.common import write_results
+
+QUESTIONS = [
+    "Quantos dias de férias tem um trabalhador por ano?",
+    "Quantos dias posso faltar se o meu marido morrer?",
+    "Qual é o período experimental de um contrato sem termo?",
+    "Como posso extinguir uma associação?",
+]
+
+
+def memory_mb() -> dict:
+    memory = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                memory[key.lower()] = int(value.split()[0]) / 1024
+    return memory
+
+
+def load_models() -> tuple:
+    from rag.query_enhancement.main import Preprocessing
+    from rag.retriever.database.bin.utils import DenseEmbeddingModel
+    from rag.retriever.database.bin.utils import SparseEmbeddingModel
+
+    return DenseEmbeddingModel(), SparseEmbeddingModel(), Preprocessing()
+
+
+def worker(models, shared, threads, duration, barrier, results):
+    import torch
+    from rag.utils.embedding_cache import embedding_cache
+    from rag.utils.registry import registry
+
+    torch.set_num_threads(threads)
+    # The same few questions are embedded over and over, which must run the models
+    embedding_cache.enabled = False
+    dense, sparse, preprocessing = models
+    if not shared:
+        registry.load()
+    registry.warm_up()
+    barrier.wait()
+
+    queries = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        question = QUESTIONS[queries % len(QUESTIONS)]
+        dense.embed_query(question)
+        sparse.embed_query(question)
+        preprocessing.classify_query(question)
+        queries += 1
+
+    results.put({"queries": queries, **memory_mb()})
+
+
+def run(shared: bool, workers: int, duration: float, rows):
+    from rag.utils.registry import registry
+
+    context = multiprocessing.get_context("fork")
+    models = load_models()
+    if shared:
+        registry.load()
+        gc.collect()
+        gc.freeze()
+
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    threads = max(1, multiprocessing.cpu_count() // workers)
+    processes = [
+        context.Process(
+            target=worker,
+            args=(models, shared, threads, duration, barrier, results),
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    rows.put(
+        {
+            "mode": "shared" if shared else "per_worker",
+            "workers": workers,
+            "rss_mb_per_worker": sum(r["rss"] for r in reports) / workers,
+            "pss_mb_per_worker": sum(r["pss"] for r in reports) / workers,
+            "total_pss_mb": sum(r["pss"] for r in reports),
+            "throughput_qps": sum(r["queries"] for r in reports) / duration,
+        }
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    rows = []
+    for workers in args.workers:
+        for shared in (False, True):
+            # Each configuration runs in its own process so that models loaded by
+            # the previous one do not count towards its parent's memory.
+            context = multiprocessing.get_context("spawn")
+            queue = context.Queue()
+            process = context.Process(
+                target=run, args=(shared, workers, args.duration, queue)
+            )
+            process.start()
+            rows.append(queue.get())
+            process.join()
+    print_table(rows)
+
+    if args.output:
+        write_results(args.output, {"workers": rows})
+
+
+if __name__ == "__main__":
+    main()
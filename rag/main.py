@@ -1,12 +1,39 @@
 import asyncio
-from functools import lru_cache
-from queue import Queue
-from threading import Thread
+import logging
+import os
+from typing import AsyncIterator
+from typing import List
 from typing import Optional
+from typing import Tuple
 
 from rag.prompt_specialists.streaming import StreamingRAG
 from rag.query_enhancement.main import Preprocessing
+from rag.retriever.database.models.ArticleIndex import article_numbers
 from rag.retriever.main import Retriever
+from rag.utils.budget import budget_scope
+from rag.utils.budget import LatencyBudget
+from rag.utils.embedding_cache import embedding_cache
+from rag.utils.executors import check_capacity
+from rag.utils.executors import executor_metrics
+from rag.utils.executors import reset_executors
+from rag.utils.executors import shutdown_executors
+from rag.utils.registry import MODEL_WARM_UP
+from rag.utils.registry import registry
+from rag.utils.semantic_cache import SEMANTIC_CACHE_ENABLED
+from rag.utils.semantic_cache import SemanticCache
+from rag.utils.singleflight import normalize_question
+from rag.utils.singleflight import SingleFlight
+from rag.utils.tracing import question_attributes
+from rag.utils.tracing import tracer
+
+LOG = logging.getLogger("RAG")
+
+SPECULATIVE_RETRIEVAL = os.getenv("RAG_SPECULATIVE_RETRIEVAL", "true") == "true"
+# Also retrieve with the expanded queries, fusing their candidates before a single
+# reranking pass. Retrieval then waits for the query expansion, so it is not
+# started speculatively.
+MULTI_QUERY = os.getenv("RAG_MULTI_QUERY", "false") == "true"
+BATCH_GENERATION_CONCURRENCY = int(os.getenv("RAG_BATCH_GENERATION_CONCURRENCY", 8))
 
 
 class RAG:
@@ -14,39 +41,17 @@ class RAG:
         self.retriever = Retriever()
         self.preprocessing = Preprocessing()
         self.streaming_rag = StreamingRAG()
-
-    @lru_cache(maxsize=100)
-    def query(self, query: str, topk: Optional[int] = 3) -> dict:
-        query_preprocessing = self.preprocessing.process_query(
-            query=query,
-            method_names=(
-                "metadata_extraction",
-                "classify_query",
-            ),
-        )
-        # expanded_queries = query_preprocessing.get("expanded_queries", [])
-        expanded_queries = []
-        metadata_filter = query_preprocessing.get("metadata_filter", {})
-        additional_data = query_preprocessing.get("additional_data", {})
-        queue = Queue()
-        threads = []
-        expanded_queries.append(query)
-        for expanded_query in expanded_queries:
-            t = Thread(
-                target=self.retriever.query,
-                args=(expanded_query, topk, queue, metadata_filter),
+        self.single_flight = SingleFlight()
+        self.semantic_cache = (
+            SemanticCache(
+                embedding_model=self.retriever.databasecontroller.vector_db.dense_embeddings,
+                version_provider=self.retriever.databasecontroller.get_index_version,
             )
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        results = {}
-        while not queue.empty():
-            queue_element = queue.get()
-            results.update(queue_element)
+            if SEMANTIC_CACHE_ENABLED
+            else None
+        )
 
+    def build_context(self, query: str, results: dict, metadata_filter: dict) -> dict:
         payload = {
             "code": metadata_filter.get("theme", None),
             "context_rag": [],
@@ -56,88 +61,514 @@ class RAG:
         for result in results.keys():
             documents = results.get(result)
             for document in documents:
-                metadata = document.get("metadata", [])
+                metadata = document.get("metadata", {})
                 payload["context_rag"].append(
                     {
-                        "article_title": metadata["title"],
+                        "article_title": metadata.get("title", ""),
                         "date": metadata_filter["data_legislacao"],
-                        "url": metadata["link"],
-                        "article_name": metadata["epigrafe"],
-                        "content": metadata["text"],
+                        "url": metadata.get("link", ""),
+                        "article_name": metadata.get("epigrafe", ""),
+                        "content": metadata.get("text", ""),
                     }
                 )
 
+        return payload
+
+    def preprocessing_methods(self, method_names: tuple) -> tuple:
+        # Multi-query retrieval needs the expanded queries
+        if (
+            MULTI_QUERY
+            and method_names != ("all",)
+            and "query_enhancement" not in method_names
+        ):
+            return ("query_enhancement",) + tuple(method_names)
+        return method_names
+
+    def direct_context(self, query: str) -> Tuple[Optional[tuple], Optional[str]]:
+        """
+        The context of a question that cites the articles it is about, taken from
+        the article index without preprocessing, retrieval or reranking, and the
+        key of the question in the semantic cache.
+
+        Questions that only differ in the article they cite are embedded close
+        together, so their cached answers are keyed on the cited articles' ids. The
+        key is "" for questions citing no article, and None, which bypasses the
+        cache, for those citing articles the index cannot resolve.
+        """
+        documents = self.retriever.article_lookup(query)
+        if not documents:
+            return None, None if article_numbers(query) else ""
+        trace = tracer.current_trace()
+        if trace:
+            trace.attributes["article_lookup"] = True
+        metadata_filter = {"data_legislacao": None, "theme": None}
+        return (
+            (self.build_context(query, {query: documents}, metadata_filter), {}),
+            ",".join(document["id"] for document in documents),
+        )
+
+    def _retrieve(self, query: str, topk: int, method_names: tuple) -> tuple:
+        query_preprocessing = self.preprocessing.process_query(
+            query=query,
+            method_names=self.preprocessing_methods(method_names),
+        )
+        metadata_filter = query_preprocessing.get("metadata_filter", {})
+        additional_data = query_preprocessing.get("additional_data", {})
+        if MULTI_QUERY:
+            documents = self.retriever.multi_query(
+                query, metadata_filter.get("expanded_queries"), topk, metadata_filter
+            )
+        else:
+            documents = self.retriever.query(query, topk, metadata_filter)
+
+        payload = self.build_context(query, {query: documents}, metadata_filter)
+        return payload, additional_data
+
+    async def _aretrieve(self, query: str, topk: int, method_names: tuple) -> tuple:
+        if SPECULATIVE_RETRIEVAL and not MULTI_QUERY:
+            return await self._aretrieve_speculative(query, topk, method_names)
+
+        query_preprocessing = await self.preprocessing.aprocess_query(
+            query=query,
+            method_names=self.preprocessing_methods(method_names),
+        )
+        metadata_filter = query_preprocessing.get("metadata_filter", {})
+        additional_data = query_preprocessing.get("additional_data", {})
+        if MULTI_QUERY:
+            documents = await self.retriever.amulti_query(
+                query, metadata_filter.get("expanded_queries"), topk, metadata_filter
+            )
+        else:
+            documents = await self.retriever.aquery(query, topk, metadata_filter)
+
+        payload = self.build_context(query, {query: documents}, metadata_filter)
+        return payload, additional_data
+
+    async def _aretrieve_speculative(
+        self, query: str, topk: int, method_names: tuple
+    ) -> tuple:
+        """
+        Start the hybrid search and reranking on the raw query while preprocessing
+        runs, then apply the metadata filter to the speculative results.
+        """
+        speculative_task = asyncio.create_task(
+            self.retriever.aspeculative_query(query, topk)
+        )
+        try:
+            query_preprocessing = await self.preprocessing.aprocess_query(
+                query=query,
+                method_names=method_names,
+            )
+        except BaseException:
+            speculative_task.cancel()
+            raise
+        metadata_filter = query_preprocessing.get("metadata_filter", {})
+        additional_data = query_preprocessing.get("additional_data", {})
+
+        documents = await self.retriever.aresolve_speculative_query(
+            query, topk, await speculative_task, metadata_filter
+        )
+
+        payload = self.build_context(query, {query: documents}, metadata_filter)
+        return payload, additional_data
+
+    def query(
+        self, query: str, topk: Optional[int] = 3, request_id: Optional[str] = None
+    ) -> dict:
+        trace = tracer.start_trace(request_id, **question_attributes(query), topk=topk)
+        try:
+            with tracer.activate(trace):
+                return self._query(query, topk)
+        finally:
+            tracer.finish_trace(trace)
+
+    def _query(self, query: str, topk: int) -> dict:
+        direct_context, cache_key = self.direct_context(query)
+        use_cache = self.semantic_cache and cache_key is not None
+        if use_cache:
+            cached = self.semantic_cache.lookup(query, cache_key)
+            if cached:
+                tracer.current_trace().attributes["semantic_cache_hit"] = True
+                return cached
+
+        payload, additional_data = direct_context or self._retrieve(
+            query, topk, ("metadata_extraction", "classify_query")
+        )
+
         response = self.streaming_rag.stream_answer(
             context_rag=payload.get("context_rag"), user_question=query, code_rag=None
         )
 
-        return {
+        answer = {
             "answer": response.answer,
             "references": response.references[0].url,
             "summary": additional_data.get("assunto"),
         }
+        if use_cache:
+            self.semantic_cache.store(query, answer, cache_key)
+        return answer
 
-    async def stream_answer(self, query: str, topk: Optional[int] = 3):
-        query_preprocessing = self.preprocessing.process_query(
-            query=query,
-            method_names=("all",),
-        )
-        # expanded_queries = query_preprocessing.get("expanded_queries", [])
-        expanded_queries = []
-        metadata_filter = query_preprocessing.get("metadata_filter", {})
-        additional_data = query_preprocessing.get("additional_data", {})
-        queue = Queue()
-        threads = []
-        expanded_queries.append(query)
-        for expanded_query in expanded_queries:
-            t = Thread(
-                target=self.retriever.query,
-                args=(expanded_query, topk, queue, metadata_filter),
+    async def aquery(
+        self,
+        query: str,
+        topk: Optional[int] = 3,
+        request_id: Optional[str] = None,
+        latency_budget: Optional[float] = None,
+    ) -> dict:
+        async def run_query():
+            trace = tracer.start_trace(
+                request_id,
+                **question_attributes(query),
+                topk=topk,
+                latency_budget=latency_budget or 0,
             )
-            threads.append(t)
-            t.start()
+            budget = LatencyBudget(latency_budget) if latency_budget else None
+            try:
+                with tracer.activate(trace), budget_scope(budget):
+                    return await self._aquery(query, topk)
+            finally:
+                tracer.finish_trace(trace)
 
-        for t in threads:
-            t.join()
+        return await self.single_flight.call(
+            self.coalescing_key(query, topk, "query"), run_query, owner=request_id
+        )
 
-        results = {}
-        while not queue.empty():
-            queue_element = queue.get()
-            results.update(queue_element)
+    async def _aquery(self, query: str, topk: int) -> dict:
+        direct_context, cache_key = self.direct_context(query)
+        use_cache = self.semantic_cache and cache_key is not None
+        if use_cache:
+            cached = await self.semantic_cache.alookup(query, cache_key)
+            if cached:
+                tracer.current_trace().attributes["semantic_cache_hit"] = True
+                return cached
 
-        payload = {
-            "code": metadata_filter.get("theme", None),
-            "context_rag": [],
-            "question": query,
+        payload, additional_data = direct_context or await self._aretrieve(
+            query, topk, ("metadata_extraction", "classify_query")
+        )
+
+        response = await self.streaming_rag.aanswer(
+            context_rag=payload.get("context_rag"), user_question=query, code_rag=None
+        )
+
+        answer = {
+            "answer": response.answer,
+            "references": response.references[0].url,
+            "summary": additional_data.get("assunto"),
         }
+        if use_cache:
+            await self.semantic_cache.astore(query, answer, cache_key)
+        return answer
 
-        retrieved_document_ids = []
-        for result in results.keys():
-            documents = results.get(result)
-            for document in documents:
-                metadata = document.get("metadata", [])
-                payload["context_rag"].append(
-                    {
-                        "article_title": metadata["title"],
-                        "date": metadata_filter["data_legislacao"],
-                        "url": metadata["link"],
-                        "article_name": metadata["epigrafe"],
-                        "content": metadata["text"],
-                    }
+    async def _abatch_retrieve(self, queries: List[str], topk: int) -> List[tuple]:
+        query_preprocessings = await self.preprocessing.aprocess_queries(
+            queries, ("metadata_extraction", "classify_query")
+        )
+        metadata_filters = [
+            query_preprocessing.get("metadata_filter", {})
+            for query_preprocessing in query_preprocessings
+        ]
+        documents = await self.retriever.abatch_query(queries, topk, metadata_filters)
+
+        return [
+            (
+                self.build_context(query, {query: results}, metadata_filter),
+                query_preprocessing.get("additional_data", {}),
+            )
+            for query, results, metadata_filter, query_preprocessing in zip(
+                queries, documents, metadata_filters, query_preprocessings
+            )
+        ]
+
+    async def batch_query(
+        self,
+        queries: List[str],
+        topk: Optional[int] = 3,
+        request_id: Optional[str] = None,
+        generation_concurrency: int = BATCH_GENERATION_CONCURRENCY,
+    ) -> AsyncIterator[dict]:
+        """
+        Answer a list of questions, yielding each answer as soon as it is ready.
+
+        Cached answers are yielded first. The remaining questions are preprocessed,
+        embedded and searched as one batch, except those citing articles found in
+        the article index, and their answers are generated concurrently, at most
+        `generation_concurrency` at a time so a large batch does not hit the LLM
+        provider's rate limits. Every chunk carries the `index` of its question in
+        `queries`; a question that fails yields an `error` instead of an answer.
+        """
+        trace = tracer.start_trace(request_id, batch_size=len(queries), topk=topk)
+        tasks = []
+        try:
+            with tracer.activate(trace):
+                direct_contexts = [self.direct_context(query) for query in queries]
+            cached = [None] * len(queries)
+            if self.semantic_cache:
+                cacheable = [
+                    index
+                    for index, (_, cache_key) in enumerate(direct_contexts)
+                    if cache_key is not None
+                ]
+                with tracer.activate(trace):
+                    answers = await asyncio.gather(
+                        *(
+                            self.semantic_cache.alookup(
+                                queries[index], direct_contexts[index][1]
+                            )
+                            for index in cacheable
+                        )
+                    )
+                for index, answer in zip(cacheable, answers):
+                    cached[index] = answer
+                trace.attributes["semantic_cache_hits"] = sum(
+                    answer is not None for answer in cached
                 )
-                retrieved_document_ids.append(metadata["epigrafe"])
+            for index, answer in enumerate(cached):
+                if answer:
+                    yield {"index": index, "query": queries[index], **answer}
 
-        print("Retrieved: ", retrieved_document_ids)
+            pending = [index for index, answer in enumerate(cached) if not answer]
+            if not pending:
+                return
 
-        response = self.streaming_rag.stream_answer(
-            context_rag=payload.get("context_rag"), user_question=query, code_rag=None
+            retrieved = {
+                index: direct_contexts[index][0]
+                for index in pending
+                if direct_contexts[index][0]
+            }
+            to_retrieve = [index for index in pending if index not in retrieved]
+            if to_retrieve:
+                with tracer.activate(trace):
+                    contexts = await self._abatch_retrieve(
+                        [queries[index] for index in to_retrieve], topk
+                    )
+                retrieved.update(zip(to_retrieve, contexts))
+
+            semaphore = asyncio.Semaphore(generation_concurrency)
+            tasks = [
+                asyncio.create_task(
+                    self._abatch_answer(
+                        index,
+                        queries[index],
+                        *retrieved[index],
+                        semaphore,
+                        trace,
+                        direct_contexts[index][1],
+                    )
+                )
+                for index in pending
+            ]
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            tracer.finish_trace(trace)
+
+    async def _abatch_answer(
+        self,
+        index: int,
+        query: str,
+        payload: dict,
+        additional_data: dict,
+        semaphore: asyncio.Semaphore,
+        trace,
+        cache_key: Optional[str] = "",
+    ) -> dict:
+        context_rag = payload.get("context_rag")
+        try:
+            async with semaphore:
+                answer_tokens = [
+                    token
+                    async for token in self.streaming_rag.astream_answer(
+                        context_rag=context_rag,
+                        user_question=query,
+                        code_rag=None,
+                        trace=trace,
+                    )
+                ]
+        except Exception as e:
+            LOG.error(f"Error answering batch query {index}: {e}")
+            return {"index": index, "query": query, "error": str(e)}
+
+        answer = {
+            "answer": "".join(answer_tokens),
+            "references": context_rag[0]["url"] if context_rag else None,
+            "summary": additional_data.get("assunto"),
+        }
+        if self.semantic_cache and cache_key is not None and context_rag:
+            await self.semantic_cache.astore(query, answer, cache_key)
+        return {"index": index, "query": query, **answer}
+
+    def coalescing_key(self, query: str, topk: int, kind: str) -> str:
+        return f"{kind}:{topk}:{normalize_question(query)}"
+
+    async def stream_answer(
+        self,
+        query: str,
+        topk: Optional[int] = 3,
+        request_id: Optional[str] = None,
+        latency_budget: Optional[float] = None,
+    ):
+        """
+        Yield a `metadata` chunk with the references and summary as soon as retrieval
+        is done, followed by one `token` chunk per token produced by the LLM.
+
+        Concurrent identical questions share a single pipeline execution and all
+        receive the same stream. `latency_budget` bounds, in seconds, the time spent
+        before the answer starts streaming by degrading optional stages.
+        """
+        flight, leader = self.single_flight.join(
+            self.coalescing_key(query, topk, "stream"),
+            lambda: self._stream_answer(query, topk, request_id, latency_budget),
+            owner=request_id,
+        )
+        if leader:
+            async for chunk in flight.subscribe():
+                yield chunk
+            return
+
+        trace = tracer.start_trace(
+            request_id,
+            **question_attributes(query),
+            topk=topk,
+            coalesced_with=flight.owner,
+        )
+        try:
+            async for chunk in flight.subscribe():
+                yield chunk
+        finally:
+            tracer.finish_trace(trace)
+
+    async def _stream_answer(
+        self,
+        query: str,
+        topk: int,
+        request_id: Optional[str] = None,
+        latency_budget: Optional[float] = None,
+    ):
+        """
+        Run the pipeline for one question and yield its chunks.
+
+        The trace is only activated around awaits that do not cross a yield, since the
+        consumer may resume the generator from a different context.
+        """
+        trace = tracer.start_trace(
+            request_id,
+            **question_attributes(query),
+            topk=topk,
+            latency_budget=latency_budget or 0,
         )
+        budget = LatencyBudget(latency_budget) if latency_budget else None
+        try:
+            with tracer.activate(trace):
+                direct_context, cache_key = self.direct_context(query)
+            use_cache = self.semantic_cache and cache_key is not None
+            if use_cache:
+                with tracer.activate(trace):
+                    cached = await self.semantic_cache.alookup(query, cache_key)
+                if cached:
+                    trace.attributes["semantic_cache_hit"] = True
+                    yield {
+                        "type": "metadata",
+                        "references": cached["references"],
+                        "summary": cached["summary"],
+                    }
+                    yield {"type": "token", **cached}
+                    return
+
+            with tracer.activate(trace), budget_scope(budget):
+                payload, additional_data = direct_context or await self._aretrieve(
+                    query, topk, ("all",)
+                )
+            context_rag = payload.get("context_rag")
 
-        answer_chunks = response.answer.split()
-        for chunk in answer_chunks:
+            LOG.debug(
+                f"Retrieved: {[context['article_name'] for context in context_rag]}"
+            )
+
+            references = context_rag[0]["url"] if context_rag else None
+            summary = additional_data.get("assunto")
             yield {
-                "answer": chunk + " ",
-                "references": response.references[0].url,
-                "summary": additional_data.get("assunto"),
+                "type": "metadata",
+                "references": references,
+                "summary": summary,
             }
-            await asyncio.sleep(0.1)
+
+            answer_tokens = []
+            async for token in self.streaming_rag.astream_answer(
+                context_rag=context_rag, user_question=query, code_rag=None, trace=trace
+            ):
+                answer_tokens.append(token)
+                yield {
+                    "type": "token",
+                    "answer": token,
+                    "references": references,
+                    "summary": summary,
+                }
+
+            if use_cache and context_rag:
+                await self.semantic_cache.astore(
+                    query,
+                    {
+                        "answer": "".join(answer_tokens),
+                        "references": references,
+                        "summary": summary,
+                    },
+                    cache_key,
+                )
+        finally:
+            tracer.finish_trace(trace)
+
+    def metrics(self) -> dict:
+        metrics = {}
+        if self.semantic_cache:
+            metrics["semantic_cache"] = self.semantic_cache.metrics()
+        metrics["single_flight"] = self.single_flight.metrics()
+        metrics["stages"] = tracer.metrics()
+        metrics["models"] = registry.metrics()
+        metrics["embedding_cache"] = embedding_cache.metrics()
+        metrics["executors"] = executor_metrics()
+        return metrics
+
+    def check_capacity(self):
+        """
+        Raise `ExecutorSaturatedError` when the executors are too busy to take a new
+        request, which should then be retried later.
+        """
+        check_capacity()
+
+    def warm_up(self):
+        """
+        Load the models used on the query path and run one inference through each,
+        so the first requests do not pay for it. With RAG_MODEL_WARM_UP=false the
+        models are left to load on first use.
+        """
+        registry.warm_up(None if MODEL_WARM_UP else [])
+
+    def is_ready(self) -> bool:
+        return registry.ready
+
+    def load_models(self):
+        registry.load()
+
+    def after_fork(self):
+        """
+        Reopen the connections inherited from the parent process, which must not be
+        shared between workers: the vector database and the LLM clients, whose
+        connection pools and event loop state belong to the parent. The executors
+        are reset too, as their threads were not forked.
+        """
+        reset_executors()
+        self.retriever.databasecontroller.vector_db.reconnect()
+        self.retriever.connect()
+        self.preprocessing.connect()
+        self.streaming_rag.connect()
+        if self.semantic_cache:
+            # The first worker to start saves the cache the workers share
+            self.semantic_cache.release_persistence()
+            self.semantic_cache.claim_persistence()
+
+    def shutdown(self):
+        if self.semantic_cache:
+            self.semantic_cache.save()
+        shutdown_executors()
@@ -7,6 +7,7 @@ import dspy
 import pydantic
 from dotenv import load_dotenv
 from rag.prompt_specialists.utils.logging import logger
+from rag.utils.tracing import tracer
 
 # NOTA_FINAL = """**Observação:** Esta análise é meramente informativa e não substitui o aconselhamento jurídico de um profissional."""
 NOTA_FINAL = """"""
@@ -45,6 +46,12 @@ class GenerateAnswer(dspy.Signature):
     )
 
 
+STREAMING_INSTRUCTIONS = f"""{GenerateAnswer.__doc__.strip()}
+    4. Escreve a resposta diretamente em markdown, sublinhando os aspetos mais importantes como artigos citados (com **), parágrafos (\n), e listas (-).
+    5. Responde apenas com o texto da resposta, sem introduções nem listas de referências no fim.
+    """
+
+
 class RAGPrompt(dspy.Module):
     def __init__(self):
         super().__init__()
@@ -53,8 +60,10 @@ class RAGPrompt(dspy.Module):
 
     def forward(self, question, context, hint):
         init_time = datetime.now()
-        pred = self.generate_answer(context=context, question=question, hint=hint)
-        ans_markdown = self.markdown(question=question, answer=pred.answer.answer)
+        with tracer.span("answer_generation"):
+            pred = self.generate_answer(context=context, question=question, hint=hint)
+        with tracer.span("markdown"):
+            ans_markdown = self.markdown(question=question, answer=pred.answer.answer)
         final_res = ans_markdown.answer_markdown
         final_res = final_res + f"\n\n{NOTA_FINAL}"
         final_time = datetime.now()
@@ -1,17 +1,37 @@
+import json
+from datetime import datetime
+from typing import AsyncIterator
+from typing import List
+from typing import Optional
+
+import dspy
+from rag.prompt_specialists.generator import NOTA_FINAL
 from rag.prompt_specialists.generator import RAGPrompt
+from rag.prompt_specialists.generator import STREAMING_INSTRUCTIONS
 from rag.prompt_specialists.specialists import SpecialistPrompts
 from rag.prompt_specialists.utils.config import Config
 from rag.prompt_specialists.utils.logging import logger
+from rag.utils.executors import run_in_io_executor
+from rag.utils.tracing import Trace
+from rag.utils.tracing import tracer
+from together import AsyncTogether
 
 
 class StreamingRAG:
     def __init__(self):
         self.rag_class = RAGPrompt()
+        self.config = Config()
+        self.connect()
 
-    def stream_answer(self, context_rag, user_question, code_rag):
-        config = Config()
-        lm = config.setup_models()
+    def connect(self):
+        """
+        Create the LLM clients, again in each worker after a fork, as their
+        connection pools must not be shared between processes.
+        """
+        self.lm = self.config.create_model()
+        self.streaming_llm = AsyncTogether(api_key=self.config.together_api_key)
 
+    def get_hint(self, code_rag):
         specialist = SpecialistPrompts()
 
         if code_rag is None:
@@ -29,8 +49,95 @@ class StreamingRAG:
             else:
                 hint = introduction
 
-        model_answer = self.rag_class(
-            context=context_rag, question=user_question, hint=hint
-        )
+        return hint
+
+    def stream_answer(self, context_rag, user_question, code_rag):
+        hint = self.get_hint(code_rag)
+
+        # dspy.configure may only be called from one thread, so the model is scoped
+        # with dspy.context to allow this to run on the IO executor.
+        with dspy.context(lm=self.lm):
+            model_answer = self.rag_class(
+                context=context_rag, question=user_question, hint=hint
+            )
 
         return model_answer
+
+    async def aanswer(self, context_rag, user_question, code_rag):
+        return await run_in_io_executor(
+            self.stream_answer, context_rag, user_question, code_rag
+        )
+
+    async def astream_answer(
+        self,
+        context_rag: List[dict],
+        user_question: str,
+        code_rag,
+        trace: Optional[Trace] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Stream the answer token by token as the LLM produces it.
+
+        Unlike `stream_answer`, this issues a single streamed completion that is asked
+        to write markdown directly, so the first token reaches the caller after the
+        model's own time-to-first-token instead of after the full DSPy pipeline.
+        """
+        hint = self.get_hint(code_rag)
+        messages = [
+            {"role": "system", "content": f"{hint}\n\n{STREAMING_INSTRUCTIONS}"},
+            {
+                "role": "user",
+                "content": (
+                    "Contexto:\n"
+                    + json.dumps(context_rag, ensure_ascii=False)
+                    + f"\n\nQuestão: {user_question}"
+                ),
+            },
+        ]
+
+        init_time = datetime.now()
+        first_token_time = None
+        chunks = 0
+        usage = None
+        # The span is ended explicitly rather than with `tracer.span` because it
+        # stays open across yields, which may resume in a different context.
+        trace = trace or tracer.current_trace()
+        span = trace.start_span("answer_generation", streaming=True) if trace else None
+        try:
+            stream = await self.streaming_llm.chat.completions.create(
+                model=self.config.streaming_model,
+                messages=messages,
+                max_tokens=self.config.max_tokens,
+                temperature=0,
+                stream=True,
+            )
+            async for chunk in stream:
+                # The last chunk carries the token usage of the whole completion
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content
+                if not token:
+                    continue
+                if first_token_time is None:
+                    first_token_time = datetime.now()
+                    logger.info(f"Time to first token: {first_token_time - init_time}")
+                    if span:
+                        span.set_attribute(
+                            "time_to_first_token",
+                            (first_token_time - init_time).total_seconds(),
+                        )
+                chunks += 1
+                yield token
+
+            if NOTA_FINAL:
+                yield f"\n\n{NOTA_FINAL}"
+        finally:
+            if span:
+                if usage is not None:
+                    span.set_attribute(
+                        "completion_tokens", getattr(usage, "completion_tokens", 0)
+                    )
+                span.end(chunks=chunks)
+
+        logger.info(f"Time passed streaming answer: {datetime.now() - init_time}")
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -5,12 +6,17 @@ import re
 from datetime import datetime
 from functools import lru_cache
 from pathlib import Path
-from queue import Queue
-from threading import Thread
 from typing import List
 
 import spacy
 from dotenv import load_dotenv
+from rag.utils.budget import optional_stage
+from rag.utils.executors import get_executor
+from rag.utils.executors import run_in_executor
+from rag.utils.registry import registry
+from rag.utils.registry import WARM_UP_TEXT
+from rag.utils.tracing import tracer
+from together import AsyncTogether
 from together import Together
 
 logging.basicConfig(level=logging.INFO)
@@ -40,12 +46,26 @@ class Preprocessing:
         ) as f:
             self.query_metadata_few_shot_examples = json.load(f)
 
+        self.connect()
+        registry.register(
+            "spacy:classifier",
+            lambda: spacy.load(CLASSIFIER_MODEL),
+            warm_up=lambda model: model(WARM_UP_TEXT),
+        )
+
+    def connect(self):
+        # Called again by each worker after a fork, see RAG.after_fork
         self.enhancement_client = Together(api_key=ENHANCEMENT_API_KEY)
         self.extraction_client = Together(api_key=EXTRACTION_API_KEY)
-        self.classifier_model = spacy.load(CLASSIFIER_MODEL)
+        self.async_enhancement_client = AsyncTogether(api_key=ENHANCEMENT_API_KEY)
+        self.async_extraction_client = AsyncTogether(api_key=EXTRACTION_API_KEY)
+
+    @property
+    def classifier_model(self):
+        return registry.get("spacy:classifier")
 
-    def query_enhancement(self, query: str, queue: Queue) -> None:
-        query_expansion_prompt = f"""
+    def query_expansion_prompt(self, query: str) -> str:
+        return f"""
         És um sistema de informação que processa queries dos utilizadores.
         Expande uma query dada em 2 queries semelhantes no seu significado.
 
@@ -74,21 +94,50 @@ class Preprocessing:
         - Usa vírgulas para separar os elementos.
         - Usa chavetas para agrupar os elementos.
         """
+
+    def query_enhancement(self, query: str) -> dict:
         result = self._expand_query(
-            query_expansion_prompt, self.query_expansion_few_shot_examples
+            self.query_expansion_prompt(query), self.query_expansion_few_shot_examples
         )
-        queue.put({"queries_expanded": result})
+        return {"queries_expanded": result}
+
+    async def aquery_enhancement(self, query: str) -> dict:
+        try:
+            messages = self.query_expansion_few_shot_examples + [
+                {"role": "user", "content": self.query_expansion_prompt(query)}
+            ]
+            init_time = datetime.now()
+
+            with tracer.span("query_expansion"):
+                response = await self.async_enhancement_client.chat.completions.create(
+                    model="mistralai/Mistral-7B-Instruct-v0.1",
+                    messages=messages,
+                    temperature=0,
+                )
+
+            expanded_queries = self.parse_tool_response(
+                response.choices[0].message.content
+            )
+
+            final_time = datetime.now()
+            LOG.info(f"Query expansion took {final_time - init_time} seconds")
+
+        except Exception as e:
+            LOG.error(f"Failed to expand query: {e}")
+            expanded_queries = {}
+        return {"queries_expanded": expanded_queries}
 
     def _expand_query(self, query: str, few_shot_examples: list) -> dict:
         try:
             messages = few_shot_examples + [{"role": "user", "content": query}]
             init_time = datetime.now()
 
-            response = self.enhancement_client.chat.completions.create(
-                model="mistralai/Mistral-7B-Instruct-v0.1",
-                messages=messages,
-                temperature=0,
-            )
+            with tracer.span("query_expansion"):
+                response = self.enhancement_client.chat.completions.create(
+                    model="mistralai/Mistral-7B-Instruct-v0.1",
+                    messages=messages,
+                    temperature=0,
+                )
 
             expanded_queries = response.choices[0].message.content
             expanded_queries = self.parse_tool_response(expanded_queries)
@@ -102,8 +151,8 @@ class Preprocessing:
         finally:
             return expanded_queries
 
-    def metadata_extraction(self, query: str, queue: Queue) -> None:
-        user_query = f"""
+    def metadata_extraction_prompt(self, query: str) -> str:
+        return f"""
         Tens acesso a uma função que extrai metadados de uma query.
         Para extrair metadados da query '{query}', usa o seguinte formato:
 
@@ -126,15 +175,19 @@ class Preprocessing:
         - Usa chavetas para agrupar os elementos.
         """
 
+    def metadata_extraction(self, query: str) -> dict:
         try:
             messages = self.query_metadata_few_shot_examples + [
-                {"role": "user", "content": user_query}
+                {"role": "user", "content": self.metadata_extraction_prompt(query)}
             ]
             init_time = datetime.now()
 
-            response = self.extraction_client.chat.completions.create(
-                model="meta-llama/Llama-Vision-Free", messages=messages, temperature=0
-            )
+            with tracer.span("metadata_extraction"):
+                response = self.extraction_client.chat.completions.create(
+                    model="meta-llama/Llama-Vision-Free",
+                    messages=messages,
+                    temperature=0,
+                )
 
             metadata = response.choices[0].message.content
             metadata = self.parse_tool_response(metadata)
@@ -146,20 +199,67 @@ class Preprocessing:
             LOG.error("Failed to decode JSON response for metadata extraction.")
             metadata = {}
         finally:
-            queue.put({"metadata": metadata})
+            return {"metadata": metadata}
+
+    async def ametadata_extraction(self, query: str) -> dict:
+        try:
+            messages = self.query_metadata_few_shot_examples + [
+                {"role": "user", "content": self.metadata_extraction_prompt(query)}
+            ]
+            init_time = datetime.now()
+
+            with tracer.span("metadata_extraction"):
+                response = await self.async_extraction_client.chat.completions.create(
+                    model="meta-llama/Llama-Vision-Free",
+                    messages=messages,
+                    temperature=0,
+                )
+
+            metadata = self.parse_tool_response(response.choices[0].message.content)
+
+            final_time = datetime.now()
+            LOG.info(f"Metadata extraction took {final_time - init_time} seconds")
 
-    def classify_query(self, query: str, queue: Queue) -> None:
+        except Exception as e:
+            LOG.error(f"Failed to extract metadata: {e}")
+            metadata = {}
+        return {"metadata": metadata}
+
+    def classify_query(self, query: str) -> dict:
         init_time = datetime.now()
-        result = self.classifier_model(self._remove_stopwords(query))
+        with tracer.span("classification"):
+            result = self.classifier_model(self._remove_stopwords(query))
         sorted_results = sorted(result.cats.items(), key=lambda x: x[1], reverse=True)[
             0
         ]
         final_time = datetime.now()
         LOG.info(f"Query classification took {final_time - init_time} seconds")
-        queue.put({"theme": sorted_results})
+        return {"theme": sorted_results}
+
+    async def aclassify_query(self, query: str) -> dict:
+        return await run_in_executor(self.classify_query, query)
+
+    def classify_queries(self, queries: List[str]) -> List[dict]:
+        init_time = datetime.now()
+        with tracer.span("classification", batch_size=len(queries)):
+            filtered_queries = [
+                self._filter_stopwords(doc)
+                for doc in self.classifier_model.pipe(queries)
+            ]
+            results = list(self.classifier_model.pipe(filtered_queries))
+        final_time = datetime.now()
+        LOG.info(
+            f"Classification of {len(queries)} queries took {final_time - init_time} seconds"
+        )
+        return [
+            {"theme": sorted(result.cats.items(), key=lambda x: x[1], reverse=True)[0]}
+            for result in results
+        ]
 
     def _remove_stopwords(self, text: str) -> str:
-        doc = self.classifier_model(text)
+        return self._filter_stopwords(self.classifier_model(text))
+
+    def _filter_stopwords(self, doc) -> str:
         filtered_words = [
             token.text for token in doc if not token.is_stop and not token.is_punct
         ]
@@ -187,12 +287,12 @@ class Preprocessing:
         metadata = results.get("metadata", {})
         data_legislacao = metadata.get("data_legislacao", None)
         theme = results.get("theme", None)
-        expanded_queries = results.get("queries_expanded", [])
+        expanded_queries = results.get("queries_expanded", {}) or {}
         payload = {
             "metadata_filter": {
                 "expanded_queries": expanded_queries.get("queries_expandidas", []),
                 "data_legislacao": data_legislacao,
-                "theme": theme[0] if theme[1] > 0.8 else None,
+                "theme": theme[0] if theme and theme[1] > 0.8 else None,
             },
             "additional_data": {
                 "resumo": metadata.get("resumo", None),
@@ -216,22 +316,110 @@ class Preprocessing:
             method_names = tuple(method_mapping.keys())
 
         LOG.info(f"Methods to be executed: {method_names}")
-        queue = Queue()
-        threads = []
+        # The LLM calls go to the IO executor while the classifier runs here
+        io_executor = get_executor("io")
+        futures = [
+            io_executor.defer(method_mapping[method_name], query)
+            for method_name in method_names
+            if method_name != "classify_query"
+        ]
+
+        results = {}
+        if "classify_query" in method_names:
+            results.update(self.classify_query(query))
+        for future in futures:
+            results.update(future.result())
+
+        final_time = datetime.now()
+        LOG.info(f"Processing query took {final_time - init_time} seconds")
+        return self.parse_results(results)
+
+    def async_method_mapping(self) -> dict:
+        # Query expansion and metadata extraction are optional and give way to the
+        # request's latency budget; classification is cheap and always runs.
+        return {
+            "query_enhancement": lambda query: optional_stage(
+                "query_expansion",
+                lambda: self.aquery_enhancement(query),
+                {"queries_expanded": {}},
+            ),
+            "metadata_extraction": lambda query: optional_stage(
+                "metadata_extraction",
+                lambda: self.ametadata_extraction(query),
+                {"metadata": {}},
+            ),
+            "classify_query": self.aclassify_query,
+        }
 
-        for method_name in method_names:
-            method = method_mapping[method_name]
-            t = Thread(target=method, args=(query, queue))
-            threads.append(t)
-            t.start()
+    async def aprocess_query(
+        self, query: str, method_names: tuple[str] = ("all",)
+    ) -> dict:
+        LOG.info(f"Processing query: {query}")
+        init_time = datetime.now()
 
-        for t in threads:
-            t.join()
+        method_mapping = self.async_method_mapping()
+
+        if method_names == ("all",):
+            method_names = tuple(method_mapping.keys())
+
+        LOG.info(f"Methods to be executed: {method_names}")
+        answers = await asyncio.gather(
+            *(method_mapping[method_name](query) for method_name in method_names)
+        )
 
         results = {}
-        while not queue.empty():
-            results.update(queue.get())
+        for answer in answers:
+            results.update(answer)
 
         final_time = datetime.now()
         LOG.info(f"Processing query took {final_time - init_time} seconds")
         return self.parse_results(results)
+
+    async def aprocess_queries(
+        self, queries: List[str], method_names: tuple[str] = ("all",)
+    ) -> List[dict]:
+        """
+        Preprocess a batch of queries. Classification runs once over the whole batch
+        with `nlp.pipe`, while the LLM stages are issued concurrently per query.
+        """
+        LOG.info(f"Processing {len(queries)} queries")
+        init_time = datetime.now()
+
+        method_mapping = self.async_method_mapping()
+
+        if method_names == ("all",):
+            method_names = tuple(method_mapping.keys())
+
+        llm_method_names = [name for name in method_names if name != "classify_query"]
+
+        async def classify() -> List[dict]:
+            if "classify_query" not in method_names:
+                return [{} for _ in queries]
+            return await run_in_executor(self.classify_queries, queries)
+
+        async def run_llm_methods(query: str) -> dict:
+            answers = await asyncio.gather(
+                *(
+                    method_mapping[method_name](query)
+                    for method_name in llm_method_names
+                )
+            )
+            results = {}
+            for answer in answers:
+                results.update(answer)
+            return results
+
+        classifications, *llm_results = await asyncio.gather(
+            classify(), *(run_llm_methods(query) for query in queries)
+        )
+
+        processed = []
+        for classification, results in zip(classifications, llm_results):
+            results.update(classification)
+            processed.append(self.parse_results(results))
+
+        final_time = datetime.now()
+        LOG.info(
+            f"Processing {len(queries)} queries took {final_time - init_time} seconds"
+        )
+        return processed
@@ -1,12 +1,14 @@
 #!/usr/bin/env/python3
 import json
 import logging
+import os
+import time
 from typing import List
 from typing import Optional
 
 from rag.retriever.database.bin.models import EmbeddingDocument
 from rag.retriever.database.bin.utils import EmbeddingModel
-from rag.retriever.database.models.PineconeDatabase import PineconeDatabase as Pinecone
+from rag.utils.executors import ExecutorSaturatedError
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,31 +20,115 @@ logging.basicConfig(
 )
 LOG = logging.getLogger("DB_CONTROLLER")
 
+# Changed by every insert so the semantic caches of the serving processes drop
+# their answers. It is a file, not a property of the index: when the documents are
+# inserted into Pinecone from another machine, it must point to storage shared with
+# the servers, or their caches keep serving answers from before the insert until
+# they expire.
+INDEX_VERSION_PATH = os.getenv("RAG_INDEX_VERSION_PATH", ".cache/index_version")
+# "pinecone" or "local" (the on-disk FAISSDatabase, which needs no network)
+VECTOR_DATABASE = os.getenv("RAG_VECTOR_DATABASE", "pinecone")
+
+
+def create_vector_database(backend: str = VECTOR_DATABASE):
+    # Imported here so the local backend runs without the Pinecone client
+    if backend == "pinecone":
+        from rag.retriever.database.models.PineconeDatabase import PineconeDatabase
+
+        return PineconeDatabase()
+    if backend == "local":
+        from rag.retriever.database.models.FAISSDatabase import FAISSDatabase
+
+        return FAISSDatabase()
+    raise ValueError(f"Unknown vector database: {backend}")
+
 
 class DatabaseController:
     def __init__(self):
         self.embeddings = EmbeddingModel()
-        self.pinecone_db = Pinecone()
+        self.vector_db = create_vector_database()
 
     def insert_many_into_databases(self, payload: List[EmbeddingDocument]):
         LOG.info("Inserting many documents into databases")
         try:
-            self.pinecone_db.insert_many_into_databases(payload)
+            self.vector_db.insert_many_into_databases(payload)
         except Exception as e:
             LOG.error(f"Error inserting payload into database: {e}")
+        finally:
+            self.bump_index_version()
 
     def insert_into_databases(self, payload: EmbeddingDocument):
         try:
-            self.pinecone_db.insert_into_database(payload)
+            self.vector_db.insert_into_database(payload)
         except Exception as e:
             LOG.error(f"Error inserting payload into database: {e}")
+        finally:
+            self.bump_index_version()
+
+    def bump_index_version(self):
+        """
+        Record that the index content changed, so caches built on top of query
+        results in other processes know they are stale.
+        """
+        os.makedirs(os.path.dirname(INDEX_VERSION_PATH) or ".", exist_ok=True)
+        with open(INDEX_VERSION_PATH, "w") as f:
+            f.write(str(time.time_ns()))
+
+    def get_index_version(self) -> str:
+        try:
+            with open(INDEX_VERSION_PATH, "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ""
 
     def query(
         self, query: str, metadata_filter: Optional[dict] = {}, top_k: Optional[int] = 5
     ):
         try:
-            pinecone_results = self.pinecone_db.query(query, metadata_filter, top_k)
-            return pinecone_results
+            results = self.vector_db.query(query, metadata_filter, top_k)
+            return results
+        except ExecutorSaturatedError:
+            raise
         except Exception as e:
             LOG.error(f"Error querying database: {e}, query: {query}")
             return
+
+    async def aquery(
+        self, query: str, metadata_filter: Optional[dict] = {}, top_k: Optional[int] = 5
+    ):
+        try:
+            results = await self.vector_db.aquery(query, metadata_filter, top_k)
+            return results
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database: {e}, query: {query}")
+            return
+
+    def batch_query(
+        self,
+        queries: List[str],
+        metadata_filters: List[dict],
+        top_k: Optional[int] = 5,
+    ):
+        try:
+            return self.vector_db.batch_query(queries, metadata_filters, top_k)
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database for {len(queries)} queries: {e}")
+            return [None for _ in queries]
+
+    async def abatch_query(
+        self,
+        queries: List[str],
+        metadata_filters: List[dict],
+        top_k: Optional[int] = 5,
+    ):
+        try:
+            return await self.vector_db.abatch_query(queries, metadata_filters, top_k)
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database for {len(queries)} queries: {e}")
+            return [None for _ in queries]
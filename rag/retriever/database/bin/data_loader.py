@@ -3,12 +3,18 @@ import json
 import logging
 import os
 from argparse import ArgumentParser
+from typing import Iterator
 from typing import List
 
-from RAG.Retriever.database.bin.models import EmbeddingDocument
-from RAG.Retriever.database.DatabaseController import DatabaseController as dbc
+from rag.prompt_specialists.specialists import SpecialistPrompts
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.DatabaseController import DatabaseController as dbc
+from rag.retriever.database.models.ArticleIndex import ARTICLE_INDEX_PATH
+from rag.retriever.database.models.ArticleIndex import ArticleIndex
+from rag.retriever.database.models.BM25Index import BM25_INDEX_PATH
+from rag.retriever.database.models.BM25Index import BM25Index
 
-database_controller = dbc()
+specialist = SpecialistPrompts()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,7 +44,7 @@ def hash_id(text: str) -> str:
     return hashlib.md5(text.encode()).hexdigest()
 
 
-def load_data(data_path):
+def iter_documents(data_path) -> Iterator[EmbeddingDocument]:
     LOG.info(f"Loading data from {data_path}")
     for path in os.listdir(data_path):
         temp_path = os.path.join(data_path, path)
@@ -57,6 +63,10 @@ def load_data(data_path):
                     "date_of_fetch": data.get("date_of_fetch", "Unknown"),
                     "theme": data.get("theme", "Unknown"),
                 }
+                legal_code = specialist.get_legal_code(
+                    f"{base_metadata['theme']} {base_metadata['law_name']}"
+                )
+                base_metadata["legal_code"] = legal_code.name if legal_code else ""
 
                 sections = data.get("sections", {})
                 for section_key, section in sections.items():
@@ -78,16 +88,47 @@ def load_data(data_path):
 
                     document = EmbeddingDocument(doc_id=doc_id, metadata=metadata)
                     LOG.info(f"Processed document ID: {doc_id}, Title: {title}")
-                    database_controller.insert_into_databases(document)
+                    yield document
                 LOG.info(f"Processed all documents in file: {json_file_name}")
 
 
+def load_data(data_path):
+    database_controller = dbc()
+    database_controller.insert_many_into_databases(list(iter_documents(data_path)))
+
+
+def build_bm25_index(data_path, index_path=BM25_INDEX_PATH) -> BM25Index:
+    return BM25Index.build(iter_documents(data_path), index_path)
+
+
+def build_article_index(data_path, index_path=ARTICLE_INDEX_PATH) -> ArticleIndex:
+    return ArticleIndex.build(iter_documents(data_path), index_path)
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("--data_path", type=str, default="data")
+    parser.add_argument(
+        "--bm25_index", action="store_true", help="also build the BM25 index"
+    )
+    parser.add_argument(
+        "--article_index",
+        action="store_true",
+        help="also build the index of articles by legal code and number",
+    )
+    parser.add_argument(
+        "--skip_database",
+        action="store_true",
+        help="do not insert the documents into the vector database",
+    )
     args = parser.parse_args()
 
-    load_data(args.data_path)
+    if not args.skip_database:
+        load_data(args.data_path)
+    if args.bm25_index:
+        build_bm25_index(args.data_path)
+    if args.article_index:
+        build_article_index(args.data_path)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
-import asyncio
+import logging
+import os
+import shutil
 from collections import Counter
 from typing import Dict
 from typing import List
@@ -7,10 +9,128 @@ from typing import Optional
 import torch
 from langchain_core.embeddings.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
+from rag.utils.embedding_cache import embedding_cache
+from rag.utils.executors import run_in_executor
+from rag.utils.registry import registry
+from rag.utils.registry import WARM_UP_TEXT
+from rag.utils.tracing import tracer
 from sentence_transformers import SentenceTransformer
 from transformers import AutoModelForMaskedLM
+from transformers import AutoModelForSequenceClassification
 from transformers import AutoTokenizer
 
+LOG = logging.getLogger("MODELS")
+
+# "tokens" or "splade", see SparseEmbeddingModel
+SPARSE_ENCODING = os.getenv("RAG_SPARSE_ENCODING", "tokens")
+SPLADE_QUERY_TOP_N = int(os.getenv("RAG_SPLADE_QUERY_TOP_N", 64))
+SPLADE_DOCUMENT_TOP_N = int(os.getenv("RAG_SPLADE_DOCUMENT_TOP_N", 256))
+
+# "torch", "int8" (dynamic quantization of the linear layers) or "onnx" (int8 ONNX
+# Runtime, falling back to "int8" when it is not installed) for the query path
+# embedding models
+EMBEDDING_BACKEND = os.getenv("RAG_EMBEDDING_BACKEND", "torch")
+# Threads of each ONNX Runtime session, 0 for as many as torch uses
+EMBEDDING_THREADS = int(os.getenv("RAG_EMBEDDING_THREADS", 0))
+# Instruction set the ONNX weights are quantized for: avx2, avx512, avx512_vnni or
+# arm64
+ONNX_QUANTIZATION = os.getenv("RAG_ONNX_QUANTIZATION", "avx512_vnni")
+ONNX_PATH = os.getenv("RAG_ONNX_PATH", ".cache/onnx")
+EMBEDDING_BACKENDS = ("torch", "int8", "onnx")
+
+
+def quantize_linear(model: torch.nn.Module) -> torch.nn.Module:
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def onnx_session_options():
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = EMBEDDING_THREADS or torch.get_num_threads()
+    options.inter_op_num_threads = 1
+    return options
+
+
+def load_onnx_sentence_transformer(model_name: str, cache_dir: str):
+    """
+    Sentence transformer running an int8 ONNX export of the model, exported and
+    quantized on first use and kept under `ONNX_PATH`.
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    path = os.path.join(ONNX_PATH, model_name)
+    file_name = f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx"
+    if not os.path.exists(os.path.join(path, file_name)):
+        LOG.info(f"Exporting {model_name} to ONNX in {path}")
+        model = SentenceTransformer(model_name, cache_folder=cache_dir, backend="onnx")
+        model.save(path)
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANTIZATION, path)
+    return SentenceTransformer(
+        path,
+        backend="onnx",
+        model_kwargs={
+            "file_name": file_name,
+            "session_options": onnx_session_options(),
+        },
+    )
+
+
+def load_onnx_model(model_class, model_name: str, cache_dir: str):
+    """
+    `optimum` ONNX Runtime model of `model_class` (e.g. ORTModelForMaskedLM) running
+    an int8 export of the model, exported and quantized on first use and kept under
+    `ONNX_PATH`, so later loads, in any worker, only read the quantized file.
+    """
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    path = os.path.join(ONNX_PATH, model_name)
+    file_suffix = f"qint8_{ONNX_QUANTIZATION}"
+    quantized_path = os.path.join(path, f"model_{file_suffix}.onnx")
+    if not os.path.exists(quantized_path):
+        LOG.info(f"Exporting {model_name} to ONNX in {path}")
+        # Exported next to the final directory and renamed into place, so a worker
+        # exporting at the same time never loads a partial export
+        export_path = f"{path}.{os.getpid()}.tmp"
+        model = model_class.from_pretrained(
+            model_name, export=True, cache_dir=cache_dir
+        )
+        model.save_pretrained(export_path)
+        ORTQuantizer.from_pretrained(model).quantize(
+            save_dir=export_path,
+            quantization_config=getattr(AutoQuantizationConfig, ONNX_QUANTIZATION)(
+                is_static=False, per_channel=False
+            ),
+            file_suffix=file_suffix,
+        )
+        try:
+            os.rename(export_path, path)
+        except OSError:
+            if not os.path.exists(quantized_path):
+                raise
+            LOG.info(f"{model_name} was exported by another process")
+            shutil.rmtree(export_path, ignore_errors=True)
+    return model_class.from_pretrained(
+        path,
+        file_name=f"model_{file_suffix}.onnx",
+        session_options=onnx_session_options(),
+    )
+
+
+def load_onnx_masked_lm(model_name: str, cache_dir: str):
+    from optimum.onnxruntime import ORTModelForMaskedLM
+
+    return load_onnx_model(ORTModelForMaskedLM, model_name, cache_dir)
+
+
+def load_onnx_sequence_classifier(model_name: str, cache_dir: str):
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+
+    return load_onnx_model(ORTModelForSequenceClassification, model_name, cache_dir)
+
 
 class EmbeddingModel(Embeddings):
     def __init__(
@@ -23,13 +143,23 @@ class EmbeddingModel(Embeddings):
         self.model_name = model_name
         self.normalize_embeddings = normalize_embeddings
         self.show_progress = show_progress
-        self.embedding_model = HuggingFaceEmbeddings(
-            cache_folder=cache_dir,
-            model_name=model_name,
-            encode_kwargs={"normalize_embeddings": normalize_embeddings},
-            show_progress=show_progress,
+        # Not used on the query path, so it is only loaded if something embeds with it
+        self.registry_name = f"huggingface_embeddings:{model_name}"
+        registry.register(
+            self.registry_name,
+            lambda: HuggingFaceEmbeddings(
+                cache_folder=cache_dir,
+                model_name=model_name,
+                encode_kwargs={"normalize_embeddings": normalize_embeddings},
+                show_progress=show_progress,
+            ),
+            preload=False,
         )
 
+    @property
+    def embedding_model(self) -> HuggingFaceEmbeddings:
+        return registry.get(self.registry_name)
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         return [self.embedding_model.embed_query(text) for text in texts]
 
@@ -37,44 +167,88 @@ class EmbeddingModel(Embeddings):
         return self.embedding_model.embed_query(text)
 
     async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_documents, texts
-        )
+        return await run_in_executor(self.embed_documents, texts)
 
     async def aembed_query(self, text: str) -> List[float]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_query, text
-        )
+        return await run_in_executor(self.embed_query, text)
 
 
 class DenseEmbeddingModel(Embeddings):
+    """
+    Sentence embeddings, on the `backend` in `EMBEDDING_BACKENDS`. Texts are
+    encoded in batches of similar length, so each batch is only padded to the
+    longest text in it.
+    """
+
     def __init__(
         self,
         model_name: Optional[str] = "rufimelo/Legal-BERTimbau-sts-large-ma-v3",
+        backend: Optional[str] = EMBEDDING_BACKEND,
         cache_dir: Optional[str] = ".cache",
     ):
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {backend}")
         self.model_name = model_name
-        self.embedding_model = SentenceTransformer(model_name, cache_folder=cache_dir)
+        self.backend = backend
+        self.cache_dir = cache_dir
+        # Each backend has its own copy of the model and of the cached embeddings
+        self.registry_name = (
+            f"sentence_transformer:{model_name}"
+            if backend == "torch"
+            else f"sentence_transformer:{backend}:{model_name}"
+        )
+        registry.register(
+            self.registry_name,
+            self._load,
+            warm_up=lambda model: model.encode(WARM_UP_TEXT, show_progress_bar=False),
+            fork_safe=backend != "onnx",
+        )
+
+    def _load(self) -> SentenceTransformer:
+        if self.backend == "onnx":
+            try:
+                return load_onnx_sentence_transformer(self.model_name, self.cache_dir)
+            except ImportError:
+                LOG.warning("optimum[onnxruntime] is not installed, using int8 torch")
+
+        model = SentenceTransformer(self.model_name, cache_folder=self.cache_dir)
+        model.eval()
+        if self.backend in ("int8", "onnx"):
+            model = quantize_linear(model)
+        return model
+
+    @property
+    def embedding_model(self) -> SentenceTransformer:
+        return registry.get(self.registry_name)
+
+    @property
+    def embedding_dim(self) -> int:
+        return self.embedding_model.get_sentence_embedding_dimension()
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return self.embedding_model.encode(
-            texts, convert_to_tensor=True, show_progress_bar=False
-        ).tolist()
+        return embedding_cache.get_or_compute_many(
+            self.registry_name, texts, self._encode
+        )
 
     def embed_query(self, text: str) -> List[float]:
-        return self.embedding_model.encode(
-            text, convert_to_tensor=True, show_progress_bar=False
-        ).tolist()
+        return embedding_cache.get_or_compute(
+            self.registry_name, text, lambda text: self._encode([text])[0]
+        )
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        with tracer.span("embedding.dense", batch_size=len(texts)):
+            return self.embedding_model.encode(
+                texts, convert_to_tensor=True, show_progress_bar=False
+            ).tolist()
 
     async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_documents, texts
-        )
+        return await run_in_executor(self.embed_documents, texts)
 
     async def aembed_query(self, text: str) -> List[float]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_query, text
-        )
+        cached = embedding_cache.peek(self.registry_name, text)
+        if cached is not None:
+            return cached
+        return await run_in_executor(self.embed_query, text)
 
 
 class RerankingModel(Embeddings):
@@ -84,7 +258,16 @@ class RerankingModel(Embeddings):
         cache_dir: Optional[str] = ".cache",
     ):
         self.model_name = model_name
-        self.embedding_model = SentenceTransformer(model_name, cache_folder=cache_dir)
+        self.registry_name = f"sentence_transformer:{model_name}"
+        registry.register(
+            self.registry_name,
+            lambda: SentenceTransformer(model_name, cache_folder=cache_dir),
+            preload=False,
+        )
+
+    @property
+    def embedding_model(self) -> SentenceTransformer:
+        return registry.get(self.registry_name)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         return self.embedding_model.encode(
@@ -97,58 +280,205 @@ class RerankingModel(Embeddings):
         ).tolist()
 
     async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_documents, texts
-        )
+        return await run_in_executor(self.embed_documents, texts)
 
     async def aembed_query(self, text: str) -> List[float]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_query, text
-        )
+        return await run_in_executor(self.embed_query, text)
 
 
 class SparseEmbeddingModel(Embeddings):
+    """
+    Sparse vectors over the SPLADE vocabulary, as token id to weight.
+
+    With the "tokens" encoding the weights are the counts of the text's tokens, so
+    only the tokenizer runs. With "splade" the query (or, for documents, the
+    document) model runs and each vocabulary entry is weighted by its max-pooled
+    log(1 + ReLU(logit)) over the text, keeping the `top_n` largest weights, on
+    the `backend` in `EMBEDDING_BACKENDS`. The database must be built with the
+    encoding the queries use.
+    """
+
     def __init__(
         self,
         query_model: Optional[str] = "naver/efficient-splade-V-large-query",
+        document_model: Optional[str] = "naver/efficient-splade-V-large-doc",
+        encoding: Optional[str] = SPARSE_ENCODING,
+        backend: Optional[str] = EMBEDDING_BACKEND,
+        query_top_n: Optional[int] = SPLADE_QUERY_TOP_N,
+        document_top_n: Optional[int] = SPLADE_DOCUMENT_TOP_N,
+        batch_size: Optional[int] = 32,
+        max_length: Optional[int] = 512,
         cache_dir: Optional[str] = ".cache",
     ):
-        # self.tokenizer_docs = AutoTokenizer.from_pretrained(docs_model, cache_dir=cache_dir)
-        # self.model_docs = AutoModelForMaskedLM.from_pretrained(docs_model, cache_dir=cache_dir)
-
-        self.tokenizer_query = AutoTokenizer.from_pretrained(
-            query_model, cache_dir=cache_dir
+        if encoding not in ("tokens", "splade"):
+            raise ValueError(f"Unknown sparse encoding: {encoding}")
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        self.encoding = encoding
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.query_top_n = query_top_n
+        self.document_top_n = document_top_n
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        self.tokenizer_query_name = f"tokenizer:{query_model}"
+        self.tokenizer_document_name = f"tokenizer:{document_model}"
+        model_prefix = "masked_lm" if backend == "torch" else f"masked_lm:{backend}"
+        self.model_query_name = f"{model_prefix}:{query_model}"
+        self.model_document_name = f"{model_prefix}:{document_model}"
+        registry.register(
+            self.tokenizer_query_name,
+            lambda: AutoTokenizer.from_pretrained(query_model, cache_dir=cache_dir),
+        )
+        registry.register(
+            self.model_query_name,
+            lambda: self._load_masked_lm(query_model),
+            warm_up=lambda model: self._splade_encode(
+                [WARM_UP_TEXT], self.tokenizer_query, model, self.query_top_n
+            ),
+            preload=encoding == "splade",
+            fork_safe=backend != "onnx",
+        )
+        # Documents are only encoded when ingesting
+        registry.register(
+            self.tokenizer_document_name,
+            lambda: AutoTokenizer.from_pretrained(document_model, cache_dir=cache_dir),
+            preload=False,
         )
-        self.model_query = AutoModelForMaskedLM.from_pretrained(
-            query_model, cache_dir=cache_dir
+        registry.register(
+            self.model_document_name,
+            lambda: self._load_masked_lm(document_model),
+            preload=False,
+            fork_safe=backend != "onnx",
+        )
+
+        if encoding == "tokens":
+            # Queries and documents share the tokenizer, and so the cached vectors
+            self.query_cache_name = f"sparse:tokens:{query_model}"
+            self.document_cache_name = self.query_cache_name
+        else:
+            self.query_cache_name = f"sparse:splade:{query_model}:{query_top_n}"
+            self.document_cache_name = (
+                f"sparse:splade:{document_model}:{document_top_n}"
+            )
+            if backend != "torch":
+                self.query_cache_name += f":{backend}"
+                self.document_cache_name += f":{backend}"
+
+    def _load_masked_lm(self, model_name: str):
+        if self.backend == "onnx":
+            try:
+                return load_onnx_masked_lm(model_name, self.cache_dir)
+            except ImportError:
+                LOG.warning("optimum[onnxruntime] is not installed, using int8 torch")
+
+        model = AutoModelForMaskedLM.from_pretrained(
+            model_name, cache_dir=self.cache_dir
         )
+        model.eval()
+        if self.backend in ("int8", "onnx"):
+            model = quantize_linear(model)
+        return model
+
+    @property
+    def tokenizer_query(self):
+        return registry.get(self.tokenizer_query_name)
+
+    @property
+    def model_query(self):
+        return registry.get(self.model_query_name)
+
+    @property
+    def tokenizer_document(self):
+        return registry.get(self.tokenizer_document_name)
+
+    @property
+    def model_document(self):
+        return registry.get(self.model_document_name)
 
     def embed_documents(self, texts: List[str]) -> List[Dict[int, float]]:
-        return [
-            self._sparse_encode(text, self.tokenizer_docs, self.model_docs)
-            for text in texts
-        ]
+        return embedding_cache.get_or_compute_many(
+            self.document_cache_name, texts, self._encode_documents
+        )
 
     def embed_query(self, text: str) -> Dict[int, float]:
-        return self._sparse_encode(text, self.tokenizer_query, self.model_query)
+        return embedding_cache.get_or_compute(
+            self.query_cache_name, text, lambda text: self._encode_queries([text])[0]
+        )
+
+    def embed_queries(self, texts: List[str]) -> List[Dict[int, float]]:
+        return embedding_cache.get_or_compute_many(
+            self.query_cache_name, texts, self._encode_queries
+        )
 
-    def _sparse_encode(self, text: str, tokenizer, model) -> Dict[int, float]:
-        tokenized_text = tokenizer(text, return_tensors="pt")
-        with torch.no_grad():
-            output = model(**tokenized_text)
-        token_ids = tokenized_text["input_ids"].squeeze().tolist()
-        sparse_vec = dict(Counter(token_ids))
-        return sparse_vec
+    def _encode_queries(self, texts: List[str]) -> List[Dict[int, float]]:
+        with tracer.span("embedding.sparse", batch_size=len(texts)):
+            if self.encoding == "tokens":
+                return self._token_counts(texts, self.tokenizer_query)
+            return self._splade_encode(
+                texts, self.tokenizer_query, self.model_query, self.query_top_n
+            )
+
+    def _encode_documents(self, texts: List[str]) -> List[Dict[int, float]]:
+        with tracer.span("embedding.sparse", batch_size=len(texts)):
+            if self.encoding == "tokens":
+                return self._token_counts(texts, self.tokenizer_query)
+            return self._splade_encode(
+                texts,
+                self.tokenizer_document,
+                self.model_document,
+                self.document_top_n,
+            )
+
+    def _token_counts(self, texts: List[str], tokenizer) -> List[Dict[int, float]]:
+        # Special tokens are counted too, as in the vectors already indexed
+        return [dict(Counter(token_ids)) for token_ids in tokenizer(texts)["input_ids"]]
+
+    def _splade_encode(
+        self, texts: List[str], tokenizer, model, top_n: int
+    ) -> List[Dict[int, float]]:
+        sparse_vecs = [None] * len(texts)
+        # Texts of similar length are batched together to pad as little as possible
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            tokenized_texts = tokenizer(
+                [texts[i] for i in batch],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="pt",
+            )
+            with torch.no_grad():
+                logits = model(**tokenized_texts).logits
+            # Padding is masked out so each vector matches its unbatched encoding
+            weights = torch.log1p(torch.relu(logits)) * tokenized_texts[
+                "attention_mask"
+            ].unsqueeze(-1)
+            weights = weights.max(dim=1).values
+            values, indices = weights.topk(min(top_n, weights.shape[1]), dim=1)
+            for i, row_indices, row_values in zip(
+                batch, indices.tolist(), values.tolist()
+            ):
+                sparse_vecs[i] = {
+                    index: value
+                    for index, value in zip(row_indices, row_values)
+                    if value > 0
+                }
+        return sparse_vecs
 
     async def aembed_documents(self, texts: List[str]) -> List[Dict[int, float]]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_documents, texts
-        )
+        return await run_in_executor(self.embed_documents, texts)
 
     async def aembed_query(self, text: str) -> Dict[int, float]:
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_query, text
-        )
+        cached = embedding_cache.peek(self.query_cache_name, text)
+        if cached is not None:
+            return cached
+        return await run_in_executor(self.embed_query, text)
+
+    async def aembed_queries(self, texts: List[str]) -> List[Dict[int, float]]:
+        return await run_in_executor(self.embed_queries, texts)
 
 
 from rank_bm25 import BM25Okapi
@@ -167,7 +497,17 @@ STOP_WORDS = set(stopwords.words("portuguese"))
 class BM250RerankingModel(Embeddings):
     def __init__(self, language: Optional[str] = "portuguese"):
         self.language = language
-        self.tokenizer = AutoTokenizer.from_pretrained("bert-base-multilingual-cased")
+        # Reranking splits on whitespace, so the tokenizer is only loaded on demand
+        self.tokenizer_name = "tokenizer:bert-base-multilingual-cased"
+        registry.register(
+            self.tokenizer_name,
+            lambda: AutoTokenizer.from_pretrained("bert-base-multilingual-cased"),
+            preload=False,
+        )
+
+    @property
+    def tokenizer(self):
+        return registry.get(self.tokenizer_name)
 
     def preprocess_text(self, text: str) -> List[str]:
         return [word.lower() for word in text.split() if word.lower() not in STOP_WORDS]
@@ -180,12 +520,16 @@ class BM250RerankingModel(Embeddings):
     def embed_query(self, text: str) -> List[float]:
         return self.preprocess_text(text)
 
-    def bm25_rerank(self, query: str, documents: List[str]) -> List[Dict[str, float]]:
-        tokenized_documents = self.embed_documents(documents)
-        tokenized_query = self.embed_query(query)
+    def bm25_scores(self, query: str, documents: List[str]) -> List[float]:
+        """
+        BM25 score of each document, in the order of `documents`, with the IDF of
+        the documents themselves.
+        """
+        bm25 = BM25Okapi(self.embed_documents(documents))
+        return bm25.get_scores(self.embed_query(query)).tolist()
 
-        bm25 = BM25Okapi(tokenized_documents)
-        scores = bm25.get_scores(tokenized_query)
+    def bm25_rerank(self, query: str, documents: List[str]) -> List[Dict[str, float]]:
+        scores = self.bm25_scores(query, documents)
 
         # Rerank documents based on BM25 scores
         reranked_results = [
@@ -204,17 +548,99 @@ class BM250RerankingModel(Embeddings):
         """
         Asynchronously embed documents using BM25.
         """
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_documents, texts
-        )
+        return await run_in_executor(self.embed_documents, texts)
 
     async def aembed_query(self, text: str) -> List[float]:
         """
         Asynchronously embed a query using BM25.
         """
-        return await asyncio.get_event_loop().run_in_executor(
-            None, self.embed_query, text
+        return await run_in_executor(self.embed_query, text)
+
+
+class CrossEncoderRerankingModel:
+    """
+    Scores query-document pairs with a cross-encoder on CPU, in batches of pairs of
+    similar length. `backend` is "torch", "int8" (dynamic quantization of the linear
+    layers) or "onnx" (an int8 ONNX Runtime export through `optimum`, falling back
+    to "int8" when it is not installed). Scores are the model's relevance
+    probability in 0-100, the same scale as the LLM reranker's.
+    """
+
+    def __init__(
+        self,
+        model_name: Optional[str] = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1",
+        backend: Optional[str] = "int8",
+        batch_size: Optional[int] = 32,
+        max_length: Optional[int] = 512,
+        cache_dir: Optional[str] = ".cache",
+        preload: Optional[bool] = False,
+    ):
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cache_dir = cache_dir
+        self.registry_name = f"cross_encoder:{backend}:{model_name}"
+        registry.register(
+            self.registry_name,
+            self._load,
+            warm_up=lambda model: self._score(model, WARM_UP_TEXT, [WARM_UP_TEXT]),
+            preload=preload,
+        )
+
+    def _load(self) -> tuple:
+        tokenizer = AutoTokenizer.from_pretrained(
+            self.model_name, cache_dir=self.cache_dir
+        )
+        if self.backend == "onnx":
+            try:
+                return tokenizer, load_onnx_sequence_classifier(
+                    self.model_name, self.cache_dir
+                )
+            except ImportError:
+                LOG.warning("optimum[onnxruntime] is not installed, using int8 torch")
+
+        model = AutoModelForSequenceClassification.from_pretrained(
+            self.model_name, cache_dir=self.cache_dir
         )
+        model.eval()
+        if self.backend in ("int8", "onnx"):
+            model = quantize_linear(model)
+        return tokenizer, model
+
+    def _score(self, model, query: str, documents: List[str]) -> List[float]:
+        tokenizer, model = model
+        # Similar lengths are batched together so little compute goes to padding
+        order = sorted(range(len(documents)), key=lambda i: len(documents[i]))
+        scores = [0.0] * len(documents)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            inputs = tokenizer(
+                [query] * len(batch),
+                [documents[i] for i in batch],
+                padding=True,
+                truncation="only_second",
+                max_length=self.max_length,
+                return_tensors="pt",
+            )
+            with torch.no_grad():
+                logits = model(**inputs).logits
+            if logits.shape[-1] == 1:
+                probabilities = torch.sigmoid(logits[:, 0])
+            else:
+                probabilities = torch.softmax(logits, dim=-1)[:, -1]
+            for i, probability in zip(batch, probabilities.tolist()):
+                scores[i] = probability * 100
+        return scores
+
+    def rerank(self, query: str, documents: List[str]) -> List[float]:
+        if not documents:
+            return []
+        with tracer.span("cross_encoder", pairs=len(documents)):
+            return self._score(registry.get(self.registry_name), query, documents)
+
+    async def arerank(self, query: str, documents: List[str]) -> List[float]:
+        return await run_in_executor(self.rerank, query, documents)
 
 
 # bm25_model = BM250RerankingModel()
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import re
+import unicodedata
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.models.DocumentStore import DocumentStore
+from rag.utils.tracing import tracer
+
+LOG = logging.getLogger("ARTICLE_INDEX")
+
+ARTICLE_INDEX_PATH = os.getenv("RAG_ARTICLE_INDEX_PATH", ".cache/article_index")
+
+# "artigo 251.º", "art.º 17.º-A", "art 5", "artigos 13.º e 14.º", ... A citation
+# keyword is followed by a number, and a list of them continues only with numbers
+# that have their own ordinal marker, or after a plural keyword, so "artigo 5 e 2
+# filhos" only cites article 5.
+CITATION_REGEX = re.compile(r"\bart(?:igo)?(s)?\b\.?\s*[º°]?\s*", re.IGNORECASE)
+NUMBER_REGEX = re.compile(r"(\d+)(\s*\.?\s*[º°])?(?:-([a-z]{1,2})\b)?", re.IGNORECASE)
+SEPARATOR_REGEX = re.compile(r"\s*(?:,|\be\b)\s*", re.IGNORECASE)
+MIN_ALIAS_LENGTH = 4
+
+
+def fold(text: str) -> str:
+    """
+    Lowercase without accents and with single spaces, to match code names however
+    they are typed.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def article_numbers(text: str) -> List[str]:
+    """
+    The article numbers cited in the text, as "251" or "17-a".
+    """
+    numbers = []
+    for citation in CITATION_REGEX.finditer(text):
+        plural = bool(citation.group(1))
+        match = NUMBER_REGEX.match(text, citation.end())
+        while match:
+            digits, _, suffix = match.groups()
+            number = str(int(digits)) + (f"-{suffix.lower()}" if suffix else "")
+            if number not in numbers:
+                numbers.append(number)
+            separator = SEPARATOR_REGEX.match(text, match.end())
+            if separator is None:
+                break
+            match = NUMBER_REGEX.match(text, separator.end())
+            if match and not (plural or match.group(2)):
+                break
+    return numbers
+
+
+def document_code(metadata: dict) -> str:
+    # Laws without a known legal code are told apart by their theme
+    return metadata.get("legal_code") or fold(metadata.get("theme", ""))
+
+
+def code_aliases(metadata: dict) -> List[str]:
+    aliases = []
+    for name in (metadata.get("theme", ""), metadata.get("document_name", "")):
+        # "Novo Regime do Arrendamento Urbano - NRAU" is cited by either part
+        for alias in [name, *name.split(" - ")]:
+            alias = fold(alias)
+            if len(alias) >= MIN_ALIAS_LENGTH and alias not in aliases:
+                aliases.append(alias)
+    return aliases
+
+
+class ArticleIndex:
+    """
+    Exact lookup of an article by its legal code and number, for questions that
+    cite the article they are about ("o que diz o artigo 251.º do Código do
+    Trabalho?"), which can then skip retrieval and reranking.
+
+    Articles are keyed by the number in their title and by their document's legal
+    code, or its theme when it has none. The names of the documents are kept as
+    aliases of their code, and matched against the question with a single regex
+    alternation, longest first.
+
+    Only the ids of the articles are stored with the index; the metadata of the
+    articles `find` returns is read from `document_store`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = ARTICLE_INDEX_PATH,
+        document_store: Optional[DocumentStore] = None,
+    ):
+        self.path = path
+        self.document_store = document_store
+        self.articles: Dict[str, Dict[str, str]] = {}
+        self.aliases: Dict[str, str] = {}
+        self.alias_regex: Optional[re.Pattern] = None
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self.articles)
+
+    @classmethod
+    def build(
+        cls,
+        documents: Iterable[EmbeddingDocument],
+        path: Optional[str] = ARTICLE_INDEX_PATH,
+        document_store: Optional[DocumentStore] = None,
+    ) -> "ArticleIndex":
+        articles: Dict[str, Dict[str, str]] = {}
+        in_diploma = {}
+        aliases = {}
+        for document in documents:
+            numbers = article_numbers(document.metadata.get("title", ""))
+            if not numbers:
+                continue
+            code = document_code(document.metadata)
+            for alias in code_aliases(document.metadata):
+                aliases.setdefault(alias, code)
+
+            # The articles of the law that approves a code (its "Diploma") share
+            # their numbers with the code's own articles, which are the ones cited
+            key = (code, numbers[0])
+            diploma = document.metadata.get("book_title") == "Diploma"
+            if key in in_diploma and (diploma or not in_diploma[key]):
+                continue
+            in_diploma[key] = diploma
+            articles.setdefault(code, {})[numbers[0]] = document.id
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({"articles": articles, "aliases": aliases}, f, ensure_ascii=False)
+        LOG.info(
+            f"Built article index with {len(in_diploma)} articles of "
+            f"{len(articles)} codes"
+        )
+
+        index = cls(path, document_store)
+        index.load()
+        return index
+
+    def load(self) -> bool:
+        index_path = os.path.join(self.path, "index.json")
+        if not os.path.exists(index_path):
+            LOG.info(f"No article index found at {self.path}")
+            return False
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if any(
+            not isinstance(doc_id, str)
+            for articles in data["articles"].values()
+            for doc_id in articles.values()
+        ):
+            LOG.warning(f"The article index at {self.path} is outdated, rebuild it")
+            return False
+        self.articles = data["articles"]
+        self.aliases = data["aliases"]
+        self.alias_regex = (
+            re.compile(
+                r"\b("
+                + "|".join(
+                    re.escape(alias)
+                    for alias in sorted(self.aliases, key=len, reverse=True)
+                )
+                + r")\b"
+            )
+            if self.aliases
+            else None
+        )
+        LOG.info(
+            f"Loaded article index with "
+            f"{sum(len(articles) for articles in self.articles.values())} articles"
+        )
+        return True
+
+    def cited_code(self, question: str) -> Optional[str]:
+        if self.alias_regex is None:
+            return None
+        match = self.alias_regex.search(fold(question))
+        return self.aliases[match.group(1)] if match else None
+
+    def lookup(self, code: str, number: str) -> Optional[dict]:
+        """
+        The article as a vector database match (`id`, `score`, `metadata`), if it
+        is in the index and in the document store.
+        """
+        doc_id = self.articles.get(code, {}).get(number)
+        if doc_id is None:
+            return None
+        record = self.document_store.get(doc_id) if self.document_store else None
+        if record is None:
+            LOG.warning(f"Article {doc_id} not in the document store")
+            return None
+        metadata = {
+            field: value for field, value in record.items() if field != "chunk_spans"
+        }
+        return {"id": doc_id, "score": 1.0, "metadata": metadata}
+
+    def find(self, question: str, default_code: Optional[str] = None) -> List[dict]:
+        """
+        The articles the question cites, when it names their code (or
+        `default_code` is given) and all of them are in the index; otherwise none.
+        """
+        if not self.loaded:
+            return []
+        with tracer.span("article_lookup"):
+            numbers = article_numbers(question)
+            if not numbers:
+                return []
+            code = self.cited_code(question) or default_code
+            if code is None:
+                return []
+            matches = [self.lookup(code, number) for number in numbers]
+        if any(match is None for match in matches):
+            LOG.info(f"Cited articles {numbers} not all found in {code}")
+            return []
+        return matches
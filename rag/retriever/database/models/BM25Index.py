@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import re
+from collections import Counter
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+import numpy as np
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.bin.utils import STOP_WORDS
+from rag.retriever.database.models.DocumentStore import DocumentStore
+from rag.utils.tracing import tracer
+
+LOG = logging.getLogger("BM25_INDEX")
+
+BM25_INDEX_PATH = os.getenv("RAG_BM25_INDEX_PATH", ".cache/bm25_index")
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token
+        for token in TOKEN_REGEX.findall(text.lower())
+        if token not in STOP_WORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+
+class BM25Index:
+    """
+    Okapi BM25 over every section of the legislation, stored on disk as a CSR
+    inverted index and memory-mapped when loaded.
+
+    The index keeps, per term, the sorted ids of the documents containing it and
+    the term's precomputed BM25 impact on each of them, so a query only sums the
+    impacts of its terms' postings. The IDF and average document length are also
+    kept so texts outside the index can be scored with corpus-level statistics.
+
+    Only the ids of the documents and their legal codes are stored with the index;
+    the metadata of the documents `search` returns is read from `document_store`.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = BM25_INDEX_PATH,
+        document_store: Optional[DocumentStore] = None,
+    ):
+        self.path = path
+        self.document_store = document_store
+        self.k1 = 1.5
+        self.b = 0.75
+        self.avgdl = 0.0
+        self.vocabulary: Dict[str, int] = {}
+        self.doc_ids: List[str] = []
+        self.legal_codes: List[str] = []
+        self.doc_legal_codes: Optional[np.ndarray] = None
+        self.offsets: Optional[np.ndarray] = None
+        self.postings: Optional[np.ndarray] = None
+        self.impacts: Optional[np.ndarray] = None
+        self.idf: Optional[np.ndarray] = None
+        self.legal_code_masks: Dict[str, np.ndarray] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return self.offsets is not None
+
+    @classmethod
+    def build(
+        cls,
+        documents: Iterable[EmbeddingDocument],
+        path: Optional[str] = BM25_INDEX_PATH,
+        k1: float = 1.5,
+        b: float = 0.75,
+        document_store: Optional[DocumentStore] = None,
+    ) -> "BM25Index":
+        doc_ids = []
+        legal_codes = {}
+        doc_legal_codes = []
+        term_frequencies = []
+        for document in documents:
+            doc_ids.append(document.id)
+            legal_code = document.metadata.get("legal_code") or ""
+            doc_legal_codes.append(legal_codes.setdefault(legal_code, len(legal_codes)))
+            term_frequencies.append(
+                Counter(
+                    tokenize(
+                        f"{document.metadata.get('title', '')} "
+                        f"{document.metadata.get('epigrafe', '')} "
+                        f"{document.metadata.get('text', '')}"
+                    )
+                )
+            )
+
+        vocabulary = {}
+        postings_by_term: List[List[tuple]] = []
+        for doc, frequencies in enumerate(term_frequencies):
+            for term, frequency in frequencies.items():
+                if term not in vocabulary:
+                    vocabulary[term] = len(vocabulary)
+                    postings_by_term.append([])
+                postings_by_term[vocabulary[term]].append((doc, frequency))
+
+        doc_lengths = np.array(
+            [sum(frequencies.values()) for frequencies in term_frequencies],
+            dtype=np.float32,
+        )
+        n_docs = len(doc_ids)
+        avgdl = float(doc_lengths.mean()) if n_docs else 0.0
+        document_frequencies = np.array(
+            [len(postings) for postings in postings_by_term], dtype=np.float32
+        )
+        idf = np.log(
+            1 + (n_docs - document_frequencies + 0.5) / (document_frequencies + 0.5)
+        ).astype(np.float32)
+
+        offsets = np.zeros(len(postings_by_term) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings) for postings in postings_by_term])
+        postings = np.empty(offsets[-1], dtype=np.int32)
+        impacts = np.empty(offsets[-1], dtype=np.float32)
+        for term, term_postings in enumerate(postings_by_term):
+            docs, frequencies = zip(*term_postings)
+            docs = np.array(docs, dtype=np.int32)
+            frequencies = np.array(frequencies, dtype=np.float32)
+            norm = k1 * (1 - b + b * doc_lengths[docs] / avgdl)
+            postings[offsets[term] : offsets[term + 1]] = docs
+            impacts[offsets[term] : offsets[term + 1]] = (
+                idf[term] * frequencies * (k1 + 1) / (frequencies + norm)
+            )
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        np.save(os.path.join(path, "postings.npy"), postings)
+        np.save(os.path.join(path, "impacts.npy"), impacts)
+        np.save(os.path.join(path, "idf.npy"), idf)
+        np.save(
+            os.path.join(path, "legal_codes.npy"),
+            np.array(doc_legal_codes, dtype=np.int16),
+        )
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "k1": k1,
+                    "b": b,
+                    "avgdl": avgdl,
+                    "vocabulary": vocabulary,
+                    "doc_ids": doc_ids,
+                    "legal_codes": list(legal_codes),
+                },
+                f,
+                ensure_ascii=False,
+            )
+        LOG.info(
+            f"Built BM25 index with {n_docs} documents and {len(vocabulary)} terms"
+        )
+
+        index = cls(path, document_store)
+        index.load()
+        return index
+
+    def load(self) -> bool:
+        index_path = os.path.join(self.path, "index.json")
+        if not os.path.exists(index_path):
+            LOG.info(f"No BM25 index found at {self.path}")
+            return False
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if "legal_codes" not in data:
+            LOG.warning(f"The BM25 index at {self.path} is outdated, rebuild it")
+            return False
+        self.k1 = data["k1"]
+        self.b = data["b"]
+        self.avgdl = data["avgdl"]
+        self.vocabulary = data["vocabulary"]
+        self.doc_ids = data["doc_ids"]
+        self.legal_codes = data["legal_codes"]
+        self.doc_legal_codes = np.load(
+            os.path.join(self.path, "legal_codes.npy"), mmap_mode="r"
+        )
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+        self.postings = np.load(os.path.join(self.path, "postings.npy"), mmap_mode="r")
+        self.impacts = np.load(os.path.join(self.path, "impacts.npy"), mmap_mode="r")
+        self.idf = np.load(os.path.join(self.path, "idf.npy"), mmap_mode="r")
+        self.legal_code_masks = {}
+        LOG.info(f"Loaded BM25 index with {len(self.doc_ids)} documents")
+        if self.document_store is not None and self.document_store.loaded:
+            missing = sum(doc_id not in self.document_store for doc_id in self.doc_ids)
+            if missing:
+                LOG.warning(
+                    f"{missing} documents of the BM25 index are not in the document "
+                    "store and will not be returned, rebuild the index"
+                )
+        return True
+
+    def _query_terms(self, query: str) -> List[int]:
+        return [
+            self.vocabulary[token]
+            for token in tokenize(query)
+            if token in self.vocabulary
+        ]
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        for term in self._query_terms(query):
+            start, end = self.offsets[term], self.offsets[term + 1]
+            scores[self.postings[start:end]] += self.impacts[start:end]
+        return scores
+
+    def _legal_code_mask(self, legal_code: str) -> np.ndarray:
+        if legal_code not in self.legal_code_masks:
+            code = (
+                self.legal_codes.index(legal_code)
+                if legal_code in self.legal_codes
+                else -1
+            )
+            self.legal_code_masks[legal_code] = self.doc_legal_codes == code
+        return self.legal_code_masks[legal_code]
+
+    def _metadata(self, doc_id: str) -> Optional[dict]:
+        record = self.document_store.get(doc_id) if self.document_store else None
+        if record is None:
+            return None
+        return {
+            field: value for field, value in record.items() if field != "chunk_spans"
+        }
+
+    def search(
+        self, query: str, top_k: int = 5, legal_code: Optional[str] = None
+    ) -> List[dict]:
+        """
+        Return the `top_k` best matching documents in the same format as the vector
+        database matches (`id`, `score`, `metadata`). Documents missing from the
+        document store are left out.
+        """
+        top_k = min(top_k, len(self.doc_ids))
+        if not self.loaded or top_k <= 0:
+            return []
+        with tracer.span("bm25_index.search", top_k=top_k):
+            scores = self.scores(query)
+            if legal_code:
+                scores[~self._legal_code_mask(legal_code)] = 0
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+        matches = []
+        missing = 0
+        for doc in top:
+            if scores[doc] <= 0:
+                continue
+            metadata = self._metadata(self.doc_ids[doc])
+            if metadata is None:
+                missing += 1
+                continue
+            matches.append(
+                {
+                    "id": self.doc_ids[doc],
+                    "score": float(scores[doc]),
+                    "metadata": metadata,
+                }
+            )
+        if missing:
+            LOG.debug(f"Left out {missing} matches not in the document store")
+        return matches
+
+    def score_texts(self, query: str, texts: List[str]) -> List[float]:
+        """
+        Score arbitrary texts against the query with the index's IDF and average
+        document length, so few candidates are scored as if ranked in the corpus.
+        """
+        terms = Counter(tokenize(query))
+        scores = []
+        for text in texts:
+            frequencies = Counter(tokenize(text))
+            norm = self.k1 * (
+                1 - self.b + self.b * sum(frequencies.values()) / (self.avgdl or 1)
+            )
+            score = 0.0
+            for token in terms:
+                term = self.vocabulary.get(token)
+                frequency = frequencies.get(token, 0)
+                if term is None or not frequency:
+                    continue
+                score += (
+                    float(self.idf[term])
+                    * frequency
+                    * (self.k1 + 1)
+                    / (frequency + norm)
+                )
+            scores.append(score)
+        return scores
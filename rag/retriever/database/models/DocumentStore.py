@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import numpy as np
+
+LOG = logging.getLogger("DOCUMENT_STORE")
+
+DOCUMENT_STORE_PATH = os.getenv("RAG_DOCUMENT_STORE_PATH", ".database/documents")
+DOCUMENT_CACHE_SIZE = 256
+
+# Fields kept only in the document store, the rest are also stored with every chunk
+STORED_FIELDS = ("text", "updates", "previous_iterations")
+
+
+def compact_metadata(metadata: dict) -> dict:
+    return {
+        field: value for field, value in metadata.items() if field not in STORED_FIELDS
+    }
+
+
+def chunk_document_id(chunk_id: str) -> str:
+    # Chunk ids are the document id followed by the chunk number
+    return chunk_id.rsplit("_part", 1)[0]
+
+
+class DocumentStore:
+    """
+    The metadata of each document, including its bulky fields (article text,
+    updates and previous iterations), and the character span of each of its chunks,
+    stored once per document instead of with every chunk in the vector database.
+    Indexes that only keep document ids, such as the BM25 index, read their
+    documents from it.
+
+    Each document is a zlib-compressed JSON record, and the records are
+    concatenated in `documents.bin`, which is memory-mapped when loaded, with their
+    offsets in `offsets.npy`. Documents are added with `put` and written with
+    `save`, which rewrites the files; only the records that changed are compressed
+    again. The most recently read documents are kept decompressed.
+    """
+
+    def __init__(self, path: Optional[str] = DOCUMENT_STORE_PATH):
+        self.path = path
+        self.lock = Lock()
+        self.positions: Dict[str, int] = {}
+        self.offsets: Optional[np.ndarray] = None
+        self.records: Optional[np.ndarray] = None
+        self.pending: Dict[str, bytes] = {}
+        self.cache: OrderedDict = OrderedDict()
+
+    @property
+    def loaded(self) -> bool:
+        return self.offsets is not None
+
+    def load(self) -> bool:
+        index_path = os.path.join(self.path, "index.json")
+        if not os.path.exists(index_path):
+            LOG.info(f"No document store found at {self.path}")
+            return False
+        with open(index_path, "r", encoding="utf-8") as f:
+            ids = json.load(f)["ids"]
+        self.positions = {doc_id: position for position, doc_id in enumerate(ids)}
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+        records_path = os.path.join(self.path, "documents.bin")
+        # An empty file cannot be memory-mapped
+        self.records = (
+            np.memmap(records_path, dtype=np.uint8, mode="r")
+            if os.path.getsize(records_path)
+            else np.empty(0, dtype=np.uint8)
+        )
+        with self.lock:
+            self.cache.clear()
+        LOG.info(f"Loaded document store with {len(ids)} documents")
+        return True
+
+    def put(self, doc_id: str, metadata: dict, chunk_spans: List[List[int]]):
+        record = {**metadata, "chunk_spans": chunk_spans}
+        self.pending[doc_id] = zlib.compress(
+            json.dumps(record, ensure_ascii=False).encode()
+        )
+
+    def _record(self, position: int) -> bytes:
+        return self.records[self.offsets[position] : self.offsets[position + 1]]
+
+    def save(self):
+        if not self.pending:
+            return
+        ids = [doc_id for doc_id in self.positions if doc_id not in self.pending]
+        ids.extend(self.pending)
+        os.makedirs(self.path, exist_ok=True)
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        records_path = os.path.join(self.path, "documents.bin")
+        with open(f"{records_path}.tmp", "wb") as f:
+            for i, doc_id in enumerate(ids):
+                record = self.pending.get(doc_id)
+                if record is None:
+                    record = self._record(self.positions[doc_id]).tobytes()
+                f.write(record)
+                offsets[i + 1] = offsets[i] + len(record)
+        offsets_path = os.path.join(self.path, "offsets.npy")
+        with open(f"{offsets_path}.tmp", "wb") as f:
+            np.save(f, offsets)
+        os.replace(f"{records_path}.tmp", records_path)
+        os.replace(f"{offsets_path}.tmp", offsets_path)
+        # Written last, as its presence is what marks the store as saved
+        index_path = os.path.join(self.path, "index.json")
+        with open(f"{index_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"ids": ids}, f)
+        os.replace(f"{index_path}.tmp", index_path)
+        self.pending = {}
+        LOG.info(f"Document store with {len(ids)} documents saved to {self.path}")
+        self.load()
+
+    def get(self, doc_id: str) -> Optional[dict]:
+        with self.lock:
+            record = self.cache.get(doc_id)
+            if record is not None:
+                self.cache.move_to_end(doc_id)
+                return record
+        position = self.positions.get(doc_id)
+        if position is None:
+            return None
+        record = json.loads(zlib.decompress(self._record(position)))
+        with self.lock:
+            self.cache[doc_id] = record
+            if len(self.cache) > DOCUMENT_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return record
+
+    def hydrate(self, chunk_id: str, metadata: dict) -> dict:
+        """
+        The chunk's metadata with its document's stored fields added back, and the
+        character span of the chunk in the text. Metadata that already has the text,
+        as stored before the store existed, is returned as it is, as is the metadata
+        of a chunk whose document is not in the store.
+        """
+        if "text" in metadata:
+            return metadata
+        record = self.get(chunk_document_id(chunk_id))
+        if record is None:
+            LOG.debug(f"Document of chunk {chunk_id} not found in the document store")
+            return metadata
+        hydrated = {**metadata, **record}
+        chunk_spans = hydrated.pop("chunk_spans")
+        _, _, part = chunk_id.rpartition("_part")
+        if part.isdigit() and int(part) < len(chunk_spans):
+            hydrated["chunk_span"] = chunk_spans[int(part)]
+        return hydrated
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.positions
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
+import json
 import logging
 import os
-import time
+from threading import Lock
+from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
 
-import faiss
 import numpy as np
-from bin.models import EmbeddingDocument
-from dotenv import load_dotenv
-from Retriever.database.bin.utils import EmbeddingModel
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.models.DenseQuantizer import DenseQuantizer
+from rag.retriever.database.models.HybridDatabase import HybridDatabase
+from rag.utils.tracing import tracer
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,105 +26,587 @@ logging.basicConfig(
 )
 LOG = logging.getLogger("FAISS")
 
-DATABASE_PATH = ".database/FAISS"
+DATABASE_PATH = os.getenv("RAG_LOCAL_DATABASE_PATH", ".database/FAISS")
 DATABASE_NAME = "legislai"
 
+INSERT_BATCH_SIZE = 32
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 128
+HNSW_EF_SEARCH = 128
+# Chunks appended since the last rebuild, as a fraction of all chunks, above which
+# `upsert` rebuilds the database to group them by legal code again
+REBUILD_FRACTION = 0.1
+# Documents fetched from the first stage (the HNSW graph or the quantized vectors,
+# and the sparse index) per result before the hybrid scores of all of them are
+# computed exactly
+CANDIDATE_FACTOR = 10
+MIN_CANDIDATES = 100
+# "none" or "int8" first-stage dense vectors, optionally truncated to the first
+# dimensions (0 keeps them all). Binary codes lose too many of the exact results to
+# be served, see DenseQuantizer.
+SERVED_QUANTIZATIONS = ("none", "int8")
+DENSE_QUANTIZATION = os.getenv("RAG_DENSE_QUANTIZATION", "none")
+DENSE_SEARCH_DIMENSIONS = int(os.getenv("RAG_DENSE_SEARCH_DIMENSIONS", 0))
 
-class FAISSDatabase:
-    def __init__(self, force: bool = False):
-        LOG.info("Initializing FAISS Instance")
-        load_dotenv()
+FILTER_OPERATORS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+}
 
-        self.embeddings = EmbeddingModel()
-        self.db = self.init_database(database_name=DATABASE_NAME, force=force)
 
-        LOG.info(f"Number of embeddings in database: {self.get_embedding_count()}")
-        self.test_insert()
-
-    def test_insert(self):
-        LOG.info("Testing insert")
-        test_encoding = np.array(
-            self.embeddings.embed_query("test"), dtype="float32"
-        ).reshape(1, -1)
-        self.db.add(test_encoding)
-        init_time = time.time()
-        result = self.query("teste", top_k=1)
-        LOG.info(f"Query time: {time.time() - init_time} seconds")
-        for res, score in result:
-            LOG.info(f"Test insert result: {res}, score: {score}")
-        LOG.info(
-            f"Number of embeddings after test insert: {self.get_embedding_count()}"
+def matches_filter(metadata: dict, metadata_filter: dict) -> bool:
+    """
+    Evaluate a Pinecone metadata filter (`{"field": {"$eq": value}}`, `$and`, `$or`)
+    against the metadata of one document.
+    """
+    for field, condition in metadata_filter.items():
+        if field == "$and":
+            if not all(matches_filter(metadata, c) for c in condition):
+                return False
+        elif field == "$or":
+            if not any(matches_filter(metadata, c) for c in condition):
+                return False
+        else:
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            value = metadata.get(field)
+            for operator, operand in condition.items():
+                if not FILTER_OPERATORS[operator](value, operand):
+                    return False
+    return True
+
+
+class FAISSDatabase(HybridDatabase):
+    """
+    Vector database kept on local disk, a drop-in replacement for Pinecone.
+
+    Chunks are stored as in Pinecone (`{id}_part{i}` with the metadata from
+    `chunk_payload`). The dense vectors are a float32 matrix and the sparse vectors
+    an inverted index in CSR form (sorted term ids, offsets, postings and values),
+    all saved as .npy files and memory-mapped when loaded. Scores are Pinecone's
+    dotproduct scores on the `hybrid_scale`d vectors: the dense dot product plus
+    the sparse one.
+
+    With faiss installed an HNSW graph picks the dense candidates of unfiltered
+    queries, which are rescored exactly together with the best sparse matches.
+    Without it, or when a metadata filter narrows the documents, the dense scores
+    of every candidate are computed directly. Chunks are stored grouped by legal
+    code, so with partitions enabled a query filtered on a legal code only reads
+    that code's rows, and those of the chunks appended after them since the last
+    rebuild.
+
+    With `quantization` set to "int8" the first stage instead scans compact
+    codes of the dense vectors, saved next to them and memory-mapped when loaded,
+    and only the best candidates are rescored with the float32 vectors.
+    """
+
+    def __init__(
+        self,
+        database_name: str = DATABASE_NAME,
+        quantization: str = DENSE_QUANTIZATION,
+        search_dimensions: int = DENSE_SEARCH_DIMENSIONS,
+    ):
+        if quantization not in SERVED_QUANTIZATIONS:
+            raise ValueError(f"Unsupported dense quantization: {quantization}")
+        super().__init__()
+        self.path = os.path.join(DATABASE_PATH, database_name)
+        self.write_lock = Lock()
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        self.dense: Optional[np.ndarray] = None
+        self.sparse_terms: Optional[np.ndarray] = None
+        self.sparse_offsets: Optional[np.ndarray] = None
+        self.sparse_postings: Optional[np.ndarray] = None
+        self.sparse_values: Optional[np.ndarray] = None
+        self.partitions: Dict[str, List[int]] = {}
+        # Rows grouped by legal code, the ones after them were appended since
+        self.grouped_rows = 0
+        self.hnsw = None
+        self.candidate_factor = CANDIDATE_FACTOR
+        self.quantizer = (
+            DenseQuantizer(quantization, search_dimensions)
+            if quantization != "none"
+            else None
         )
+        self.filter_masks: Dict[str, np.ndarray] = {}
+        self.load()
+        LOG.info(f"Number of embeddings in database: {self.get_embedding_count()}")
 
-    def init_database(self, database_name, force: bool = False) -> faiss.IndexHNSWFlat:
-        LOG.info("Initializing database")
-        index_path = f"{DATABASE_PATH}/{database_name}.index"
-        if force or not os.path.exists(index_path):
-            os.makedirs(DATABASE_PATH, exist_ok=True)
-            index = faiss.IndexHNSWFlat(self.get_embedding_model_size(), 32)
-            index.hnsw.efConstruction = 128
-            index.hnsw.efSearch = 128
-            LOG.info(
-                f"Creating new database with efConstruction = {index.hnsw.efConstruction}"
+    def load(self) -> bool:
+        index_path = os.path.join(self.path, "index.json")
+        if not os.path.exists(index_path):
+            LOG.info(f"No local database found at {self.path}")
+            return False
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.ids = data["ids"]
+        self.metadata = data["metadata"]
+        self.partitions = data.get("partitions") or self.build_partitions(self.metadata)
+        self.grouped_rows = data.get("grouped_rows", len(self.ids))
+        for name in (
+            "dense",
+            "sparse_terms",
+            "sparse_offsets",
+            "sparse_postings",
+            "sparse_values",
+        ):
+            setattr(
+                self,
+                name,
+                np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r"),
             )
-            faiss.write_index(index, index_path)
-            return index
+        if self.quantizer is not None:
+            self.quantizer.load(self.path, self.dense)
         else:
-            LOG.info("Loading database from disk")
-            index = faiss.read_index(index_path)
-            return index
-
-    def query(self, query: str, top_k: int = 5):
-        query_vector = np.array(
-            self.embeddings.embed_query(query), dtype="float32"
-        ).reshape(1, -1)
-        distances, indices = self.db.search(query_vector, top_k)
-        return [(index, distance) for index, distance in zip(indices[0], distances[0])]
-
-    def insert_many_into_database(self, payloads: List[EmbeddingDocument]):
+            self.hnsw = self.load_hnsw()
+        self.filter_masks = {}
+        LOG.info(f"Loaded local database from {self.path}")
+        return True
+
+    def load_hnsw(self):
+        hnsw_path = os.path.join(self.path, "dense.hnsw")
+        if faiss is None or not os.path.exists(hnsw_path):
+            return None
         try:
-            embeddings = [
-                np.array(
-                    self.embeddings.embed_query(payload.metadata["text"]),
-                    dtype="float32",
-                )
-                for payload in payloads
-            ]
-            embeddings = np.vstack(embeddings)
-            self.db.add(embeddings)
+            hnsw = faiss.read_index(hnsw_path, faiss.IO_FLAG_MMAP)
+        except RuntimeError:
+            hnsw = faiss.read_index(hnsw_path)
+        hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+        return hnsw
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        for name in (
+            "dense",
+            "sparse_terms",
+            "sparse_offsets",
+            "sparse_postings",
+            "sparse_values",
+        ):
+            path = os.path.join(self.path, f"{name}.npy")
+            with open(f"{path}.tmp", "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(f"{path}.tmp", path)
+        if self.hnsw is not None:
+            hnsw_path = os.path.join(self.path, "dense.hnsw")
+            faiss.write_index(self.hnsw, f"{hnsw_path}.tmp")
+            os.replace(f"{hnsw_path}.tmp", hnsw_path)
+        if self.quantizer is not None:
+            self.quantizer.save(self.path)
+        # Written last, as its presence is what marks the database as saved
+        index_path = os.path.join(self.path, "index.json")
+        with open(f"{index_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "ids": self.ids,
+                    "metadata": self.metadata,
+                    "partitions": self.partitions,
+                    "grouped_rows": self.grouped_rows,
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(f"{index_path}.tmp", index_path)
+        LOG.info(f"Database saved to {self.path}")
+
+    def upsert_document(self, payload: EmbeddingDocument):
+        self.insert_many_into_databases([payload])
+
+    def insert_many_into_databases(self, payloads: List[EmbeddingDocument]):
+        try:
+            ids = []
+            metadata = []
+            texts = []
+            for payload in payloads:
+                chunks, chunk_metadata = self.chunk_payload(payload)
+                for i, text in enumerate(chunks):
+                    ids.append(f"{payload.id}_part{i}")
+                    metadata.append(chunk_metadata)
+                    texts.append(text)
+            if not texts:
+                return
+
+            dense_vecs = []
+            sparse_vecs = []
+            for start in range(0, len(texts), INSERT_BATCH_SIZE):
+                batch = texts[start : start + INSERT_BATCH_SIZE]
+                dense_vecs.extend(self.dense_embeddings.embed_documents(batch))
+                sparse_vecs.extend(self.sparse_embeddings.embed_documents(batch))
+
+            with self.write_lock:
+                # Saved first, so no chunk is ever stored without its document
+                self.document_store.save()
+                self.upsert(ids, metadata, dense_vecs, sparse_vecs)
+                self.save()
             LOG.info(f"Inserted {len(payloads)} documents into database")
             LOG.info(
                 f"Number of embeddings after insertion: {self.get_embedding_count()}"
             )
-            self.save_database()
         except Exception as e:
             LOG.error(f"Error inserting payload into database: {e}")
 
-    def insert_into_database(self, payload: EmbeddingDocument):
-        try:
-            embedding = np.array(
-                self.embeddings.embed_query(payload.metadata["text"]), dtype="float32"
-            ).reshape(1, -1)
-            self.db.add(embedding)
-            LOG.info(f"Inserted document into database with ID: {payload.id}")
-            LOG.info(
-                f"Number of embeddings after single insert: {self.get_embedding_count()}"
+    def upsert(
+        self,
+        ids: List[str],
+        metadata: List[dict],
+        dense_vecs: List[List[float]],
+        sparse_vecs: List[Dict[int, float]],
+    ):
+        """
+        Add the chunks to the stored ones, replacing those with the same id. New
+        chunks are appended after the stored ones; the database is only rebuilt when
+        a stored chunk is replaced or the appended chunks exceed `REBUILD_FRACTION`.
+        """
+        stored = set(self.ids)
+        n_appended = len(self.ids) - self.grouped_rows + len(ids)
+        if (
+            self.dense is None
+            or len(set(ids)) < len(ids)
+            or any(chunk_id in stored for chunk_id in ids)
+            or n_appended > REBUILD_FRACTION * (len(self.ids) + len(ids))
+        ):
+            self.rebuild(ids, metadata, dense_vecs, sparse_vecs)
+        else:
+            self.append(ids, metadata, dense_vecs, sparse_vecs)
+        self.filter_masks = {}
+
+    def append(
+        self,
+        ids: List[str],
+        metadata: List[dict],
+        dense_vecs: List[List[float]],
+        sparse_vecs: List[Dict[int, float]],
+    ):
+        """
+        Append new chunks after the stored ones: their vectors are added to the HNSW
+        graph (or encoded with the quantizer fitted at the last rebuild) and their
+        postings merged into the sparse index.
+        """
+        n_stored = len(self.ids)
+        dense = np.asarray(dense_vecs, dtype=np.float32)
+        new_docs = np.asarray(
+            [n_stored + doc for doc, vec in enumerate(sparse_vecs) for _ in vec],
+            dtype=np.int64,
+        )
+        new_terms = np.asarray([term for vec in sparse_vecs for term in vec], np.int64)
+        new_values = np.asarray(
+            [float(value) for vec in sparse_vecs for value in vec.values()],
+            dtype=np.float32,
+        )
+        order = np.lexsort((new_docs, new_terms))
+        new_docs, new_terms, new_values = (
+            new_docs[order],
+            new_terms[order],
+            new_values[order],
+        )
+
+        # The appended rows come after every stored one, so each term's new
+        # postings go after its stored postings and they stay sorted by row
+        terms, new_counts = np.unique(new_terms, return_counts=True)
+        all_terms = np.union1d(self.sparse_terms, terms)
+        stored_positions = np.searchsorted(all_terms, self.sparse_terms)
+        new_positions = np.searchsorted(all_terms, terms)
+        counts = np.zeros(len(all_terms), dtype=np.int64)
+        counts[stored_positions] = np.diff(self.sparse_offsets)
+        stored_counts = counts.copy()
+        counts[new_positions] += new_counts
+        offsets = np.zeros(len(all_terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        stored_destinations = np.arange(len(self.sparse_postings)) + np.repeat(
+            offsets[stored_positions] - self.sparse_offsets[:-1],
+            np.diff(self.sparse_offsets),
+        )
+        term_starts = np.repeat(np.cumsum(new_counts) - new_counts, new_counts)
+        new_destinations = np.repeat(
+            offsets[new_positions] + stored_counts[new_positions], new_counts
+        ) + (np.arange(len(new_terms)) - term_starts)
+        postings = np.empty(offsets[-1], dtype=np.int32)
+        values = np.empty(offsets[-1], dtype=np.float32)
+        postings[stored_destinations] = self.sparse_postings
+        postings[new_destinations] = new_docs
+        values[stored_destinations] = self.sparse_values
+        values[new_destinations] = new_values
+
+        self.ids = self.ids + ids
+        self.metadata = self.metadata + metadata
+        self.dense = np.concatenate([self.dense, dense])
+        self.sparse_terms = all_terms
+        self.sparse_offsets = offsets
+        self.sparse_postings = postings
+        self.sparse_values = values
+        if self.quantizer is not None:
+            self.quantizer.codes = np.concatenate(
+                [self.quantizer.codes, self.quantizer.encode(dense)]
             )
-            self.save_database()
-        except Exception as e:
-            LOG.error(f"Error inserting payload into database: {e}")
+        elif self.hnsw is not None:
+            try:
+                self.hnsw.add(dense)
+            except RuntimeError:
+                # A memory-mapped graph cannot grow, so it is read into memory
+                self.hnsw = faiss.read_index(os.path.join(self.path, "dense.hnsw"))
+                self.hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+                self.hnsw.add(dense)
 
-    def save_database(self):
-        index_path = f"{DATABASE_PATH}/{DATABASE_NAME}.index"
-        faiss.write_index(self.db, index_path)
-        LOG.info(f"Database saved to {index_path}")
+    def rebuild(
+        self,
+        ids: List[str],
+        metadata: List[dict],
+        dense_vecs: List[List[float]],
+        sparse_vecs: List[Dict[int, float]],
+    ):
+        """
+        Add the chunks to the stored ones, replacing those with the same id, group
+        all of them by legal code and rebuild the sparse index and the HNSW graph (or
+        the quantized vectors).
+        """
+        n_stored = len(self.ids)
+        all_ids = self.ids + ids
+        all_metadata = self.metadata + metadata
+        dense = np.asarray(dense_vecs, dtype=np.float32)
+        if self.dense is not None:
+            dense = np.concatenate([self.dense, dense])
 
-    def get_embedding_count(self) -> int:
-        return self.db.ntotal
+        if self.sparse_terms is not None:
+            terms = np.repeat(self.sparse_terms, np.diff(self.sparse_offsets))
+            docs = np.asarray(self.sparse_postings, dtype=np.int64)
+            values = np.asarray(self.sparse_values)
+        else:
+            terms = docs = np.empty(0, dtype=np.int64)
+            values = np.empty(0, dtype=np.float32)
+        new_docs = [n_stored + doc for doc, vec in enumerate(sparse_vecs) for _ in vec]
+        new_terms = [term for vec in sparse_vecs for term in vec]
+        new_values = [float(value) for vec in sparse_vecs for value in vec.values()]
+        terms = np.concatenate([terms, np.asarray(new_terms, dtype=np.int64)])
+        docs = np.concatenate([docs, np.asarray(new_docs, dtype=np.int64)])
+        values = np.concatenate([values, np.asarray(new_values, dtype=np.float32)])
+
+        # The last chunk inserted with each id wins, as in a Pinecone upsert. Chunks
+        # are stored grouped by legal code so each code's partition is a block of
+        # contiguous rows.
+        last_position = {chunk_id: i for i, chunk_id in enumerate(all_ids)}
+        keep = np.array(
+            sorted(
+                last_position.values(),
+                key=lambda i: (all_metadata[i].get("legal_code") or "", i),
+            ),
+            dtype=np.int64,
+        )
+        remap = np.full(len(all_ids), -1, dtype=np.int64)
+        remap[keep] = np.arange(len(keep))
+        docs = remap[docs]
+        kept = docs >= 0
+        terms, docs, values = terms[kept], docs[kept], values[kept]
+
+        order = np.lexsort((docs, terms))
+        unique_terms, counts = np.unique(terms[order], return_counts=True)
+        offsets = np.zeros(len(unique_terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        self.ids = [all_ids[i] for i in keep]
+        self.metadata = [all_metadata[i] for i in keep]
+        self.dense = np.ascontiguousarray(dense[keep])
+        self.sparse_terms = unique_terms
+        self.sparse_offsets = offsets
+        self.sparse_postings = docs[order].astype(np.int32)
+        self.sparse_values = values[order]
+        self.partitions = self.build_partitions(self.metadata)
+        self.grouped_rows = len(self.ids)
+        if self.quantizer is not None:
+            self.quantizer.fit(self.dense)
+        else:
+            self.hnsw = self.build_hnsw(self.dense)
+
+    def build_partitions(self, metadata: List[dict]) -> Dict[str, List[int]]:
+        partitions = {}
+        for row, chunk_metadata in enumerate(metadata):
+            legal_code = chunk_metadata.get("legal_code")
+            if legal_code:
+                partitions.setdefault(legal_code, [row, row])[1] = row + 1
+        return partitions
+
+    def build_hnsw(self, dense: np.ndarray):
+        if faiss is None:
+            return None
+        hnsw = faiss.IndexHNSWFlat(dense.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+        hnsw.add(dense)
+        return hnsw
+
+    def filter_mask(self, metadata_filter: Optional[dict]) -> Optional[np.ndarray]:
+        if not metadata_filter:
+            return None
+        key = json.dumps(metadata_filter, sort_keys=True)
+        if key not in self.filter_masks:
+            self.filter_masks[key] = np.array(
+                [
+                    matches_filter(metadata, metadata_filter)
+                    for metadata in self.metadata
+                ],
+                dtype=bool,
+            )
+        return self.filter_masks[key]
+
+    def sparse_scores(self, sparse_vec: dict, start: int, end: int) -> np.ndarray:
+        """
+        Sparse dot products of the rows from `start` to `end`. Postings are sorted
+        by row, so only those of the rows in that range are read.
+        """
+        scores = np.zeros(end - start, dtype=np.float32)
+        whole_index = start == 0 and end == len(self.ids)
+        indices = np.asarray(sparse_vec["indices"], dtype=np.int64)
+        positions = np.searchsorted(self.sparse_terms, indices)
+        for position, term, value in zip(positions, indices, sparse_vec["values"]):
+            if (
+                position == len(self.sparse_terms)
+                or self.sparse_terms[position] != term
+            ):
+                continue
+            postings = self.sparse_postings[
+                self.sparse_offsets[position] : self.sparse_offsets[position + 1]
+            ]
+            values = self.sparse_values[
+                self.sparse_offsets[position] : self.sparse_offsets[position + 1]
+            ]
+            if not whole_index:
+                first, last = np.searchsorted(postings, [start, end])
+                postings, values = postings[first:last], values[first:last]
+            scores[postings - start] += value * values
+        return scores
+
+    @staticmethod
+    def top_candidates(scores: np.ndarray, n_candidates: int) -> np.ndarray:
+        if len(scores) <= n_candidates:
+            return np.arange(len(scores))
+        return np.argpartition(-scores, n_candidates - 1)[:n_candidates]
 
-    def get_embedding_model_size(self) -> int:
-        return len(self.embeddings.embed_query("test"))
+    def sparse_candidates(
+        self, sparse_scores: np.ndarray, n_candidates: int
+    ) -> np.ndarray:
+        candidates = np.flatnonzero(sparse_scores)
+        return candidates[self.top_candidates(sparse_scores[candidates], n_candidates)]
+
+    def hnsw_candidates(
+        self, dense_vec: np.ndarray, sparse_scores: np.ndarray, top_k: int
+    ) -> np.ndarray:
+        n_candidates = min(
+            len(self.ids), max(top_k * self.candidate_factor, MIN_CANDIDATES)
+        )
+        _, dense_candidates = self.hnsw.search(dense_vec.reshape(1, -1), n_candidates)
+        dense_candidates = dense_candidates[0][dense_candidates[0] >= 0]
+        return np.union1d(
+            dense_candidates, self.sparse_candidates(sparse_scores, n_candidates)
+        )
+
+    def quantized_candidates(
+        self,
+        dense_vec: np.ndarray,
+        sparse_scores: np.ndarray,
+        top_k: int,
+        start: int,
+        end: int,
+        mask: Optional[np.ndarray],
+    ) -> np.ndarray:
+        """
+        Rows from `start` to `end` with the best approximate dense scores, together
+        with the best sparse matches, skipping the rows the mask excludes.
+        """
+        n_candidates = max(top_k * self.candidate_factor, MIN_CANDIDATES)
+        dense_scores = self.quantizer.scores(dense_vec, start, end)
+        if mask is not None:
+            mask = mask[start:end]
+            dense_scores[~mask] = -np.inf
+            sparse_scores = np.where(mask, sparse_scores, 0)
+        dense_candidates = self.top_candidates(dense_scores, n_candidates)
+        if mask is not None:
+            dense_candidates = dense_candidates[mask[dense_candidates]]
+        return start + np.union1d(
+            dense_candidates, self.sparse_candidates(sparse_scores, n_candidates)
+        )
+
+    def range_scores(
+        self,
+        dense_vec: np.ndarray,
+        sparse_vec: dict,
+        top_k: int,
+        start: int,
+        end: int,
+        mask: Optional[np.ndarray],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Candidate rows from `start` to `end` and their exact hybrid scores.
+        """
+        sparse_scores = self.sparse_scores(sparse_vec, start, end)
+        if mask is not None and mask[start:end].all():
+            mask = None
+        if self.quantizer is not None:
+            candidates = self.quantized_candidates(
+                dense_vec, sparse_scores, top_k, start, end, mask
+            )
+        elif mask is not None:
+            candidates = start + np.flatnonzero(mask[start:end])
+        elif self.hnsw is not None and end - start == len(self.ids):
+            candidates = self.hnsw_candidates(dense_vec, sparse_scores, top_k)
+        else:
+            # Every row of the range is a candidate, and the range is a view
+            return (
+                np.arange(start, end),
+                self.dense[start:end] @ dense_vec + sparse_scores,
+            )
+        return (
+            candidates,
+            self.dense[candidates] @ dense_vec + sparse_scores[candidates - start],
+        )
+
+    def hybrid_query_vectors(
+        self, dense_vec, sparse_vec, top_k, alpha, metadata_filter
+    ) -> list:
+        dense_vec, sparse_vec = self.hybrid_scale(dense_vec, sparse_vec, alpha)
+        if not self.ids:
+            return []
+        partition = self.partition(metadata_filter)
+        # Without a partition (or when the legal code has no documents, so the
+        # filter matches nothing) the whole index is searched. The chunks appended
+        # since the last rebuild are not grouped, so they are searched too.
+        ranges = [(0, len(self.ids))]
+        if partition in self.partitions:
+            ranges = [tuple(self.partitions[partition])]
+            if self.grouped_rows < len(self.ids):
+                ranges.append((self.grouped_rows, len(self.ids)))
+        with tracer.span("local_db.query", top_k=top_k, partition=partition or ""):
+            dense_vec = np.asarray(dense_vec, dtype=np.float32)
+            mask = self.filter_mask(metadata_filter)
+            results = [
+                self.range_scores(dense_vec, sparse_vec, top_k, start, end, mask)
+                for start, end in ranges
+            ]
+            candidates = np.concatenate([candidates for candidates, _ in results])
+            scores = np.concatenate([scores for _, scores in results])
+            top_k = min(top_k, len(candidates))
+            if top_k == 0:
+                return []
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+
+        return [
+            {
+                "id": self.ids[candidates[i]],
+                "score": float(scores[i]),
+                "metadata": self.metadata[candidates[i]],
+            }
+            for i in top
+        ]
+
+    def get_embedding_count(self) -> int:
+        return len(self.ids)
 
 
 if __name__ == "__main__":
-    FAISSDatabase(force=True)
+    FAISSDatabase()
@@ -0,0 +1,255 @@
+import abc
+import asyncio
+import logging
+import os
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.bin.utils import DenseEmbeddingModel
+from rag.retriever.database.bin.utils import SparseEmbeddingModel
+from rag.retriever.database.models.DocumentStore import compact_metadata
+from rag.retriever.database.models.DocumentStore import DocumentStore
+from rag.utils.executors import ExecutorSaturatedError
+from rag.utils.executors import get_executor
+
+LOG = logging.getLogger("HYBRID_DB")
+
+HYBRID_ALPHA = 0.3
+# Keep each legal code's documents in a partition of their own (a Pinecone
+# namespace, a contiguous block of rows in the local database) and search only that
+# partition when the metadata filter selects a legal code. Documents inserted
+# before it was enabled must be inserted again to populate the Pinecone namespaces.
+LEGAL_CODE_PARTITIONS = os.getenv("RAG_LEGAL_CODE_PARTITIONS", "false") == "true"
+# Store the text, updates and previous iterations of each document once in the
+# document store, instead of in the metadata of every one of its chunks. The
+# chunks inserted this way can only be served where the document store is loaded.
+COMPACT_METADATA = os.getenv("RAG_COMPACT_METADATA", "false") == "true"
+
+
+class HybridDatabase(abc.ABC):
+    """
+    Query side shared by the vector database backends. Questions are embedded with
+    the dense and sparse models, both vectors are weighted by `hybrid_scale` and the
+    backend's `hybrid_query_vectors` ranks the documents by the sum of their dense
+    and sparse dot products.
+
+    Searches run on the backend's `search_executor`: "cpu" when they compute the
+    scores locally, "io" when they wait on a remote database.
+
+    Inserted documents are also written to the document store, and with
+    `COMPACT_METADATA` their chunks only carry the fields used for filtering and
+    display; `DocumentStore.hydrate` adds the rest back to the results.
+    """
+
+    search_executor = "cpu"
+
+    def __init__(self):
+        self.sparse_embeddings = SparseEmbeddingModel()
+        self.dense_embeddings = DenseEmbeddingModel()
+        self.legal_code_partitions = LEGAL_CODE_PARTITIONS
+        self.document_store = DocumentStore()
+        self.document_store.load()
+
+    def reconnect(self):
+        pass
+
+    def partition(self, metadata_filter: Optional[dict]) -> Optional[str]:
+        """
+        The legal code whose partition holds every document the filter can match,
+        if partitions are enabled and the filter selects a single legal code.
+        """
+        if not (self.legal_code_partitions and metadata_filter):
+            return None
+        condition = metadata_filter.get("legal_code")
+        if isinstance(condition, dict):
+            return condition.get("$eq")
+        return condition
+
+    def chunk_text(self, text: str, chunk_size: int = 512) -> List[str]:
+        chunks = []
+        for i in range(0, len(text), chunk_size):
+            chunks.append(text[i : i + chunk_size])
+        return chunks
+
+    def chunk_payload(self, payload: EmbeddingDocument) -> Tuple[List[str], dict]:
+        """
+        Split the document's text into chunks, add the document to the document
+        store and return the chunks with the metadata to store with each of them.
+        """
+        chunks = self.chunk_text(payload.metadata["text"])
+        payload.metadata["num_chunks"] = len(chunks)
+        chunk_spans = []
+        start = 0
+        for chunk in chunks:
+            chunk_spans.append([start, start + len(chunk)])
+            start += len(chunk)
+        self.document_store.put(payload.id, payload.metadata, chunk_spans)
+        if COMPACT_METADATA:
+            return chunks, compact_metadata(payload.metadata)
+        return chunks, payload.metadata
+
+    def insert_into_database(self, payload: EmbeddingDocument):
+        self.insert_many_into_databases([payload])
+
+    @abc.abstractmethod
+    def upsert_document(self, payload: EmbeddingDocument):
+        pass
+
+    def insert_many_into_databases(self, payloads: List[EmbeddingDocument]):
+        try:
+            for payload in payloads:
+                self.upsert_document(payload)
+            LOG.info(f"Inserted {len(payloads)} documents into database")
+        except Exception as e:
+            LOG.error(f"Error inserting payload into database: {e}")
+        finally:
+            self.document_store.save()
+
+    def query(self, query: str, metadata_filter: dict = {}, top_k: int = 5):
+        try:
+            results = self.hybrid_query(
+                query, top_k, alpha=HYBRID_ALPHA, metadata_filter=metadata_filter
+            )
+            return results
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database: {e}, query: {query}")
+            return
+
+    def hybrid_scale(self, dense, sparse: dict, alpha: float):
+        if alpha < 0 or alpha > 1:
+            raise ValueError("Alpha must be between 0 and 1")
+        hsparse = {
+            "indices": list(sparse.keys()),
+            "values": [float(v) * (1 - alpha) for v in sparse.values()],
+        }
+        hdense = [v * alpha for v in dense]
+        return hdense, hsparse
+
+    async def aquery(self, query: str, metadata_filter: dict = {}, top_k: int = 5):
+        try:
+            results = await self.ahybrid_query(
+                query, top_k, alpha=HYBRID_ALPHA, metadata_filter=metadata_filter
+            )
+            return results
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database: {e}, query: {query}")
+            return
+
+    def batch_query(
+        self, queries: List[str], metadata_filters: List[dict], top_k: int = 5
+    ) -> List[Optional[list]]:
+        """
+        Synchronous counterpart of `abatch_query`: the queries are embedded in one
+        batch and searched concurrently on the search executor.
+        """
+        sparse_vecs = self.sparse_embeddings.embed_queries(queries)
+        dense_vecs = self.dense_embeddings.embed_documents(queries)
+
+        def search(arguments):
+            query, dense_vec, sparse_vec, metadata_filter = arguments
+            try:
+                return self.filtered_query_vectors(
+                    dense_vec, sparse_vec, top_k, HYBRID_ALPHA, metadata_filter
+                )
+            except ExecutorSaturatedError:
+                raise
+            except Exception as e:
+                LOG.error(f"Error querying database: {e}, query: {query}")
+                return
+
+        return list(
+            get_executor(self.search_executor).map(
+                search, zip(queries, dense_vecs, sparse_vecs, metadata_filters)
+            )
+        )
+
+    async def abatch_query(
+        self, queries: List[str], metadata_filters: List[dict], top_k: int = 5
+    ) -> List[Optional[list]]:
+        """
+        Embed all queries in one batched forward pass of each embedding model and run
+        their hybrid searches concurrently. A failed search yields None for its query.
+        """
+        # The dense model is symmetric, so queries are embedded as documents.
+        sparse_vecs, dense_vecs = await asyncio.gather(
+            self.sparse_embeddings.aembed_queries(queries),
+            self.dense_embeddings.aembed_documents(queries),
+        )
+
+        async def search(query, dense_vec, sparse_vec, metadata_filter):
+            try:
+                return await self.afiltered_query_vectors(
+                    dense_vec, sparse_vec, top_k, HYBRID_ALPHA, metadata_filter
+                )
+            except ExecutorSaturatedError:
+                raise
+            except Exception as e:
+                LOG.error(f"Error querying database: {e}, query: {query}")
+                return
+
+        return await asyncio.gather(
+            *(
+                search(query, dense_vec, sparse_vec, metadata_filter)
+                for query, dense_vec, sparse_vec, metadata_filter in zip(
+                    queries, dense_vecs, sparse_vecs, metadata_filters
+                )
+            )
+        )
+
+    def hybrid_query(self, question, top_k, alpha, metadata_filter):
+        sparse_vec = self.sparse_embeddings.embed_query(question)
+        dense_vec = self.dense_embeddings.embed_query(question)
+        return self.filtered_query_vectors(
+            dense_vec, sparse_vec, top_k, alpha, metadata_filter
+        )
+
+    async def ahybrid_query(self, question, top_k, alpha, metadata_filter):
+        sparse_vec, dense_vec = await asyncio.gather(
+            self.sparse_embeddings.aembed_query(question),
+            self.dense_embeddings.aembed_query(question),
+        )
+        return await self.afiltered_query_vectors(
+            dense_vec, sparse_vec, top_k, alpha, metadata_filter
+        )
+
+    async def afiltered_query_vectors(
+        self, dense_vec, sparse_vec, top_k, alpha, metadata_filter
+    ) -> list:
+        return await asyncio.wrap_future(
+            get_executor(self.search_executor).submit(
+                self.filtered_query_vectors,
+                dense_vec,
+                sparse_vec,
+                top_k,
+                alpha,
+                metadata_filter,
+            )
+        )
+
+    def filtered_query_vectors(
+        self, dense_vec, sparse_vec, top_k, alpha, metadata_filter
+    ) -> list:
+        """
+        `hybrid_query_vectors`, run again without the metadata filter when it
+        matches nothing, as chunks ingested before a filtered field existed (such as
+        legal_code) do not carry it.
+        """
+        matches = self.hybrid_query_vectors(
+            dense_vec, sparse_vec, top_k, alpha, metadata_filter
+        )
+        if matches or not metadata_filter:
+            return matches
+        LOG.warning(f"No matches for filter {metadata_filter}, querying without it")
+        return self.hybrid_query_vectors(dense_vec, sparse_vec, top_k, alpha, {})
+
+    @abc.abstractmethod
+    def hybrid_query_vectors(
+        self, dense_vec, sparse_vec, top_k, alpha, metadata_filter
+    ) -> list:
+        pass
@@ -1,7 +1,5 @@
 import logging
 import os
-import time
-from typing import List
 from typing import Optional
 
 import spacy
@@ -9,9 +7,10 @@ from dotenv import load_dotenv
 from pinecone import Pinecone
 from pinecone import ServerlessSpec
 from rag.retriever.database.bin.models import EmbeddingDocument
-from rag.retriever.database.bin.utils import DenseEmbeddingModel
 from rag.retriever.database.bin.utils import EmbeddingModel
-from rag.retriever.database.bin.utils import SparseEmbeddingModel
+from rag.retriever.database.models.HybridDatabase import HybridDatabase
+from rag.utils.registry import registry
+from rag.utils.tracing import tracer
 
 
 logging.basicConfig(
@@ -25,96 +24,99 @@ LOG = logging.getLogger("PINECONE")
 # python3 -m spacy download pt_core_news_sm
 
 
-class PineconeDatabase:
+class PineconeDatabase(HybridDatabase):
+    # Queries wait on the Pinecone API, so they do not take inference workers
+    search_executor = "io"
+
     def __init__(self):
         load_dotenv()
+        super().__init__()
         self.embeddings = EmbeddingModel()
-        self.sparse_embeddings = SparseEmbeddingModel()
-        self.dense_embeddings = DenseEmbeddingModel()
-        self.nlp = spacy.load("pt_core_news_sm")
+        registry.register(
+            "spacy:pt_core_news_sm",
+            lambda: spacy.load("pt_core_news_sm"),
+            preload=False,
+        )
         self.db = self.init_database(database_name="legislai")
 
+    @property
+    def nlp(self):
+        return registry.get("spacy:pt_core_news_sm")
+
     def init_database(self, database_name) -> Pinecone:
         LOG.info("Initializing Pinecone database")
+        self.database_name = database_name
         pinecone_api_key = os.getenv("PINECONE_API_KEY")
         database = Pinecone(api_key=pinecone_api_key)
         self.create_database(database_name=database_name, database=database)
         return database.Index(database_name)
 
-    def chunk_text(self, text: str, chunk_size: int = 512) -> List[str]:
-        chunks = []
-        for i in range(0, len(text), chunk_size):
-            chunks.append(text[i : i + chunk_size])
-        return chunks
+    def reconnect(self):
+        LOG.info("Reconnecting to Pinecone database")
+        database = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+        self.db = database.Index(self.database_name)
 
-    def insert_into_database(self, payload: EmbeddingDocument):
+    def upsert_document(self, payload: EmbeddingDocument):
         try:
             i = 0
-            chunks = self.chunk_text(payload.metadata["text"])
-            payload.metadata["num_chunks"] = len(chunks)
+            chunks, metadata = self.chunk_payload(payload)
+            # "" is the default namespace, which holds every document
+            namespaces = [""]
+            if self.legal_code_partitions and payload.metadata.get("legal_code"):
+                namespaces.append(payload.metadata["legal_code"])
             for text in chunks:
                 dense_embedding = self.dense_embeddings.embed_query(text)
-                sparse_embedding = self.sparse_embeddings.embed_query(text)
+                sparse_embedding = self.sparse_embeddings.embed_documents([text])[0]
                 sparse_embedding = {
                     "indices": list(sparse_embedding.keys()),
                     "values": list(float(x) for x in sparse_embedding.values()),
                 }
-                self.db.upsert(
-                    vectors=[
-                        {
-                            "id": f"{payload.id}_part{i}",
-                            "values": dense_embedding,
-                            "sparse_values": sparse_embedding,
-                            "metadata": payload.metadata,
-                        }
-                    ]
-                )
+                for namespace in namespaces:
+                    self.db.upsert(
+                        vectors=[
+                            {
+                                "id": f"{payload.id}_part{i}",
+                                "values": dense_embedding,
+                                "sparse_values": sparse_embedding,
+                                "metadata": metadata,
+                            }
+                        ],
+                        namespace=namespace,
+                    )
                 i += 1
                 LOG.info("Inserted payload into database")
         except Exception as e:
             LOG.error(f"Error inserting payload: {payload} into database: {e}")
 
-    def query(self, query: str, metadata_filter: dict = {}, top_k: int = 5):
-        try:
-            results = self.hybrid_query(
-                query, top_k, alpha=0.3, metadata_filter=metadata_filter
-            )
-            return results
-        except Exception as e:
-            LOG.error(f"Error querying database: {e}, query: {query}")
-            return
-
-    def hybrid_scale(self, dense, sparse: dict, alpha: float):
-        if alpha < 0 or alpha > 1:
-            raise ValueError("Alpha must be between 0 and 1")
-        hsparse = {
-            "indices": list(sparse.keys()),
-            "values": [float(v) * (1 - alpha) for v in sparse.values()],
-        }
-        hdense = [v * alpha for v in dense]
-        return hdense, hsparse
-
-    def hybrid_query(self, question, top_k, alpha, metadata_filter):
-        sparse_vec = self.sparse_embeddings.embed_query(question)
-        dense_vec = self.dense_embeddings.embed_query(question)
+    def hybrid_query_vectors(
+        self, dense_vec, sparse_vec, top_k, alpha, metadata_filter
+    ):
         dense_vec, sparse_vec = self.hybrid_scale(dense_vec, sparse_vec, alpha)
-        result = self.db.query(
-            vector=dense_vec,
-            sparse_vector=sparse_vec,
-            top_k=top_k,
-            include_metadata=True,
-            filter=metadata_filter,
-        )
-
-        return result.get("matches", [])
+        namespace = self.partition(metadata_filter) or ""
+        with tracer.span("pinecone.query", top_k=top_k, namespace=namespace):
+            result = self.db.query(
+                vector=dense_vec,
+                sparse_vector=sparse_vec,
+                top_k=top_k,
+                include_metadata=True,
+                filter=metadata_filter,
+                namespace=namespace,
+            )
+        matches = result.get("matches", [])
+        if namespace and not matches:
+            # The legal code's namespace was never populated, so the filter is
+            # applied to the whole index instead
+            with tracer.span("pinecone.query", top_k=top_k, namespace=""):
+                result = self.db.query(
+                    vector=dense_vec,
+                    sparse_vector=sparse_vec,
+                    top_k=top_k,
+                    include_metadata=True,
+                    filter=metadata_filter,
+                )
+            matches = result.get("matches", [])
 
-    def insert_many_into_databases(self, payloads: List[EmbeddingDocument]):
-        try:
-            for payload in payloads:
-                self.insert_into_database(payload)
-            LOG.info(f"Inserted {len(payloads)} documents into database")
-        except Exception as e:
-            LOG.error(f"Error inserting payload into database: {e}")
+        return matches
 
     def create_database(
         self,
@@ -150,7 +152,7 @@ class PineconeDatabase:
                 LOG.error(f"Error creating database {database_name}: {e}")
 
     def get_embedding_model_size(self) -> int:
-        return len(self.dense_embeddings.embed_query("teste"))
+        return self.dense_embeddings.embedding_dim
 
 
 if __name__ == "__main__":
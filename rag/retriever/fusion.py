@@ -0,0 +1,138 @@
+import os
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+import numpy as np
+
+# "weighted" sums the (normalized) scores of the sources, "rrf" their reciprocal
+# ranks
+FUSION_METHOD = os.getenv("RAG_FUSION_METHOD", "weighted")
+# "none", "minmax" or "zscore", applied to each source's scores by "weighted"
+FUSION_NORMALIZATION = os.getenv("RAG_FUSION_NORMALIZATION", "none")
+# Weight of each source, as "source=weight" pairs separated by commas
+FUSION_WEIGHTS = os.getenv("RAG_FUSION_WEIGHTS", "database=0.3,bm25=0.3,llm=0.3")
+RRF_K = int(os.getenv("RAG_RRF_K", 60))
+
+
+def parse_weights(weights: str) -> Dict[str, float]:
+    parsed = {}
+    for pair in weights.split(","):
+        source, _, weight = pair.partition("=")
+        if source.strip():
+            parsed[source.strip()] = float(weight)
+    return parsed
+
+
+def to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ScoreFusion:
+    """
+    Combines the scores several rankers gave to the same candidates into one
+    ranking, keyed by candidate id.
+
+    Each source's scores are gathered into an array aligned with the candidates;
+    candidates a source did not score, and ids that are not candidates, are
+    ignored by it. With "weighted" the scores are normalized per source (min-max
+    to 0-1, or z-scores) and summed with the source's weight, unscored candidates
+    counting as 0 (or as the lowest z-score). With "rrf" each source adds
+    `weight / (rrf_k + rank)` for the candidates it scored, ranked by its scores.
+    """
+
+    def __init__(
+        self,
+        method: str = FUSION_METHOD,
+        normalization: str = FUSION_NORMALIZATION,
+        weights: Optional[Dict[str, float]] = None,
+        rrf_k: int = RRF_K,
+    ):
+        if method not in ("weighted", "rrf"):
+            raise ValueError(f"Unknown fusion method: {method}")
+        if normalization not in ("none", "minmax", "zscore"):
+            raise ValueError(f"Unknown score normalization: {normalization}")
+        self.method = method
+        self.normalization = normalization
+        self.weights = weights if weights is not None else parse_weights(FUSION_WEIGHTS)
+        self.rrf_k = rrf_k
+
+    def source_scores(self, positions: Dict[str, int], results: Iterable[dict]):
+        """
+        The source's scores as an array aligned with the candidates, NaN for the
+        candidates it did not score. A candidate scored twice keeps its last score,
+        as the interpolation the fusion replaced did.
+        """
+        scores = np.full(len(positions), np.nan)
+        scored = [
+            (positions[result["id"]], result["score"])
+            for result in results
+            if result["id"] in positions
+        ]
+        if scored:
+            scored_positions, values = zip(*scored)
+            try:
+                values = np.asarray(values, dtype=np.float64)
+            except (TypeError, ValueError):
+                # LLM answers may score with strings or nothing at all
+                values = np.array([to_float(value) for value in values])
+            # The first occurrence in the reversed results is the last one
+            scored_positions, last = np.unique(
+                scored_positions[::-1], return_index=True
+            )
+            scores[scored_positions] = values[::-1][last]
+        return scores
+
+    def normalize(self, scores: np.ndarray) -> np.ndarray:
+        scored = ~np.isnan(scores)
+        if not scored.any():
+            return np.zeros_like(scores)
+        values = scores[scored]
+        if self.normalization == "minmax":
+            spread = values.max() - values.min()
+            values = (
+                (values - values.min()) / spread if spread else np.ones_like(values)
+            )
+            fill = 0.0
+        elif self.normalization == "zscore":
+            std = values.std()
+            values = (values - values.mean()) / std if std else np.zeros_like(values)
+            fill = values.min()
+        else:
+            fill = 0.0
+        normalized = np.full_like(scores, fill)
+        normalized[scored] = values
+        return normalized
+
+    def reciprocal_ranks(self, scores: np.ndarray) -> np.ndarray:
+        reciprocal_ranks = np.zeros_like(scores)
+        scored = np.flatnonzero(~np.isnan(scores))
+        # Stable, so ties keep the candidates' order
+        order = scored[np.argsort(-scores[scored], kind="stable")]
+        reciprocal_ranks[order] = 1 / (self.rrf_k + np.arange(1, len(order) + 1))
+        return reciprocal_ranks
+
+    def fuse(self, ids: List[str], sources: Dict[str, Iterable[dict]]) -> List[dict]:
+        """
+        Rank the candidate `ids` by the fused scores of the `sources`, each a list of
+        `{"id", "score"}`. Returns `{"id", "score"}` from best to worst, ties in the
+        order of `ids`.
+        """
+        positions = {doc_id: position for position, doc_id in enumerate(ids)}
+        ids = list(positions)
+        fused = np.zeros(len(ids))
+        for source, results in sources.items():
+            weight = self.weights.get(source, 0.0)
+            if not weight:
+                continue
+            scores = self.source_scores(positions, results)
+            if self.method == "rrf":
+                fused += weight * self.reciprocal_ranks(scores)
+            else:
+                fused += weight * self.normalize(scores)
+        order = np.argsort(-fused, kind="stable")
+        return [{"id": ids[i], "score": float(fused[i])} for i in order]
@@ -1,4 +1,5 @@
 #!/usr/bin/env/python3
+import asyncio
 import json
 import logging
 import os
@@ -6,12 +7,24 @@ import re
 import subprocess
 import time
 from datetime import datetime
-from queue import Queue
-from threading import Thread
+from typing import List
 from typing import Optional
 
+from rag.prompt_specialists.specialists import SpecialistPrompts
 from rag.retriever.database.bin.utils import BM250RerankingModel
+from rag.retriever.database.bin.utils import CrossEncoderRerankingModel
 from rag.retriever.database.DatabaseController import DatabaseController as dbc
+from rag.retriever.database.models.ArticleIndex import ArticleIndex
+from rag.retriever.database.models.BM25Index import BM25Index
+from rag.retriever.database.models.DocumentStore import chunk_document_id
+from rag.retriever.fusion import ScoreFusion
+from rag.utils.budget import optional_stage
+from rag.utils.executors import ExecutorSaturatedError
+from rag.utils.executors import get_executor
+from rag.utils.executors import run_in_executor
+from rag.utils.singleflight import normalize_question
+from rag.utils.tracing import tracer
+from together import AsyncTogether
 from together import Together
 
 logging.basicConfig(
@@ -24,101 +37,453 @@ LOG = logging.getLogger("retriever")
 subprocess.run("export TOKENIZERS_PARALLELISM=false", shell=True)
 
 TOGETHER_API_KEY = os.getenv("TOGETHER_AI_API_KEY")
+RERANKING_MODEL = "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo"
+
+# "listwise" scores all candidates in one call, "pointwise" sends one call per
+# candidate, "cross_encoder" scores them locally without calling an LLM and "none"
+# ranks them on the database and BM25 scores alone.
+RERANKING_MODE = os.getenv("RAG_RERANKING_MODE", "listwise")
+CROSS_ENCODER_MODEL = os.getenv(
+    "RAG_CROSS_ENCODER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+)
+CROSS_ENCODER_BACKEND = os.getenv("RAG_CROSS_ENCODER_BACKEND", "int8")
+# Adds the best BM25 matches over the whole corpus to the vector database's
+# candidates, when the BM25 index has been built.
+LEXICAL_RETRIEVAL = os.getenv("RAG_LEXICAL_RETRIEVAL", "true") == "true"
+# Restricts retrieval to the legal code the classifier picks from the question's
+# theme. Only chunks ingested with a legal_code in their metadata can match it, so
+# the corpus must be ingested again before enabling it. It is also the only filter
+# that makes the speculative search on the raw question be queried again.
+LEGAL_CODE_FILTER = os.getenv("RAG_LEGAL_CODE_FILTER", "false") == "true"
+# Questions citing an article of a known code ("artigo 251.º do Código do
+# Trabalho") get the article from the article index, without retrieval or reranking,
+# when the index has been built.
+ARTICLE_LOOKUP = os.getenv("RAG_ARTICLE_LOOKUP", "true") == "true"
+# Candidates are split into several listwise calls when their combined text would
+# not fit in one prompt, and each candidate's text is truncated to this length.
+LISTWISE_RERANK_MAX_CHARS = int(os.getenv("RAG_LISTWISE_RERANK_MAX_CHARS", 16000))
+LISTWISE_RERANK_DOCUMENT_CHARS = int(
+    os.getenv("RAG_LISTWISE_RERANK_DOCUMENT_CHARS", 3000)
+)
+# Expanded queries searched alongside the question in multi-query retrieval, and
+# the candidates kept for reranking after fusing their results, as a multiple of
+# top k (a single query reranks up to top k database plus top k BM25 candidates).
+MULTI_QUERY_MAX_EXPANSIONS = int(os.getenv("RAG_MULTI_QUERY_MAX_EXPANSIONS", 3))
+MULTI_QUERY_CANDIDATE_FACTOR = int(os.getenv("RAG_MULTI_QUERY_CANDIDATE_FACTOR", 2))
+# An id/score pair of a listwise answer, complete only when its object is closed or
+# followed by another field, so a score cut off midway is not taken
+RERANK_SCORE_REGEX = re.compile(
+    r'"id"\s*:\s*"?([^",}]+)"?\s*,\s*"score"\s*:\s*"?(\d+(?:\.\d+)?)"?\s*[,}]'
+)
 
 
 class Retriever:
     def __init__(self):
         self.databasecontroller = dbc()
-        self.reranking_llm = Together(api_key=TOGETHER_API_KEY)
+        self.connect()
         self.bm25_model = BM250RerankingModel()
+        self.cross_encoder = CrossEncoderRerankingModel(
+            model_name=CROSS_ENCODER_MODEL,
+            backend=CROSS_ENCODER_BACKEND,
+            preload=RERANKING_MODE == "cross_encoder",
+        )
+        self.bm25_index = BM25Index(
+            document_store=self.databasecontroller.vector_db.document_store
+        )
+        self.bm25_index.load()
+        self.article_index = ArticleIndex(
+            document_store=self.databasecontroller.vector_db.document_store
+        )
+        self.article_index.load()
+        self.specialist = SpecialistPrompts()
+        self.fusion = ScoreFusion()
+        self.reranking_mode = RERANKING_MODE
+        self.legal_code_filter = LEGAL_CODE_FILTER
+
+    def connect(self):
+        # Called again by each worker after a fork, see RAG.after_fork
+        self.reranking_llm = Together(api_key=TOGETHER_API_KEY)
+        self.async_reranking_llm = AsyncTogether(api_key=TOGETHER_API_KEY)
 
     def query(
         self,
         query: Optional[str],
         topk: Optional[int],
-        queue: Optional[Queue] = None,
         metadata_filter: Optional[dict] = {},
     ):
         try:
             LOG.info(f"Received query: {query} with filters: {metadata_filter}")
             start = time.time()
-            results = self.databasecontroller.query(query=query, top_k=topk)
+            results = self.databasecontroller.query(
+                query=query,
+                metadata_filter=self.database_filter(metadata_filter),
+                top_k=topk,
+            )
+            results = self.add_lexical_candidates(query, results, topk, metadata_filter)
             LOG.info(f"Results for query:{query} in {time.time()-start} seconds")
             results = self.rerank_results(results, query, metadata_filter)
             end = time.time()
             LOG.info(f"Results for query:{query} in {end-start} seconds")
+        except ExecutorSaturatedError:
+            raise
         except:
             LOG.error(f"Error querying database for query: {query}")
             results = []
-        finally:
-            if queue:
-                queue.put({query: results})
-            else:
-                return results
+        return results
+
+    def article_lookup(self, query: str) -> list:
+        """
+        The articles the question cites, as `query` returns its results, or an
+        empty list when the question does not cite an article of a known code.
+        """
+        if not (ARTICLE_LOOKUP and self.article_index.loaded):
+            return []
+        legal_code = self.specialist.get_legal_code(query)
+        matches = self.article_index.find(
+            query, legal_code.name if legal_code else None
+        )
+        if not matches:
+            return []
+        LOG.info(f"Found {len(matches)} cited articles for query: {query}")
+        return list(self.process_results(matches, {}).values())
+
+    def multi_query(
+        self,
+        query: str,
+        expanded_queries: Optional[List[str]],
+        topk: Optional[int],
+        metadata_filter: Optional[dict] = {},
+    ):
+        """
+        Retrieve with the question and its expanded queries, embedded in one batch
+        and searched concurrently, and rerank their fused candidates once against
+        the question. Without expansions this is `query`.
+        """
+        queries = self.query_variants(query, expanded_queries)
+        if len(queries) == 1:
+            return self.query(query, topk, metadata_filter)
+        try:
+            LOG.info(f"Received query: {query} with {len(queries) - 1} expansions")
+            start = time.time()
+            database_filter = self.database_filter(metadata_filter)
+            candidate_lists = self.databasecontroller.batch_query(
+                queries, [database_filter for _ in queries], top_k=topk
+            )
+            results = self.fuse_query_candidates(
+                queries, candidate_lists, topk, metadata_filter
+            )
+            LOG.info(
+                f"Results for {len(queries)} queries in {time.time()-start} seconds"
+            )
+            results = self.rerank_results(results, query, metadata_filter)
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database for query: {query}: {e}")
+            results = []
+        return results
+
+    async def amulti_query(
+        self,
+        query: str,
+        expanded_queries: Optional[List[str]],
+        topk: Optional[int],
+        metadata_filter: Optional[dict] = {},
+    ):
+        queries = self.query_variants(query, expanded_queries)
+        if len(queries) == 1:
+            return await self.aquery(query, topk, metadata_filter)
+        try:
+            LOG.info(f"Received query: {query} with {len(queries) - 1} expansions")
+            start = time.time()
+            database_filter = self.database_filter(metadata_filter)
+            candidate_lists = await self.databasecontroller.abatch_query(
+                queries, [database_filter for _ in queries], top_k=topk
+            )
+            results = self.fuse_query_candidates(
+                queries, candidate_lists, topk, metadata_filter
+            )
+            LOG.info(
+                f"Results for {len(queries)} queries in {time.time()-start} seconds"
+            )
+            results = await self.arerank_results(results, query, metadata_filter)
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database for query: {query}: {e}")
+            results = []
+        return results
+
+    def query_variants(self, query: str, expanded_queries: Optional[List[str]]):
+        """
+        The question followed by its distinct expanded queries, at most
+        `MULTI_QUERY_MAX_EXPANSIONS` of them.
+        """
+        queries = [query]
+        seen = {normalize_question(query)}
+        for expanded_query in expanded_queries or []:
+            if len(queries) > MULTI_QUERY_MAX_EXPANSIONS:
+                break
+            if not isinstance(expanded_query, str) or not expanded_query.strip():
+                continue
+            normalized = normalize_question(expanded_query)
+            if normalized not in seen:
+                seen.add(normalized)
+                queries.append(expanded_query)
+        return queries
+
+    def fuse_query_candidates(
+        self, queries, candidate_lists, topk, metadata_filter: Optional[dict] = None
+    ) -> list:
+        """
+        Merge the candidates of each query, with its BM25 matches, into one list
+        ranked by reciprocal rank fusion, keeping the best ranked chunk of each
+        article. A candidate found by several queries keeps its best database score,
+        which is what the reranking fusion weighs.
+        """
+        candidate_lists = [
+            self.add_lexical_candidates(query, results, topk, metadata_filter)
+            for query, results in zip(queries, candidate_lists)
+        ]
+        candidates = {}
+        for results in candidate_lists:
+            for result in results:
+                best = candidates.get(result["id"])
+                if best is None or result["score"] > best["score"]:
+                    candidates[result["id"]] = result
+
+        with tracer.span("query_fusion", queries=len(queries)):
+            fused = ScoreFusion(
+                method="rrf",
+                weights={f"query{i}": 1.0 for i in range(len(candidate_lists))},
+            ).fuse(
+                list(candidates),
+                {f"query{i}": results for i, results in enumerate(candidate_lists)},
+            )
+
+        results = []
+        articles = set()
+        for result in fused:
+            article_id = chunk_document_id(result["id"])
+            if article_id in articles:
+                continue
+            articles.add(article_id)
+            results.append(candidates[result["id"]])
+            if len(results) == topk * MULTI_QUERY_CANDIDATE_FACTOR:
+                break
+        return results
+
+    async def aquery(
+        self,
+        query: Optional[str],
+        topk: Optional[int],
+        metadata_filter: Optional[dict] = {},
+    ):
+        try:
+            LOG.info(f"Received query: {query} with filters: {metadata_filter}")
+            start = time.time()
+            results = await self.databasecontroller.aquery(
+                query=query,
+                metadata_filter=self.database_filter(metadata_filter),
+                top_k=topk,
+            )
+            results = self.add_lexical_candidates(query, results, topk, metadata_filter)
+            LOG.info(f"Results for query:{query} in {time.time()-start} seconds")
+            results = await self.arerank_results(results, query, metadata_filter)
+            end = time.time()
+            LOG.info(f"Results for query:{query} in {end-start} seconds")
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error querying database for query: {query}: {e}")
+            results = []
+        return results
+
+    async def abatch_query(
+        self,
+        queries: List[str],
+        topk: Optional[int],
+        metadata_filters: List[dict],
+    ) -> List[list]:
+        LOG.info(f"Received batch of {len(queries)} queries")
+        start = time.time()
+        candidates = await self.databasecontroller.abatch_query(
+            queries,
+            [
+                self.database_filter(metadata_filter)
+                for metadata_filter in metadata_filters
+            ],
+            top_k=topk,
+        )
+        LOG.info(f"Results for {len(queries)} queries in {time.time()-start} seconds")
+
+        async def rerank(query, results, metadata_filter):
+            try:
+                results = self.add_lexical_candidates(
+                    query, results, topk, metadata_filter
+                )
+                return await self.arerank_results(results, query, metadata_filter)
+            except ExecutorSaturatedError:
+                raise
+            except Exception as e:
+                LOG.error(f"Error reranking results for query: {query}: {e}")
+                return []
+
+        return await asyncio.gather(
+            *(
+                rerank(query, results, metadata_filter)
+                for query, results, metadata_filter in zip(
+                    queries, candidates, metadata_filters
+                )
+            )
+        )
+
+    async def aspeculative_query(self, query: str, topk: int) -> Optional[tuple]:
+        """
+        Search and rerank on the raw query, without waiting for the metadata filter.
+        Returns the raw candidates alongside the reranked results so the filter can be
+        checked against them once preprocessing finishes.
+        """
+        try:
+            start = time.time()
+            candidates = await self.databasecontroller.aquery(query=query, top_k=topk)
+            candidates = self.add_lexical_candidates(query, candidates, topk)
+            reranked = await self.arerank_results(candidates, query, {})
+            LOG.info(
+                f"Speculative results for query:{query} in {time.time()-start} seconds"
+            )
+            return candidates, reranked
+        except ExecutorSaturatedError:
+            raise
+        except Exception as e:
+            LOG.error(f"Error in speculative query for query: {query}: {e}")
+            return None
+
+    async def aresolve_speculative_query(
+        self,
+        query: str,
+        topk: int,
+        speculative_results: Optional[tuple],
+        metadata_filter: Optional[dict] = {},
+    ):
+        """
+        Keep the speculative results unless the metadata filter would have excluded
+        some of the candidates, in which case the database is queried again with the
+        filter applied. Retrieval is only filtered with `LEGAL_CODE_FILTER`, so
+        without it the speculative results are always kept, being the ones the
+        filtered query would return.
+        """
+        if speculative_results is None:
+            return await self.aquery(query, topk, metadata_filter)
+
+        candidates, reranked = speculative_results
+        if not self.filter_changes_candidates(candidates, metadata_filter):
+            return reranked
+
+        LOG.info(f"Metadata filter changes the candidates for query: {query}")
+        results = await self.aquery(query, topk, metadata_filter)
+        # Indexes built before the legal_code field existed return nothing when
+        # filtered, so the unfiltered candidates are better than no context at all.
+        return results or reranked
+
+    def add_lexical_candidates(
+        self, query, results, topk, metadata_filter: Optional[dict] = None
+    ) -> list:
+        """
+        Append the BM25 index's best matches that the vector database missed. They
+        get a database score of 0 and are ranked by the BM25 and LLM scores.
+        """
+        results = list(results or [])
+        if not (LEXICAL_RETRIEVAL and self.bm25_index.loaded):
+            return results
+
+        database_filter = self.database_filter(metadata_filter)
+        legal_code = database_filter["legal_code"]["$eq"] if database_filter else None
+        # Vector database ids are the section id followed by the chunk number
+        seen = {result["id"].rsplit("_part", 1)[0] for result in results}
+        for match in self.bm25_index.search(query, topk, legal_code):
+            if match["id"] not in seen:
+                results.append({**match, "score": 0.0})
+        return results
+
+    def database_filter(self, metadata_filter: Optional[dict]) -> dict:
+        if not self.legal_code_filter:
+            return {}
+        legal_code = self.specialist.get_legal_code(
+            (metadata_filter or {}).get("theme") or ""
+        )
+        if legal_code is None:
+            return {}
+        return {"legal_code": {"$eq": legal_code.name}}
+
+    def document_legal_code(self, metadata: dict) -> Optional[str]:
+        if metadata.get("legal_code"):
+            return metadata["legal_code"]
+        legal_code = self.specialist.get_legal_code(
+            f"{metadata.get('theme', '')} {metadata.get('law_name', '')}"
+        )
+        return legal_code.name if legal_code else None
+
+    def filter_changes_candidates(self, candidates, metadata_filter) -> bool:
+        """
+        Whether the database filter built from the preprocessed metadata filter
+        excludes any of the candidates. There is no database filter, and so no
+        change, without `LEGAL_CODE_FILTER`.
+        """
+        database_filter = self.database_filter(metadata_filter)
+        if not database_filter:
+            return False
+        legal_code = database_filter["legal_code"]["$eq"]
+        return any(
+            self.document_legal_code(candidate.get("metadata", {})) != legal_code
+            for candidate in candidates or []
+        )
 
     def process_results(self, results, metadata_filter):
-        return {
-            result["id"]: {
+        # Chunks only carry compact metadata, the text of the candidates is read
+        # from the document store
+        document_store = self.databasecontroller.vector_db.document_store
+        processed_results = {}
+        missing = []
+        for result in results:
+            metadata = document_store.hydrate(result["id"], result["metadata"])
+            if "text" not in metadata:
+                # Without its document the chunk has nothing to rerank or answer from
+                missing.append(result["id"])
+                continue
+            processed_results[result["id"]] = {
                 "id": result["id"],
-                "metadata": result["metadata"],
+                "metadata": metadata,
                 "score": result["score"],
-                "text": "".join(result["metadata"]["text"]),
-                "theme": result["metadata"].get("theme", ""),
-                "source_url": result["metadata"].get("link", ""),
-                "law_name": result["metadata"].get("law_name", ""),
-                "title": result["metadata"].get("title", ""),
-                "epigrafe": result["metadata"].get("epigrafe", ""),
+                "text": "".join(metadata.get("text", "")),
+                "theme": metadata.get("theme", ""),
+                "source_url": metadata.get("link", ""),
+                "law_name": metadata.get("law_name", ""),
+                "title": metadata.get("title", ""),
+                "epigrafe": metadata.get("epigrafe", ""),
             }
-            for result in results
-        }
+        if missing:
+            LOG.warning(
+                f"Dropped {len(missing)} candidates whose documents are not in the "
+                f"document store: {', '.join(missing)}"
+            )
+        return processed_results
 
     def bm250_rerank(self, query, results):
+        results = list(results)
         documents = [result["text"] for result in results]
 
-        rerankinkg_result = self.bm25_model.bm25_rerank(query, documents)
-        maped_id_result = []
-        for result in rerankinkg_result:
-            for result_id in results:
-                if result["document"] == result_id["text"]:
-                    maped_id_result.append(
-                        {"id": result_id["id"], "score": result["bm25_score"]}
-                    )
-                    break
-        return maped_id_result
-
-    def interpolate_results(self, reranked_results, alpha):
-        scores_dict = {}
-
-        def add_scores(source_results, source_name):
-            for item in source_results:
-                doc_id = item["id"]
-                score = item["score"]
-                if doc_id not in scores_dict:
-                    scores_dict[doc_id] = {
-                        "database_score": 0,
-                        "bm25_score": 0,
-                        "llm_score": 0,
-                    }
-                scores_dict[doc_id][source_name] = score
-
-        add_scores(reranked_results["database_results"], "database_score")
-        add_scores(reranked_results["bm25_results"], "bm25_score")
-        add_scores(reranked_results["llm_reranking"], "llm_score")
-
-        interpolated_results = []
-
-        for doc_id, scores in scores_dict.items():
-            interpolated_score = (
-                alpha * scores["database_score"]
-                + alpha * scores["bm25_score"]
-                + alpha * scores["llm_score"]
-            )
-            interpolated_results.append({"id": doc_id, "score": interpolated_score})
-
-        interpolated_results = sorted(
-            interpolated_results, key=lambda x: x["score"], reverse=True
-        )
-        return interpolated_results
+        with tracer.span("bm25_rerank", documents=len(documents)):
+            if self.bm25_index.loaded:
+                # The corpus-wide IDF is meaningful, unlike one computed over the
+                # few candidates alone.
+                scores = self.bm25_index.score_texts(query, documents)
+            else:
+                scores = self.bm25_model.bm25_scores(query, documents)
+        return [
+            {"id": result["id"], "score": score}
+            for result, score in zip(results, scores)
+        ]
 
     # llm based reranking
     # https://huggingface.co/cmarkea/bloomz-3b-reranking#dataset
@@ -129,36 +494,55 @@ class Retriever:
         bm25_results = self.bm250_rerank(query, process_results.values())
         llm_reranking = self.llm_rerank(query, process_results.values())
 
-        reranked_results = {
-            "database_results": [
-                {"id": result["id"], "score": result["score"]} for result in results
-            ],
-            "bm25_results": bm25_results,
-            "llm_reranking": llm_reranking,
-        }
-        interpolated_ranked_results = self.interpolate_results(reranked_results, 0.3)
+        return self.combine_rankings(
+            results, process_results, bm25_results, llm_reranking
+        )
 
-        reranked_results = []
-        for result in interpolated_ranked_results:
-            result_id = result["id"]
-            if result_id not in process_results:
-                LOG.info(f"Document {result_id} not found in the interpolated results.")
-                continue
+    async def arerank_results(self, results, query, metadata_filter):
+        process_results = self.process_results(results, metadata_filter)
+        # When the LLM reranking does not fit the latency budget, the results are
+        # ranked on the database and BM25 scores alone.
+        bm25_results, llm_reranking = await asyncio.gather(
+            run_in_executor(self.bm250_rerank, query, list(process_results.values())),
+            optional_stage(
+                "llm_rerank",
+                lambda: self.allm_rerank(query, process_results.values()),
+                [],
+            ),
+        )
 
-            process_result = process_results[result_id]
+        return self.combine_rankings(
+            results, process_results, bm25_results, llm_reranking
+        )
+
+    def combine_rankings(self, results, process_results, bm25_results, llm_reranking):
+        with tracer.span("fusion", candidates=len(process_results)):
+            fused_results = self.fusion.fuse(
+                list(process_results),
+                {
+                    "database": results,
+                    "bm25": bm25_results,
+                    "llm": llm_reranking,
+                },
+            )
+
+        reranked_results = []
+        for result in fused_results:
+            process_result = process_results[result["id"]]
             process_result["score"] = result["score"]
             reranked_results.append(process_result)
         return reranked_results
 
-    def _rerank(self, prompt, queue: Queue):
+    def _rerank(self, prompt) -> dict:
         try:
             prompt = {"role": "user", "content": prompt}
 
-            response = self.reranking_llm.chat.completions.create(
-                model="meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
-                messages=[prompt],
-                temperature=0,
-            )
+            with tracer.span("llm_rerank.call"):
+                response = self.reranking_llm.chat.completions.create(
+                    model=RERANKING_MODEL,
+                    messages=[prompt],
+                    temperature=0,
+                )
             metadata = response.choices[0].message.content
 
             result = self.parse_tool_response(metadata)
@@ -170,58 +554,110 @@ class Retriever:
         except Exception as e:
             LOG.error(f"Unexpected error during LLM reranking: {e}")
             result = {}
-        finally:
-            queue.put(result)
+        return result
+
+    def rerank_prompt(self, query, document) -> str:
+        document_json = json.dumps({"id": document["id"], "text": document["text"]})
+        prompt = f"""
+        Tens acesso a uma função que baseada numa query atribui relevância entre um documento e a questão do utilizador.
+        Baseado no contexto da seguinte questão {query}, qual a relevância do texto seguinte?
+            Documento:
+                {document_json}
+
+            ###
+
+        Para atribuir a relevância dos documentos à questão, usa a seguinte estrutura:
+
+            <function=rerank>
+            {{
+                "query": "{query}",
+                "results": {{
+                    "documents": [{{ "id": "document_id", "score": similarity_score }}]
+                }}
+            }}
+            </function>
+
+            Lembra-te:
+            - Responde apenas no formato JSON mostrado.
+            - Começa com <function=rerank> e termina com </function>.
+            - Se não tiveres certeza, atribui o score de 80.
+            - Atribui um valor "score" entre 0 e 100 para cada documento que represente a relevância do documento para a questão.
+            - Na resposta devolve apenas os ids dos documentos por ordem de relevância.
+            - Usa vírgulas para separar os elementos.
+            - Todos os documentos que tenhas menos de 70% de certeza que são relevantes, deves descartar.
+            - Usa chavetas para agrupar os elementos.
+            """
+        return prompt
 
     def llm_rerank(self, query, results):
+        if self.reranking_mode == "none":
+            return []
+        if self.reranking_mode == "cross_encoder":
+            return self.cross_encoder_rerank(query, results)
+        if self.reranking_mode == "listwise":
+            return self.listwise_llm_rerank(query, results)
+        return self.pointwise_llm_rerank(query, results)
+
+    def pointwise_llm_rerank(self, query, results):
         LOG.info(f"Reranking documents using an LLM for query: {query}")
-        answer_queue = Queue()
-        threads = []
         init_time = datetime.now()
 
-        # Create threads for reranking
-        for document in results:
-            document_json = json.dumps({"id": document["id"], "text": document["text"]})
-            prompt = f"""
-            Tens acesso a uma função que baseada numa query atribui relevância entre um documento e a questão do utilizador.
-            Baseado no contexto da seguinte questão {query}, qual a relevância do texto seguinte?
-                Documento:
-                    {document_json}
-
-                ###
-
-            Para atribuir a relevância dos documentos à questão, usa a seguinte estrutura:
-
-                <function=rerank>
-                {{
-                    "query": "{query}",
-                    "results": {{
-                        "documents": [{{ "id": "document_id", "score": similarity_score }}]
-                    }}
-                }}
-                </function>
-
-                Lembra-te:
-                - Responde apenas no formato JSON mostrado.
-                - Começa com <function=rerank> e termina com </function>.
-                - Se não tiveres certeza, atribui o score de 80.
-                - Atribui um valor "score" entre 0 e 100 para cada documento que represente a relevância do documento para a questão.
-                - Na resposta devolve apenas os ids dos documentos por ordem de relevância.
-                - Usa vírgulas para separar os elementos.
-                - Todos os documentos que tenhas menos de 70% de certeza que são relevantes, deves descartar.
-                - Usa chavetas para agrupar os elementos.
-                """
-
-            t = Thread(target=self._rerank, args=(prompt, answer_queue))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
+        answers = get_executor("io").map(
+            self._rerank, [self.rerank_prompt(query, document) for document in results]
+        )
+
+        aggregated_results = []
+        for element in answers:
+            if isinstance(element, list):
+                aggregated_results.extend(element)
+
+        final_time = datetime.now()
+        LOG.info(f"LLM reranking completed in {final_time - init_time}.")
+        LOG.debug(f"Final aggregated results: {aggregated_results}")
+        return aggregated_results
+
+    async def _arerank(self, prompt) -> list:
+        try:
+            prompt = {"role": "user", "content": prompt}
+
+            with tracer.span("llm_rerank.call"):
+                response = await self.async_reranking_llm.chat.completions.create(
+                    model=RERANKING_MODEL,
+                    messages=[prompt],
+                    temperature=0,
+                )
+            metadata = response.choices[0].message.content
+
+            return self.parse_tool_response(metadata)
+
+        except Exception as e:
+            LOG.error(f"Unexpected error during LLM reranking: {e}")
+            return {}
+
+    async def allm_rerank(self, query, results):
+        if self.reranking_mode == "none":
+            return []
+        if self.reranking_mode == "cross_encoder":
+            with tracer.span("llm_rerank", mode="cross_encoder"):
+                return await run_in_executor(self.cross_encoder_rerank, query, results)
+        if self.reranking_mode == "listwise":
+            return await self.alistwise_llm_rerank(query, results)
+        return await self.apointwise_llm_rerank(query, results)
+
+    async def apointwise_llm_rerank(self, query, results):
+        LOG.info(f"Reranking documents using an LLM for query: {query}")
+        init_time = datetime.now()
+
+        with tracer.span("llm_rerank", mode="pointwise"):
+            answers = await asyncio.gather(
+                *(
+                    self._arerank(self.rerank_prompt(query, document))
+                    for document in results
+                )
+            )
 
         aggregated_results = []
-        while not answer_queue.empty():
-            element = answer_queue.get()
+        for element in answers:
             if isinstance(element, list):
                 aggregated_results.extend(element)
 
@@ -230,6 +666,215 @@ class Retriever:
         LOG.debug(f"Final aggregated results: {aggregated_results}")
         return aggregated_results
 
+    def listwise_rerank_prompt(self, query, documents) -> str:
+        documents_json = json.dumps(
+            [
+                {
+                    "id": str(position),
+                    "text": document["text"][:LISTWISE_RERANK_DOCUMENT_CHARS],
+                }
+                for position, document in enumerate(documents, start=1)
+            ],
+            ensure_ascii=False,
+        )
+        prompt = f"""
+        Tens acesso a uma função que baseada numa query atribui relevância entre vários documentos e a questão do utilizador.
+        Baseado no contexto da seguinte questão {query}, qual a relevância de cada um dos documentos seguintes?
+            Documentos:
+                {documents_json}
+
+            ###
+
+        Para atribuir a relevância dos documentos à questão, usa a seguinte estrutura:
+
+            <function=rerank>
+            {{
+                "results": {{
+                    "documents": [{{ "id": "document_id", "score": similarity_score }}]
+                }}
+            }}
+            </function>
+
+            Lembra-te:
+            - Responde apenas no formato JSON mostrado.
+            - Começa com <function=rerank> e termina com </function>.
+            - Usa os ids dos documentos tal como são dados.
+            - Se não tiveres certeza, atribui o score de 80.
+            - Atribui um valor "score" entre 0 e 100 para cada documento que represente a relevância do documento para a questão.
+            - Devolve os documentos por ordem de relevância.
+            - Usa vírgulas para separar os elementos.
+            - Todos os documentos que tenhas menos de 70% de certeza que são relevantes, deves descartar.
+            - Usa chavetas para agrupar os elementos.
+            """
+        return prompt
+
+    def listwise_batches(self, results) -> list:
+        """
+        Split the candidates into groups whose combined (truncated) text fits in a
+        single listwise prompt.
+        """
+        batches = []
+        batch = []
+        batch_chars = 0
+        for document in results:
+            document_chars = min(len(document["text"]), LISTWISE_RERANK_DOCUMENT_CHARS)
+            if batch and batch_chars + document_chars > LISTWISE_RERANK_MAX_CHARS:
+                batches.append(batch)
+                batch = []
+                batch_chars = 0
+            batch.append(document)
+            batch_chars += document_chars
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def parse_listwise_response(self, response: str, documents) -> Optional[list]:
+        """
+        Map the positional ids in a listwise answer back to the document ids. When
+        the answer is not valid JSON, e.g. because it was cut off, every complete
+        id/score pair in it is still used. Returns None when nothing in the answer
+        can be parsed, unlike an empty list of documents, which discards them all.
+        """
+        documents_by_position = {
+            str(position): document["id"]
+            for position, document in enumerate(documents, start=1)
+        }
+        ranked = self.parse_tool_response(response or "")
+        if isinstance(ranked, list):
+            pairs = [
+                (str(item.get("id")), item.get("score"))
+                for item in ranked
+                if isinstance(item, dict)
+            ]
+        else:
+            pairs = RERANK_SCORE_REGEX.findall(response or "")
+            if not pairs:
+                return None
+            LOG.info(f"Recovered {len(pairs)} scores from a partial rerank answer")
+
+        reranked = []
+        seen = set()
+        for position, score in pairs:
+            document_id = documents_by_position.get(position.strip())
+            if document_id is None or document_id in seen:
+                continue
+            try:
+                reranked.append({"id": document_id, "score": float(score)})
+            except (TypeError, ValueError):
+                continue
+            seen.add(document_id)
+        return reranked
+
+    def _listwise_rerank(self, query, documents) -> list:
+        try:
+            prompt = {
+                "role": "user",
+                "content": self.listwise_rerank_prompt(query, documents),
+            }
+            with tracer.span("llm_rerank.call", documents=len(documents)) as span:
+                response = self.reranking_llm.chat.completions.create(
+                    model=RERANKING_MODEL,
+                    messages=[prompt],
+                    temperature=0,
+                )
+                self.record_usage(span, response)
+            result = self.parse_listwise_response(
+                response.choices[0].message.content, documents
+            )
+        except Exception as e:
+            LOG.error(f"Unexpected error during listwise LLM reranking: {e}")
+            return []
+        if result is None:
+            LOG.warning(
+                "Unreadable listwise rerank answer, reranking the batch pointwise"
+            )
+            return self.pointwise_llm_rerank(query, documents)
+        return result
+
+    def listwise_llm_rerank(self, query, results):
+        LOG.info(f"Listwise reranking documents using an LLM for query: {query}")
+        init_time = datetime.now()
+
+        answers = get_executor("io").map(
+            lambda documents: self._listwise_rerank(query, documents),
+            self.listwise_batches(list(results)),
+        )
+
+        aggregated_results = []
+        for answer in answers:
+            aggregated_results.extend(answer)
+
+        final_time = datetime.now()
+        LOG.info(f"Listwise LLM reranking completed in {final_time - init_time}.")
+        return aggregated_results
+
+    async def _alistwise_rerank(self, query, documents) -> list:
+        try:
+            prompt = {
+                "role": "user",
+                "content": self.listwise_rerank_prompt(query, documents),
+            }
+            with tracer.span("llm_rerank.call", documents=len(documents)) as span:
+                response = await self.async_reranking_llm.chat.completions.create(
+                    model=RERANKING_MODEL,
+                    messages=[prompt],
+                    temperature=0,
+                )
+                self.record_usage(span, response)
+            result = self.parse_listwise_response(
+                response.choices[0].message.content, documents
+            )
+        except Exception as e:
+            LOG.error(f"Unexpected error during listwise LLM reranking: {e}")
+            return []
+        if result is None:
+            LOG.warning(
+                "Unreadable listwise rerank answer, reranking the batch pointwise"
+            )
+            return await self.apointwise_llm_rerank(query, documents)
+        return result
+
+    async def alistwise_llm_rerank(self, query, results):
+        LOG.info(f"Listwise reranking documents using an LLM for query: {query}")
+        init_time = datetime.now()
+
+        with tracer.span("llm_rerank", mode="listwise"):
+            answers = await asyncio.gather(
+                *(
+                    self._alistwise_rerank(query, documents)
+                    for documents in self.listwise_batches(list(results))
+                )
+            )
+
+        aggregated_results = []
+        for element in answers:
+            aggregated_results.extend(element)
+
+        final_time = datetime.now()
+        LOG.info(f"Listwise LLM reranking completed in {final_time - init_time}.")
+        LOG.debug(f"Final aggregated results: {aggregated_results}")
+        return aggregated_results
+
+    def cross_encoder_rerank(self, query, results):
+        """
+        Score the candidates with the local cross-encoder. The scores take the place
+        of the LLM's in `combine_rankings`.
+        """
+        results = list(results)
+        scores = self.cross_encoder.rerank(
+            query, [result["text"] for result in results]
+        )
+        return [
+            {"id": result["id"], "score": score}
+            for result, score in zip(results, scores)
+        ]
+
+    def record_usage(self, span, response):
+        usage = getattr(response, "usage", None)
+        if span and usage:
+            span.set_attribute("prompt_tokens", usage.prompt_tokens)
+            span.set_attribute("completion_tokens", usage.completion_tokens)
+
     def parse_tool_response(self, response: str) -> dict:
         function_regex = r"<function=(\w+)>(.*?)</function>"
         match = re.search(function_regex, response, re.DOTALL)
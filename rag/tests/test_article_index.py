@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.models.ArticleIndex import article_numbers
+from rag.retriever.database.models.ArticleIndex import ArticleIndex
+from rag.retriever.database.models.DocumentStore import DocumentStore
+
+CITATIONS = [
+    ("O que diz o artigo 251.º do Código do Trabalho?", ["251"]),
+    ("art.º 251.º do CT", ["251"]),
+    ("art 5 do Código Civil", ["5"]),
+    ("art. 17.º-A", ["17-a"]),
+    ("Artigo 5.º-B", ["5-b"]),
+    ("artigos 13.º e 14.º", ["13", "14"]),
+    ("arts. 13.º, 14.º e 15.º", ["13", "14", "15"]),
+    ("artigos 13 e 14", ["13", "14"]),
+    ("artigo 5.º e 6.º", ["5", "6"]),
+    ("artigo 05.º", ["5"]),
+    ("artigo 5.º e artigo 7.º", ["5", "7"]),
+    ("ARTIGO 12", ["12"]),
+]
+
+NOT_CITATIONS = [
+    ("artigo 5 e 2 filhos", ["5"]),
+    ("artigo 5.º e 2 filhos", ["5"]),
+    ("artigo 5, 3 dias depois", ["5"]),
+    ("artigo 5 - a lei diz", ["5"]),
+    ("Tenho 2 filhos e 5 dias de férias", []),
+    ("Uma obra de arte 5 vezes vendida", []),
+    ("O artigo que li", []),
+    ("artesanato 12", []),
+    ("", []),
+]
+
+
+class TestArticleNumbers(unittest.TestCase):
+    def test_citations(self):
+        """Test the numbers of cited articles are found"""
+        for text, numbers in CITATIONS:
+            with self.subTest(text=text):
+                self.assertEqual(article_numbers(text), numbers)
+
+    def test_not_citations(self):
+        """Test numbers that do not follow a citation are not taken as articles"""
+        for text, numbers in NOT_CITATIONS:
+            with self.subTest(text=text):
+                self.assertEqual(article_numbers(text), numbers)
+
+
+class TestArticleIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.document_store = DocumentStore(
+            os.path.join(self.directory.name, "documents")
+        )
+        documents = [
+            EmbeddingDocument(
+                doc_id=f"ct{number}",
+                metadata={
+                    "title": f"Artigo {number}.º",
+                    "epigrafe": epigrafe,
+                    "text": f"Texto do artigo {number}.º",
+                    "legal_code": "CODIGO_TRABALHO",
+                    "document_name": "Código do Trabalho",
+                    "theme": "Direito do Trabalho",
+                },
+            )
+            for number, epigrafe in ((5, "Férias"), (6, "Faltas"))
+        ]
+        for document in documents:
+            self.document_store.put(document.id, document.metadata, [[0, 10]])
+        self.document_store.save()
+        self.index = ArticleIndex.build(
+            documents,
+            os.path.join(self.directory.name, "articles"),
+            document_store=self.document_store,
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_find_reads_the_document_store(self):
+        """Test cited articles are returned with their text from the document store"""
+        matches = self.index.find("O que diz o art.º 6.º do Código do Trabalho?")
+        self.assertEqual([match["id"] for match in matches], ["ct6"])
+        self.assertEqual(matches[0]["metadata"]["text"], "Texto do artigo 6.º")
+        self.assertNotIn("chunk_spans", matches[0]["metadata"])
+
+    def test_index_stores_only_ids(self):
+        """Test the index file does not keep the articles' metadata"""
+        with open(os.path.join(self.index.path, "index.json"), encoding="utf-8") as f:
+            self.assertNotIn("Texto do artigo", f.read())
+
+    def test_missing_article(self):
+        """Test a question citing an article outside the index finds nothing"""
+        self.assertEqual(self.index.find("artigo 7.º do Código do Trabalho"), [])
+
+    def test_missing_document(self):
+        """Test articles missing from the document store are not returned"""
+        index = ArticleIndex(self.index.path)
+        index.load()
+        self.assertEqual(index.find("artigo 5.º do Código do Trabalho"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.models.DocumentStore import DocumentStore
+
+# The embedding models are not needed to build the index, so their module is
+# replaced while the index is imported
+MOCKED_MODULES = ("rag.retriever.database.bin.utils",)
+INDEX_MODULES = ("rag.retriever.database.models.BM25Index",)
+
+
+class TestBM25IndexMissingDocuments(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Only these modules are restored afterwards, as the extension modules
+        # imported meanwhile, such as numpy, cannot be imported twice
+        cls.saved_modules = {
+            name: sys.modules.get(name) for name in MOCKED_MODULES + INDEX_MODULES
+        }
+        sys.modules.update(
+            {name: MagicMock(STOP_WORDS=set()) for name in MOCKED_MODULES}
+        )
+        from rag.retriever.database.models.BM25Index import BM25Index
+
+        cls.index_class = BM25Index
+
+    @classmethod
+    def tearDownClass(cls):
+        for name, module in cls.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        documents = [
+            EmbeddingDocument(
+                doc_id=f"ct{number}",
+                metadata={
+                    "title": f"Artigo {number}.º",
+                    "text": f"Férias do trabalhador, artigo {number}",
+                    "legal_code": "CODIGO_TRABALHO",
+                },
+            )
+            for number in (5, 6, 7)
+        ]
+        # Only the first article is in the document store
+        self.document_store = DocumentStore(
+            os.path.join(self.directory.name, "documents")
+        )
+        self.document_store.put(documents[0].id, documents[0].metadata, [[0, 10]])
+        self.document_store.save()
+        self.document_store.load()
+        self.index_path = os.path.join(self.directory.name, "bm25")
+        self.index_class.build(documents, self.index_path)
+
+    def test_missing_documents_are_logged_once_at_load(self):
+        """Test loading the index warns once about all its missing documents"""
+        index = self.index_class(self.index_path, self.document_store)
+        with self.assertLogs("BM25_INDEX", level="WARNING") as logs:
+            index.load()
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("2 documents", logs.output[0])
+
+    def test_search_leaves_missing_documents_out_quietly(self):
+        """Test a search returns the stored documents without warning per miss"""
+        index = self.index_class(self.index_path, self.document_store)
+        index.load()
+        with self.assertNoLogs("BM25_INDEX", level="WARNING"):
+            matches = index.search("férias do trabalhador", top_k=3)
+        self.assertEqual([match["id"] for match in matches], ["ct5"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import sys
+import threading
+import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from rag.utils import executors
+from rag.utils.executors import BoundedExecutor
+from rag.utils.executors import ExecutorSaturatedError
+
+# The Pinecone client, spaCy and the embedding models are not needed to route the
+# searches, so their modules are replaced while the database modules are imported
+MOCKED_MODULES = ("dotenv", "pinecone", "spacy", "rag.retriever.database.bin.utils")
+DATABASE_MODULES = (
+    "rag.retriever.database.models.HybridDatabase",
+    "rag.retriever.database.models.PineconeDatabase",
+)
+
+
+class FakeEmbeddings:
+    def embed_query(self, text):
+        return {1: 1.0}
+
+    def embed_queries(self, texts):
+        return [{1: 1.0} for _ in texts]
+
+    def embed_documents(self, texts):
+        return [[1.0] for _ in texts]
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+    async def aembed_queries(self, texts):
+        return self.embed_queries(texts)
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+
+class TestPineconeSearchExecutor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Only these modules are restored afterwards, as the extension modules
+        # imported meanwhile, such as numpy, cannot be imported twice
+        cls.saved_modules = {
+            name: sys.modules.get(name) for name in MOCKED_MODULES + DATABASE_MODULES
+        }
+        sys.modules.update({name: MagicMock() for name in MOCKED_MODULES})
+        from rag.retriever.database.models.PineconeDatabase import PineconeDatabase
+
+        cls.database_class = PineconeDatabase
+
+    @classmethod
+    def tearDownClass(cls):
+        for name, module in cls.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def setUp(self):
+        self.database = self.database_class.__new__(self.database_class)
+        self.database.sparse_embeddings = FakeEmbeddings()
+        self.database.dense_embeddings = FakeEmbeddings()
+        self.database.legal_code_partitions = False
+        self.database.db = MagicMock()
+        self.database.db.query.return_value = {"matches": [{"id": "a_part0"}]}
+
+        # A CPU pool whose only worker is busy and that queues nothing
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        cpu = BoundedExecutor("cpu", max_workers=1, max_queue=0)
+        io = BoundedExecutor("io", max_workers=2, max_queue=8)
+        self.addCleanup(cpu.shutdown)
+        self.addCleanup(io.shutdown)
+        cpu.submit(self.release.wait)
+        executors_patch = patch.dict(
+            executors._executors, {"cpu": cpu, "io": io}, clear=True
+        )
+        executors_patch.start()
+        self.addCleanup(executors_patch.stop)
+
+    def test_cpu_pool_is_saturated(self):
+        """Test the searches below run while the CPU pool rejects new tasks"""
+        with self.assertRaises(ExecutorSaturatedError):
+            executors.get_executor("cpu").submit(lambda: None)
+
+    def test_aquery(self):
+        """Test an async Pinecone search runs on the IO pool"""
+        results = asyncio.run(self.database.aquery("question"))
+        self.assertEqual(results, [{"id": "a_part0"}])
+
+    def test_abatch_query(self):
+        """Test a batch of async Pinecone searches runs on the IO pool"""
+        results = asyncio.run(self.database.abatch_query(["first", "second"], [{}, {}]))
+        self.assertEqual(results, [[{"id": "a_part0"}], [{"id": "a_part0"}]])
+
+    def test_batch_query(self):
+        """Test a batch of sync Pinecone searches runs on the IO pool"""
+        results = self.database.batch_query(["first", "second"], [{}, {}])
+        self.assertEqual(results, [[{"id": "a_part0"}], [{"id": "a_part0"}]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import importlib.util
+import unittest
+
+import numpy as np
+
+# The ONNX backend falls back to int8 torch without optimum, so the test only runs
+# when the ONNX export can actually be compared to torch
+REQUIRED_MODULES = ("torch", "sentence_transformers", "onnxruntime", "optimum")
+MODULES_AVAILABLE = all(
+    importlib.util.find_spec(module) is not None for module in REQUIRED_MODULES
+)
+# Same threshold as `python -m rag.benchmarks.embedding_backends --min-cosine`
+MIN_DENSE_COSINE = 0.98
+MIN_SPARSE_COSINE = 0.95
+
+TEXTS = [
+    "Quantos dias de férias tem um trabalhador por ano?",
+    "O trabalhador tem direito a licença parental após o nascimento de um filho.",
+    "Artigo 251.º do Código do Trabalho: faltas por motivo de falecimento.",
+    "O contrato de arrendamento pode ser denunciado pelo senhorio?",
+]
+
+
+def sparse_cosine(a: dict, b: dict) -> float:
+    dot = sum(weight * b.get(term, 0.0) for term, weight in a.items())
+    norm = np.sqrt(sum(w * w for w in a.values()) * sum(w * w for w in b.values()))
+    return dot / norm if norm else float(a == b)
+
+
+@unittest.skipUnless(MODULES_AVAILABLE, f"needs {', '.join(REQUIRED_MODULES)}")
+class TestOnnxBackend(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from rag.retriever.database.bin.utils import DenseEmbeddingModel
+        from rag.retriever.database.bin.utils import SparseEmbeddingModel
+        from rag.utils.embedding_cache import embedding_cache
+
+        cls.embedding_cache = embedding_cache
+        cls.cache_enabled = embedding_cache.enabled
+        embedding_cache.enabled = False
+        cls.models = {
+            backend: (
+                DenseEmbeddingModel(backend=backend),
+                SparseEmbeddingModel(encoding="splade", backend=backend),
+            )
+            for backend in ("torch", "onnx")
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.embedding_cache.enabled = cls.cache_enabled
+
+    def embed(self, backend: str, dense: bool):
+        dense_model, sparse_model = self.models[backend]
+        try:
+            if dense:
+                return np.asarray(dense_model.embed_documents(TEXTS))
+            return sparse_model.embed_queries(TEXTS)
+        except OSError as e:
+            # The model could not be downloaded or found in the cache
+            self.skipTest(f"model unavailable: {e}")
+
+    def test_dense_embeddings_match_torch(self):
+        """Test the ONNX dense embeddings point the same way as the torch ones"""
+        onnx = self.embed("onnx", dense=True)
+        torch = self.embed("torch", dense=True)
+        cosines = np.sum(onnx * torch, axis=1) / (
+            np.linalg.norm(onnx, axis=1) * np.linalg.norm(torch, axis=1)
+        )
+        self.assertGreaterEqual(cosines.min(), MIN_DENSE_COSINE)
+
+    def test_sparse_embeddings_match_torch(self):
+        """Test the ONNX SPLADE weights are close to the torch ones"""
+        onnx = self.embed("onnx", dense=False)
+        torch = self.embed("torch", dense=False)
+        for onnx_vec, torch_vec in zip(onnx, torch):
+            self.assertGreaterEqual(
+                sparse_cosine(onnx_vec, torch_vec), MIN_SPARSE_COSINE
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from rag.utils import executors
+from rag.utils.executors import BoundedExecutor
+from rag.utils.executors import check_capacity
+from rag.utils.executors import ExecutorSaturatedError
+
+
+class TestBoundedExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = BoundedExecutor("cpu", max_workers=1, max_queue=1)
+        self.release = threading.Event()
+        # Cleanups run last to first, so the worker is released before shutdown
+        self.addCleanup(self.executor.shutdown)
+        self.addCleanup(self.release.set)
+
+    def fill(self):
+        """Occupy the only worker and the only queue slot"""
+        running = threading.Event()
+
+        def block():
+            running.set()
+            self.release.wait()
+
+        futures = [self.executor.submit(block), self.executor.submit(block)]
+        running.wait()
+        return futures
+
+    def wait_idle(self):
+        """Wait for the done callbacks, which run after the results are set"""
+        deadline = time.monotonic() + 5
+        while self.executor.pending and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def test_submit_rejects_when_full(self):
+        """Test submit rejects at max_workers + max_queue pending tasks"""
+        self.fill()
+        self.assertTrue(self.executor.saturated)
+        with self.assertRaises(ExecutorSaturatedError) as raised:
+            self.executor.submit(lambda: None)
+        self.assertEqual(raised.exception.name, "cpu")
+        self.assertEqual(self.executor.metrics()["rejected"], 1)
+
+    def test_submit_accepts_after_tasks_finish(self):
+        """Test the slots of finished tasks are given back"""
+        futures = self.fill()
+        self.release.set()
+        for future in futures:
+            future.result()
+        self.wait_idle()
+        self.assertEqual(self.executor.pending, 0)
+        self.assertEqual(self.executor.submit(lambda: 1).result(), 1)
+
+    def test_defer_runs_on_the_caller_when_full(self):
+        """Test defer runs the task on the calling thread instead of rejecting it"""
+        self.fill()
+        future = self.executor.defer(threading.get_ident)
+        self.assertEqual(future.result(), threading.get_ident())
+        self.assertEqual(self.executor.metrics()["caller_runs"], 1)
+
+    def test_defer_runs_inline_in_a_worker(self):
+        """Test a worker deferring to its own pool does not wait on its queue"""
+        future = self.executor.submit(
+            lambda: self.executor.defer(threading.get_ident).result()
+            == threading.get_ident()
+        )
+        self.assertTrue(future.result(timeout=5))
+
+    def test_map_runs_the_first_item_on_the_caller(self):
+        """Test map runs its first item on the calling thread, in order"""
+        results = self.executor.map(
+            lambda item: (item, threading.get_ident()), [0, 1, 2]
+        )
+        self.assertEqual([item for item, _ in results], [0, 1, 2])
+        self.assertEqual(results[0][1], threading.get_ident())
+        self.assertEqual(self.executor.map(str, []), [])
+
+    def test_map_propagates_exceptions(self):
+        """Test an exception raised on any item is raised by map"""
+
+        def fail_on(failing):
+            def func(item):
+                if item == failing:
+                    raise ValueError(item)
+                return item
+
+            return func
+
+        for failing in (0, 2):
+            with self.subTest(failing=failing):
+                with self.assertRaises(ValueError):
+                    self.executor.map(fail_on(failing), [0, 1, 2])
+
+    def test_queue_wait_is_recorded(self):
+        """Test the time a task waits for a worker is recorded"""
+        futures = self.fill()
+        time.sleep(0.05)
+        self.release.set()
+        for future in futures:
+            future.result()
+        summary = self.executor.metrics()["queue_wait"]
+        self.assertEqual(summary["count"], 2)
+        # The second task waited behind the first one
+        self.assertGreaterEqual(summary["p99"], 0.05)
+
+
+class TestCheckCapacity(unittest.TestCase):
+    def setUp(self):
+        self.cpu = BoundedExecutor("cpu", max_workers=1, max_queue=0)
+        self.io = BoundedExecutor("io", max_workers=1, max_queue=0)
+        self.addCleanup(self.cpu.shutdown)
+        self.addCleanup(self.io.shutdown)
+        executors_patch = patch.dict(
+            executors._executors, {"cpu": self.cpu, "io": self.io}, clear=True
+        )
+        executors_patch.start()
+        self.addCleanup(executors_patch.stop)
+
+    def test_accepts_with_free_slots(self):
+        """Test requests are accepted while no executor is full"""
+        check_capacity()
+
+    def test_rejects_when_an_executor_is_full(self):
+        """Test requests are turned away while an executor is full"""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.io.submit(release.wait)
+        with self.assertRaises(ExecutorSaturatedError) as raised:
+            check_capacity()
+        self.assertEqual(raised.exception.name, "io")
+        self.assertEqual(self.io.rejected, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+import unittest
+
+from rag.retriever.fusion import ScoreFusion
+
+
+def interpolate_results(reranked_results, alpha):
+    # Retriever.interpolate_results, which the fusion replaced
+    scores_dict = {}
+
+    def add_scores(source_results, source_name):
+        for item in source_results:
+            doc_id = item["id"]
+            score = item["score"]
+            if doc_id not in scores_dict:
+                scores_dict[doc_id] = {
+                    "database_score": 0,
+                    "bm25_score": 0,
+                    "llm_score": 0,
+                }
+            scores_dict[doc_id][source_name] = score
+
+    add_scores(reranked_results["database_results"], "database_score")
+    add_scores(reranked_results["bm25_results"], "bm25_score")
+    add_scores(reranked_results["llm_reranking"], "llm_score")
+
+    interpolated_results = []
+
+    for doc_id, scores in scores_dict.items():
+        interpolated_score = (
+            alpha * scores["database_score"]
+            + alpha * scores["bm25_score"]
+            + alpha * scores["llm_score"]
+        )
+        interpolated_results.append({"id": doc_id, "score": interpolated_score})
+
+    interpolated_results = sorted(
+        interpolated_results, key=lambda x: x["score"], reverse=True
+    )
+    return interpolated_results
+
+
+def results(*scores):
+    return [{"id": doc_id, "score": score} for doc_id, score in scores]
+
+
+class TestDefaultFusion(unittest.TestCase):
+    def assertMatchesInterpolation(self, database, bm25, llm):
+        # The candidates are the database results, once each, as process_results
+        # keys them
+        candidates = list(dict.fromkeys(result["id"] for result in database))
+        fused = ScoreFusion(
+            method="weighted",
+            normalization="none",
+            weights={"database": 0.3, "bm25": 0.3, "llm": 0.3},
+        ).fuse(candidates, {"database": database, "bm25": bm25, "llm": llm})
+        interpolated = interpolate_results(
+            {
+                "database_results": database,
+                "bm25_results": bm25,
+                "llm_reranking": llm,
+            },
+            0.3,
+        )
+        self.assertEqual(fused, interpolated)
+
+    def test_duplicate_ids(self):
+        """Test an id scored twice by a source keeps its last score"""
+        self.assertMatchesInterpolation(
+            results(("a", 0.9), ("b", 0.5), ("a", 0.2)),
+            results(("a", 1.0), ("b", 2.0), ("b", 3.0)),
+            results(("b", 5), ("a", 7), ("a", 1)),
+        )
+
+    def test_ties(self):
+        """Test tied candidates keep the order of the database results"""
+        self.assertMatchesInterpolation(
+            results(("a", 0.5), ("b", 0.5), ("c", 0.5), ("d", 0.5)),
+            results(("d", 1.0), ("c", 1.0), ("b", 1.0)),
+            results(("c", 2), ("b", 2)),
+        )
+
+    def test_partial_sources(self):
+        """Test candidates a source did not score count as 0 for it"""
+        self.assertMatchesInterpolation(
+            results(("a", 0.8), ("b", 0.6), ("c", 0.4)),
+            results(("c", 4.2)),
+            results(("b", 9), ("c", 3)),
+        )
+
+
+class TestScoreFusion(unittest.TestCase):
+    def fuse(self, candidates, sources, **kwargs):
+        fused = ScoreFusion(weights={source: 1.0 for source in sources}, **kwargs).fuse(
+            candidates, sources
+        )
+        return {result["id"]: result["score"] for result in fused}
+
+    def test_minmax(self):
+        """Test min-max scales each source to 0-1 and unscored candidates to 0"""
+        scores = self.fuse(
+            ["a", "b", "c", "d"],
+            {"bm25": results(("a", 1.0), ("b", 3.0), ("c", 2.0))},
+            normalization="minmax",
+        )
+        self.assertEqual(scores, {"b": 1.0, "c": 0.5, "a": 0.0, "d": 0.0})
+
+    def test_minmax_equal_scores(self):
+        """Test a source scoring every candidate alike gives them all 1"""
+        scores = self.fuse(
+            ["a", "b"],
+            {"bm25": results(("a", 2.0), ("b", 2.0))},
+            normalization="minmax",
+        )
+        self.assertEqual(scores, {"a": 1.0, "b": 1.0})
+
+    def test_zscore(self):
+        """Test z-scores center each source and unscored candidates get the lowest"""
+        scores = self.fuse(
+            ["a", "b", "c", "d"],
+            {"bm25": results(("a", 1.0), ("b", 2.0), ("c", 3.0))},
+            normalization="zscore",
+        )
+        lowest = -(1.5**0.5)
+        self.assertEqual(list(scores), ["c", "b", "a", "d"])
+        self.assertAlmostEqual(scores["c"], -lowest)
+        self.assertAlmostEqual(scores["b"], 0.0)
+        self.assertAlmostEqual(scores["a"], lowest)
+        self.assertAlmostEqual(scores["d"], lowest)
+
+    def test_rrf(self):
+        """Test reciprocal-rank fusion sums weight / (k + rank) over the sources"""
+        scores = self.fuse(
+            ["a", "b", "c"],
+            {
+                "database": results(("a", 0.9), ("b", 0.1)),
+                "llm": results(("b", 8)),
+            },
+            method="rrf",
+            rrf_k=60,
+        )
+        self.assertEqual(list(scores), ["b", "a", "c"])
+        self.assertAlmostEqual(scores["b"], 1 / 62 + 1 / 61)
+        self.assertAlmostEqual(scores["a"], 1 / 61)
+        self.assertEqual(scores["c"], 0.0)
+
+    def test_non_numeric_scores(self):
+        """Test scores that are not numbers count as unscored"""
+        scores = self.fuse(
+            ["a", "b"],
+            {"llm": results(("a", "high"), ("b", "3"))},
+        )
+        self.assertEqual(scores, {"b": 3.0, "a": 0.0})
+
+    def test_unknown_ids(self):
+        """Test ids that are not candidates are ignored"""
+        scores = self.fuse(["a"], {"llm": results(("z", 10), ("a", 1))})
+        self.assertEqual(scores, {"a": 1.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import sys
+import unittest
+from unittest.mock import AsyncMock
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+# The LLM client, the embedding models and the databases are not needed to parse
+# the answers, so their modules are replaced while the retriever is imported
+MOCKED_MODULES = (
+    "together",
+    "rag.prompt_specialists.specialists",
+    "rag.retriever.database.bin.utils",
+    "rag.retriever.database.DatabaseController",
+)
+RETRIEVER_MODULES = ("rag.retriever.main",)
+
+DOCUMENTS = [{"id": "ct5_part0"}, {"id": "ct6_part0"}, {"id": "ct7_part0"}]
+
+
+def answer(documents: list) -> str:
+    arguments = {"query": "férias", "results": {"documents": documents}}
+    return f"<function=rerank>{json.dumps(arguments)}</function>"
+
+
+def completion(content: str):
+    response = MagicMock(usage=None)
+    response.choices[0].message.content = content
+    return response
+
+
+class TestParseListwiseResponse(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Only these modules are restored afterwards, as the extension modules
+        # imported meanwhile, such as numpy, cannot be imported twice
+        cls.saved_modules = {
+            name: sys.modules.get(name) for name in MOCKED_MODULES + RETRIEVER_MODULES
+        }
+        sys.modules.update({name: MagicMock() for name in MOCKED_MODULES})
+        from rag.retriever.main import Retriever
+
+        cls.retriever_class = Retriever
+
+    @classmethod
+    def tearDownClass(cls):
+        for name, module in cls.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def setUp(self):
+        self.retriever = self.retriever_class.__new__(self.retriever_class)
+
+    def parse(self, response: str):
+        return self.retriever.parse_listwise_response(response, DOCUMENTS)
+
+    def test_answer(self):
+        """Test the positional ids are mapped back to the document ids"""
+        self.assertEqual(
+            self.parse(answer([{"id": "2", "score": 90}, {"id": 1, "score": 75.5}])),
+            [{"id": "ct6_part0", "score": 90.0}, {"id": "ct5_part0", "score": 75.5}],
+        )
+
+    def test_truncated_list(self):
+        """Test the complete pairs of a cut off answer are used, and only those"""
+        response = answer([{"id": "2", "score": 90}, {"id": "3", "score": 85}])
+        for cut, expected in (
+            ('"score": 85', [{"id": "ct6_part0", "score": 90.0}]),
+            ('"score": 8', [{"id": "ct6_part0", "score": 90.0}]),
+            ('{"id": "3"', [{"id": "ct6_part0", "score": 90.0}]),
+            (
+                "}]}}",
+                [
+                    {"id": "ct6_part0", "score": 90.0},
+                    {"id": "ct7_part0", "score": 85.0},
+                ],
+            ),
+        ):
+            with self.subTest(cut=cut):
+                truncated = response[: response.index(cut) + len(cut)]
+                self.assertEqual(self.parse(truncated), expected)
+
+    def test_duplicate_ids(self):
+        """Test a document scored twice keeps its first score"""
+        self.assertEqual(
+            self.parse(answer([{"id": "1", "score": 90}, {"id": "1", "score": 10}])),
+            [{"id": "ct5_part0", "score": 90.0}],
+        )
+
+    def test_unknown_ids(self):
+        """Test ids outside the prompt's documents are ignored"""
+        self.assertEqual(
+            self.parse(
+                answer(
+                    [
+                        {"id": "4", "score": 95},
+                        {"id": "ct5_part0", "score": 90},
+                        {"id": "3", "score": 80},
+                    ]
+                )
+            ),
+            [{"id": "ct7_part0", "score": 80.0}],
+        )
+
+    def test_non_numeric_scores(self):
+        """Test documents whose score is not a number are left out"""
+        self.assertEqual(
+            self.parse(
+                answer(
+                    [
+                        {"id": "1", "score": "alta"},
+                        {"id": "2", "score": None},
+                        {"id": "3", "score": "85"},
+                    ]
+                )
+            ),
+            [{"id": "ct7_part0", "score": 85.0}],
+        )
+
+    def test_every_document_discarded(self):
+        """Test an answer that discards every document is not taken as unreadable"""
+        self.assertEqual(self.parse(answer([])), [])
+
+    def test_unreadable_answer(self):
+        """Test an answer without any id/score pair cannot be parsed"""
+        for response in ("Não sei.", "<function=rerank>{</function>", "", None):
+            with self.subTest(response=response):
+                self.assertIsNone(self.parse(response))
+
+    def test_unreadable_answer_falls_back_to_pointwise(self):
+        """Test a batch whose answer cannot be parsed is reranked pointwise"""
+        pointwise = [{"id": "ct6_part0", "score": 80}]
+        self.retriever.reranking_llm = MagicMock()
+        self.retriever.reranking_llm.chat.completions.create.return_value = completion(
+            "Não sei."
+        )
+        with patch.object(
+            self.retriever, "listwise_rerank_prompt", return_value="prompt"
+        ), patch.object(
+            self.retriever, "pointwise_llm_rerank", return_value=pointwise
+        ) as pointwise_llm_rerank:
+            self.assertEqual(
+                self.retriever._listwise_rerank("férias", DOCUMENTS), pointwise
+            )
+        pointwise_llm_rerank.assert_called_once_with("férias", DOCUMENTS)
+
+    def test_async_unreadable_answer_falls_back_to_pointwise(self):
+        """Test the async reranking also falls back to pointwise"""
+        pointwise = [{"id": "ct6_part0", "score": 80}]
+        self.retriever.async_reranking_llm = MagicMock()
+        self.retriever.async_reranking_llm.chat.completions.create = AsyncMock(
+            return_value=completion("Não sei.")
+        )
+        with patch.object(
+            self.retriever, "listwise_rerank_prompt", return_value="prompt"
+        ), patch.object(
+            self.retriever,
+            "apointwise_llm_rerank",
+            AsyncMock(return_value=pointwise),
+        ) as apointwise_llm_rerank:
+            self.assertEqual(
+                asyncio.run(self.retriever._alistwise_rerank("férias", DOCUMENTS)),
+                pointwise,
+            )
+        apointwise_llm_rerank.assert_awaited_once_with("férias", DOCUMENTS)
+
+    def test_discarded_documents_are_not_reranked_pointwise(self):
+        """Test an answer discarding every document does not fall back"""
+        self.retriever.reranking_llm = MagicMock()
+        self.retriever.reranking_llm.chat.completions.create.return_value = completion(
+            answer([])
+        )
+        with patch.object(
+            self.retriever, "listwise_rerank_prompt", return_value="prompt"
+        ), patch.object(self.retriever, "pointwise_llm_rerank") as pointwise_llm_rerank:
+            self.assertEqual(self.retriever._listwise_rerank("férias", DOCUMENTS), [])
+        pointwise_llm_rerank.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
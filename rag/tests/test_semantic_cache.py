@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+import zlib
+
+from rag.retriever.database.bin.models import EmbeddingDocument
+from rag.retriever.database.models.ArticleIndex import ArticleIndex
+from rag.retriever.database.models.DocumentStore import DocumentStore
+from rag.utils.semantic_cache import SemanticCache
+
+
+class WordEmbeddings:
+    """
+    Counts of the words of the question without their digits, so questions that
+    only differ in an article number are embedded identically.
+    """
+
+    dimensions = 64
+
+    def embed_query(self, question: str) -> list:
+        embedding = [0.0] * self.dimensions
+        for word in "".join(c for c in question if not c.isdigit()).lower().split():
+            embedding[zlib.crc32(word.encode()) % self.dimensions] += 1.0
+        return embedding
+
+
+class TestSemanticCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        document_store = DocumentStore(os.path.join(self.directory.name, "documents"))
+        documents = [
+            EmbeddingDocument(
+                doc_id=f"ct{number}",
+                metadata={
+                    "title": f"Artigo {number}.º",
+                    "text": f"Texto do artigo {number}.º",
+                    "legal_code": "CODIGO_TRABALHO",
+                    "document_name": "Código do Trabalho",
+                },
+            )
+            for number in (5, 6)
+        ]
+        for document in documents:
+            document_store.put(document.id, document.metadata, [[0, 10]])
+        document_store.save()
+        self.article_index = ArticleIndex.build(
+            documents,
+            os.path.join(self.directory.name, "articles"),
+            document_store=document_store,
+        )
+        self.cache = SemanticCache(WordEmbeddings(), persist_path=None)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def cache_key(self, question: str) -> str:
+        # As RAG.direct_context keys the questions citing articles
+        return ",".join(match["id"] for match in self.article_index.find(question))
+
+    def test_questions_citing_different_articles_do_not_share_a_hit(self):
+        """Test a cached answer about one article is not served for another"""
+        question = "O que diz o artigo 5.º do Código do Trabalho?"
+        other_question = "O que diz o artigo 6.º do Código do Trabalho?"
+        self.cache.store(question, {"answer": "artigo 5"}, self.cache_key(question))
+
+        self.assertIsNone(
+            self.cache.lookup(other_question, self.cache_key(other_question))
+        )
+        self.assertEqual(
+            self.cache.lookup(question, self.cache_key(question)),
+            {"answer": "artigo 5"},
+        )
+
+    def test_questions_without_key_share_a_hit(self):
+        """Test the embeddings alone cannot tell the questions apart"""
+        self.cache.store("artigo 5.º do Código do Trabalho", {"answer": "artigo 5"})
+        self.assertEqual(
+            self.cache.lookup("artigo 6.º do Código do Trabalho"),
+            {"answer": "artigo 5"},
+        )
+
+
+class TestSemanticCachePersistence(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index_version = "1"
+
+    def cache(self) -> SemanticCache:
+        cache = SemanticCache(
+            WordEmbeddings(),
+            persist_path=self.directory.name,
+            version_provider=lambda: self.index_version,
+        )
+        self.addCleanup(cache.release_persistence)
+        return cache
+
+    def test_saved_cache_is_loaded(self):
+        """Test a saved cache serves its answers after a restart"""
+        cache = self.cache()
+        cache.store("Quantos dias de férias?", {"answer": "22"})
+        cache.save()
+        self.assertEqual(
+            sorted(os.listdir(self.directory.name)), [".lock", "cache.npz"]
+        )
+        self.assertEqual(
+            self.cache().lookup("Quantos dias de férias?"), {"answer": "22"}
+        )
+
+    def test_interrupted_save_is_not_loaded(self):
+        """Test a save cut off before its rename leaves the previous cache"""
+        cache = self.cache()
+        cache.store("Quantos dias de férias?", {"answer": "22"})
+        cache.save()
+        with open(os.path.join(self.directory.name, "cache.npz.tmp"), "wb") as f:
+            f.write(b"PK")
+        self.assertEqual(
+            self.cache().lookup("Quantos dias de férias?"), {"answer": "22"}
+        )
+
+    def test_cache_of_another_index_version_is_not_loaded(self):
+        """Test a cache saved before a re-ingestion is dropped"""
+        cache = self.cache()
+        cache.store("Quantos dias de férias?", {"answer": "22"})
+        cache.save()
+        self.index_version = "2"
+        self.assertIsNone(self.cache().lookup("Quantos dias de férias?"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+
+from rag.utils.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.calls = 0
+
+    async def gather(self, factory, callers: int = 3):
+        return await asyncio.gather(
+            *(
+                self.single_flight.call("key", factory, owner=str(caller))
+                for caller in range(callers)
+            ),
+            return_exceptions=True,
+        )
+
+    def test_identical_keys_run_once(self):
+        """Test concurrent calls with the same key share one execution"""
+
+        async def factory():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            return {"answer": self.calls}
+
+        results = asyncio.run(self.gather(factory))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{"answer": 1}] * 3)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(
+            self.single_flight.metrics(),
+            {"in_flight": 0, "leaders": 1, "coalesced": 2},
+        )
+
+    def test_identical_keys_share_the_exception(self):
+        """Test every caller of a failed execution gets its exception"""
+        error = ValueError("failed")
+
+        async def factory():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            raise error
+
+        results = asyncio.run(self.gather(factory))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [error] * 3)
+
+    def test_key_is_freed_after_a_failure(self):
+        """Test a call after a failed execution runs again"""
+
+        async def factory():
+            self.calls += 1
+            if self.calls == 1:
+                raise ValueError("failed")
+            return "answer"
+
+        async def call_twice():
+            with self.assertRaises(ValueError):
+                await self.single_flight.call("key", factory)
+            self.assertEqual(self.single_flight.metrics()["in_flight"], 0)
+            return await self.single_flight.call("key", factory)
+
+        self.assertEqual(asyncio.run(call_twice()), "answer")
+        self.assertEqual(self.calls, 2)
+
+    def test_different_keys_run_separately(self):
+        """Test calls with different keys are not coalesced"""
+
+        async def factory():
+            self.calls += 1
+            call = self.calls
+            await asyncio.sleep(0.01)
+            return call
+
+        async def call_both():
+            return await asyncio.gather(
+                self.single_flight.call("first", factory),
+                self.single_flight.call("second", factory),
+            )
+
+        self.assertEqual(sorted(asyncio.run(call_both())), [1, 2])
+
+    def test_late_subscriber_gets_every_chunk(self):
+        """Test a stream joined midway replays the chunks already produced"""
+        produced = asyncio.Event()
+
+        async def factory():
+            yield "first"
+            await produced.wait()
+            yield "second"
+
+        async def collect():
+            return [chunk async for chunk in self.single_flight.stream("key", factory)]
+
+        async def run():
+            leader = asyncio.create_task(collect())
+            await asyncio.sleep(0.01)
+            follower = asyncio.create_task(collect())
+            await asyncio.sleep(0.01)
+            produced.set()
+            return await asyncio.gather(leader, follower)
+
+        self.assertEqual(asyncio.run(run()), [["first", "second"]] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
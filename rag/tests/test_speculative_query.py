@@ -0,0 +1,101 @@
+import asyncio
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from unittest.mock import MagicMock
+
+# The LLM client, the embedding models and the databases are not needed to resolve
+# the speculative results, so their modules are replaced while the retriever is
+# imported
+MOCKED_MODULES = (
+    "together",
+    "rag.prompt_specialists.specialists",
+    "rag.retriever.database.bin.utils",
+    "rag.retriever.database.DatabaseController",
+)
+RETRIEVER_MODULES = ("rag.retriever.main",)
+
+METADATA_FILTER = {"theme": "Direito do Trabalho"}
+LABOUR_CANDIDATE = {"id": "ct5_part0", "metadata": {"legal_code": "CODIGO_TRABALHO"}}
+CIVIL_CANDIDATE = {"id": "cc5_part0", "metadata": {"legal_code": "CODIGO_CIVIL"}}
+
+
+def get_legal_code(text: str):
+    return SimpleNamespace(name="CODIGO_TRABALHO") if "Trabalho" in text else None
+
+
+class TestResolveSpeculativeQuery(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Only these modules are restored afterwards, as the extension modules
+        # imported meanwhile, such as numpy, cannot be imported twice
+        cls.saved_modules = {
+            name: sys.modules.get(name) for name in MOCKED_MODULES + RETRIEVER_MODULES
+        }
+        sys.modules.update({name: MagicMock() for name in MOCKED_MODULES})
+        from rag.retriever.main import Retriever
+
+        cls.retriever_class = Retriever
+
+    @classmethod
+    def tearDownClass(cls):
+        for name, module in cls.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def setUp(self):
+        self.retriever = self.retriever_class.__new__(self.retriever_class)
+        self.retriever.legal_code_filter = True
+        self.retriever.specialist = MagicMock()
+        self.retriever.specialist.get_legal_code.side_effect = get_legal_code
+        self.retriever.aquery = AsyncMock(return_value=[{"id": "filtered"}])
+
+    def resolve(self, candidates, metadata_filter=METADATA_FILTER):
+        speculative_results = (candidates, [{"id": "speculative"}])
+        return asyncio.run(
+            self.retriever.aresolve_speculative_query(
+                "férias", 5, speculative_results, metadata_filter
+            )
+        )
+
+    def test_candidates_matching_the_filter_are_kept(self):
+        """Test the speculative results are kept when the filter excludes nothing"""
+        self.assertEqual(self.resolve([LABOUR_CANDIDATE]), [{"id": "speculative"}])
+        self.retriever.aquery.assert_not_called()
+
+    def test_candidates_outside_the_filter_query_again(self):
+        """Test the database is queried again when the filter excludes a candidate"""
+        self.assertEqual(
+            self.resolve([LABOUR_CANDIDATE, CIVIL_CANDIDATE]), [{"id": "filtered"}]
+        )
+        self.retriever.aquery.assert_awaited_once_with("férias", 5, METADATA_FILTER)
+
+    def test_empty_filtered_results_keep_the_speculative_ones(self):
+        """Test an index without legal codes falls back to the unfiltered results"""
+        self.retriever.aquery.return_value = []
+        self.assertEqual(
+            self.resolve([LABOUR_CANDIDATE, CIVIL_CANDIDATE]), [{"id": "speculative"}]
+        )
+
+    def test_theme_without_legal_code_keeps_the_candidates(self):
+        """Test a theme the classifier maps to no legal code filters nothing"""
+        self.assertEqual(
+            self.resolve([CIVIL_CANDIDATE], {"theme": "Outro"}),
+            [{"id": "speculative"}],
+        )
+        self.retriever.aquery.assert_not_called()
+
+    def test_without_legal_code_filter_the_candidates_are_kept(self):
+        """Test retrieval without the legal code filter never queries again"""
+        self.retriever.legal_code_filter = False
+        self.assertEqual(
+            self.resolve([LABOUR_CANDIDATE, CIVIL_CANDIDATE]), [{"id": "speculative"}]
+        )
+        self.retriever.aquery.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
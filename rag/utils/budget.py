@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable
+from typing import Callable
+from typing import List
+from typing import Optional
+
+from rag.utils.executors import ExecutorSaturatedError
+from rag.utils.tracing import tracer
+
+LOG = logging.getLogger("LATENCY_BUDGET")
+
+# Used until a stage has enough traced samples to estimate its own p95.
+DEFAULT_STAGE_ESTIMATES = {
+    "metadata_extraction": 1.0,
+    "query_expansion": 1.0,
+    "llm_rerank": 1.5,
+}
+MIN_SAMPLES_FOR_ESTIMATE = 20
+
+_current_budget: ContextVar[Optional["LatencyBudget"]] = ContextVar(
+    "rag_latency_budget", default=None
+)
+
+
+class LatencyBudget:
+    """
+    Deadline for the part of the pipeline that runs before the answer starts
+    streaming. Optional stages check it before starting and are cut off when they
+    would overrun, and the stages that were degraded are reported in the trace.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+        self.degraded: List[str] = []
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def estimate(self, stage: str) -> float:
+        summary = tracer.stage_latency(stage).summary()
+        if summary["count"] >= MIN_SAMPLES_FOR_ESTIMATE:
+            return summary["p95"]
+        return DEFAULT_STAGE_ESTIMATES.get(stage, 0.0)
+
+    def allows(self, stage: str) -> bool:
+        return self.remaining() >= self.estimate(stage)
+
+    def degrade(self, stage: str, reason: str):
+        LOG.info(f"Degrading stage {stage} ({reason}), {self.remaining():.3f}s left")
+        self.degraded.append(stage)
+        trace = tracer.current_trace()
+        if trace:
+            trace.attributes["degraded_stages"] = list(self.degraded)
+            trace.attributes[f"degraded.{stage}"] = reason
+
+    async def run(self, stage: str, factory: Callable[[], Awaitable], fallback):
+        if not self.allows(stage):
+            self.degrade(stage, "skipped")
+            return fallback
+        try:
+            return await asyncio.wait_for(factory(), timeout=max(self.remaining(), 0))
+        except asyncio.TimeoutError:
+            self.degrade(stage, "timeout")
+            return fallback
+
+
+def current_budget() -> Optional[LatencyBudget]:
+    return _current_budget.get()
+
+
+@contextmanager
+def budget_scope(budget: Optional[LatencyBudget]):
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+async def optional_stage(stage: str, factory: Callable[[], Awaitable], fallback):
+    """
+    Run an optional stage within the current latency budget, returning `fallback` if
+    the stage is skipped or cut off. Without a budget the stage always runs, unless
+    the executors are too busy to take it.
+    """
+    budget = current_budget()
+    try:
+        if budget is None:
+            return await factory()
+        return await budget.run(stage, factory, fallback)
+    except ExecutorSaturatedError as e:
+        if budget is not None:
+            budget.degrade(stage, f"{e.name} executor saturated")
+        else:
+            LOG.info(f"Skipping stage {stage}, the {e.name} executor is saturated")
+        return fallback
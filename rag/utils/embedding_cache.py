@@ -0,0 +1,303 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Union
+
+import numpy as np
+from rag.utils.metrics import LatencyRecorder
+
+LOG = logging.getLogger("EMBEDDING_CACHE")
+
+EMBEDDING_CACHE_ENABLED = os.getenv("RAG_EMBEDDING_CACHE_ENABLED", "true") == "true"
+EMBEDDING_CACHE_SIZE = int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", 4096))
+EMBEDDING_CACHE_DISK_SIZE = int(os.getenv("RAG_EMBEDDING_CACHE_DISK_SIZE", 200000))
+EMBEDDING_CACHE_PATH = os.getenv(
+    "RAG_EMBEDDING_CACHE_PATH", ".cache/embedding_cache.sqlite3"
+)
+SQLITE_BATCH_SIZE = 500
+
+Embedding = Union[List[float], dict]
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    Cache of dense (list of floats) and sparse (token id to weight) embeddings,
+    keyed by the model and the whitespace-normalized text.
+
+    The most recently used `max_entries` embeddings are kept in memory as returned
+    by the model, so callers must not modify them. Every embedding is also written
+    to a sqlite database as float16, shared by the processes on the host and kept
+    across restarts; when it holds more than `max_disk_entries` the least recently
+    used tenth is deleted.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = EMBEDDING_CACHE_SIZE,
+        max_disk_entries: int = EMBEDDING_CACHE_DISK_SIZE,
+        path: Optional[str] = EMBEDDING_CACHE_PATH,
+        enabled: bool = EMBEDDING_CACHE_ENABLED,
+    ):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.path = path
+        self.enabled = enabled
+
+        self.lock = Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.connection: Optional[sqlite3.Connection] = None
+        self.connection_pid: Optional[int] = None
+        self.disk_entries = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.lookup_latency = LatencyRecorder()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # Connections must not be shared with forked workers, so each process
+        # opens its own.
+        if not self.path:
+            return None
+        if self.connection is not None and self.connection_pid == os.getpid():
+            return self.connection
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=5, check_same_thread=False, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, key TEXT NOT NULL, sparse INTEGER NOT NULL, "
+                "data BLOB NOT NULL, last_access REAL NOT NULL, "
+                "PRIMARY KEY (model, key))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_access "
+                "ON embeddings (last_access)"
+            )
+            self.disk_entries = connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+        except sqlite3.Error as e:
+            LOG.error(f"Error opening embedding cache at {self.path}: {e}")
+            self.path = None
+            return None
+        self.connection = connection
+        self.connection_pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _encode(embedding: Embedding) -> tuple:
+        if isinstance(embedding, dict):
+            indices = np.fromiter(embedding.keys(), dtype=np.int32)
+            values = np.fromiter(embedding.values(), dtype=np.float16)
+            return 1, indices.tobytes() + values.tobytes()
+        return 0, np.asarray(embedding, dtype=np.float16).tobytes()
+
+    @staticmethod
+    def _decode(sparse: int, data: bytes) -> Embedding:
+        if sparse:
+            n = len(data) // 6
+            indices = np.frombuffer(data[: 4 * n], dtype=np.int32)
+            values = np.frombuffer(data[4 * n :], dtype=np.float16)
+            return dict(zip(indices.tolist(), values.astype(np.float32).tolist()))
+        return np.frombuffer(data, dtype=np.float16).astype(np.float32).tolist()
+
+    def _remember(self, key: tuple, embedding: Embedding):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, model: str, text: str) -> Optional[Embedding]:
+        """
+        Return the embedding if it is in memory, without touching the disk, so it
+        can be called from the event loop.
+        """
+        if not self.enabled:
+            return None
+        key = (model, normalize_text(text))
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+        return embedding
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[Embedding]]:
+        start = time.perf_counter()
+        keys = [(model, normalize_text(text)) for text in texts]
+        embeddings = [None] * len(texts)
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                embedding = self.entries.get(key)
+                if embedding is not None:
+                    self.entries.move_to_end(key)
+                    self.memory_hits += 1
+                    embeddings[i] = embedding
+                else:
+                    text_hash = hashlib.sha1(key[1].encode()).hexdigest()
+                    missing.setdefault(text_hash, []).append(i)
+
+            connection = self._connect() if missing else None
+            if connection is not None:
+                for text_hash, sparse, data in self._read(connection, model, missing):
+                    embedding = self._decode(sparse, data)
+                    for i in missing.pop(text_hash):
+                        embeddings[i] = embedding
+                        self._remember(keys[i], embedding)
+                        self.disk_hits += 1
+            self.misses += sum(len(positions) for positions in missing.values())
+        self.lookup_latency.record(time.perf_counter() - start)
+        return embeddings
+
+    def _read(
+        self, connection: sqlite3.Connection, model: str, text_hashes
+    ) -> List[tuple]:
+        text_hashes = list(text_hashes)
+        rows = []
+        try:
+            # Bounded by sqlite's limit on the number of query parameters
+            for start in range(0, len(text_hashes), SQLITE_BATCH_SIZE):
+                batch = text_hashes[start : start + SQLITE_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                found = connection.execute(
+                    "SELECT key, sparse, data FROM embeddings "
+                    f"WHERE model = ? AND key IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                if found:
+                    connection.execute(
+                        "UPDATE embeddings SET last_access = ? "
+                        f"WHERE model = ? AND key IN ({','.join('?' * len(found))})",
+                        [time.time(), model, *(row[0] for row in found)],
+                    )
+                rows.extend(found)
+        except sqlite3.Error as e:
+            LOG.error(f"Error reading embedding cache: {e}")
+        return rows
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[Embedding]):
+        now = time.time()
+        rows = {}
+        with self.lock:
+            for text, embedding in zip(texts, embeddings):
+                key = (model, normalize_text(text))
+                self._remember(key, embedding)
+                rows[hashlib.sha1(key[1].encode()).hexdigest()] = embedding
+
+            connection = self._connect()
+            if connection is None:
+                return
+            try:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings "
+                    "(model, key, sparse, data, last_access) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (model, text_hash, *self._encode(embedding), now)
+                        for text_hash, embedding in rows.items()
+                    ],
+                )
+                self.disk_entries += len(rows)
+                if self.disk_entries > self.max_disk_entries:
+                    self._evict_disk(connection)
+            except sqlite3.Error as e:
+                LOG.error(f"Error writing embedding cache: {e}")
+
+    def _evict_disk(self, connection: sqlite3.Connection):
+        self.disk_entries = connection.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()[0]
+        excess = self.disk_entries - self.max_disk_entries
+        if excess <= 0:
+            return
+        evicted = excess + self.max_disk_entries // 10
+        connection.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings "
+            "ORDER BY last_access LIMIT ?)",
+            (evicted,),
+        )
+        self.disk_entries -= evicted
+        self.disk_evictions += evicted
+
+    def get_or_compute(
+        self, model: str, text: str, compute: Callable[[str], Embedding]
+    ) -> Embedding:
+        return self.get_or_compute_many(
+            model, [text], lambda texts: [compute(texts[0])]
+        )[0]
+
+    def get_or_compute_many(
+        self,
+        model: str,
+        texts: List[str],
+        compute: Callable[[List[str]], List[Embedding]],
+    ) -> List[Embedding]:
+        """
+        Return the embeddings of `texts`, computing only the ones that are not
+        cached, in a single call to `compute`.
+        """
+        if not self.enabled:
+            return compute(texts)
+        embeddings = self.get_many(model, texts)
+        # Texts that normalize to the same key are computed once
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(normalize_text(texts[i]), []).append(i)
+        if missing:
+            missing_texts = [texts[positions[0]] for positions in missing.values()]
+            computed = compute(missing_texts)
+            self.put_many(model, missing_texts, computed)
+            for positions, embedding in zip(missing.values(), computed):
+                for i in positions:
+                    embeddings[i] = embedding
+        return embeddings
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            connection = self._connect()
+            if connection is not None:
+                connection.execute("DELETE FROM embeddings")
+                self.disk_entries = 0
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            metrics = {
+                "enabled": self.enabled,
+                "entries": len(self.entries),
+                "disk_entries": self.disk_entries,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+                ),
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+            }
+        metrics["lookup_latency"] = self.lookup_latency.summary()
+        return metrics
+
+
+embedding_cache = EmbeddingCache()
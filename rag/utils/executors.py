@@ -0,0 +1,231 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+from threading import Lock
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+
+from rag.utils.metrics import LatencyRecorder
+
+LOG = logging.getLogger("EXECUTORS")
+
+# Model inference (embeddings, classification, reranking, local search)
+CPU_MAX_WORKERS = int(
+    os.getenv(
+        "RAG_CPU_MAX_WORKERS",
+        os.getenv("RAG_INFERENCE_MAX_WORKERS", min(4, os.cpu_count() or 1)),
+    )
+)
+CPU_MAX_QUEUE = int(os.getenv("RAG_CPU_MAX_QUEUE", 64))
+# Blocking calls to the LLM provider, which mostly wait on the network
+IO_MAX_WORKERS = int(os.getenv("RAG_IO_MAX_WORKERS", 32))
+IO_MAX_QUEUE = int(os.getenv("RAG_IO_MAX_QUEUE", 256))
+# Seconds a rejected client is asked to wait before retrying
+EXECUTOR_RETRY_AFTER = int(os.getenv("RAG_EXECUTOR_RETRY_AFTER", 2))
+
+EXECUTOR_LIMITS = {
+    "cpu": (CPU_MAX_WORKERS, CPU_MAX_QUEUE),
+    "io": (IO_MAX_WORKERS, IO_MAX_QUEUE),
+}
+
+
+class ExecutorSaturatedError(RuntimeError):
+    def __init__(self, name: str, retry_after: int = EXECUTOR_RETRY_AFTER):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"The {name} executor queue is full")
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a limit on the tasks waiting for a worker.
+
+    `submit` rejects a task with `ExecutorSaturatedError` when `max_queue` tasks are
+    already waiting, so a burst of requests is turned away instead of slowing every
+    request down. `defer` runs the task on the calling thread instead, which is how
+    synchronous code fans out: it cannot be rejected halfway through, and a worker
+    that fans out to its own pool does not wait on tasks queued behind it. The time
+    each task waits for a worker is recorded.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"rag-{name}"
+        )
+        self.lock = Lock()
+        self.workers = local()
+        self.pending = 0
+        self.rejected = 0
+        self.caller_runs = 0
+        self.queue_wait = LatencyRecorder()
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_workers + self.max_queue
+
+    def in_worker(self) -> bool:
+        return getattr(self.workers, "active", False)
+
+    def _done(self, _: Future):
+        with self.lock:
+            self.pending -= 1
+
+    def _reserve(self) -> bool:
+        with self.lock:
+            if self.saturated:
+                return False
+            self.pending += 1
+            return True
+
+    def _start(self, func: Callable, *args, **kwargs) -> Future:
+        context = contextvars.copy_context()
+        submitted = time.perf_counter()
+
+        def run():
+            self.workers.active = True
+            self.queue_wait.record(time.perf_counter() - submitted)
+            return context.run(func, *args, **kwargs)
+
+        try:
+            future = self.pool.submit(run)
+        except BaseException:
+            self._done(None)
+            raise
+        # Also called when the future is cancelled before it runs
+        future.add_done_callback(self._done)
+        return future
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        Queue the callable for a worker, with the caller's context variables.
+        """
+        if not self._reserve():
+            with self.lock:
+                self.rejected += 1
+            raise ExecutorSaturatedError(self.name)
+        return self._start(func, *args, **kwargs)
+
+    def defer(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        Queue the callable for a worker, or run it on the calling thread when the
+        queue is full or the caller is one of this pool's workers.
+        """
+        if not self.in_worker() and self._reserve():
+            return self._start(func, *args, **kwargs)
+        with self.lock:
+            self.caller_runs += 1
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def map(self, func: Callable, items: Iterable) -> List:
+        """
+        Call `func` on every item concurrently and return the results in order. The
+        first item runs on the calling thread, which would otherwise sit idle.
+        """
+        items = list(items)
+        if not items:
+            return []
+        futures = [self.defer(func, item) for item in items[1:]]
+        first = func(items[0])
+        return [first] + [future.result() for future in futures]
+
+    def metrics(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "caller_runs": self.caller_runs,
+            "queue_wait": self.queue_wait.summary(),
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+_executors: Dict[str, BoundedExecutor] = {}
+_executors_lock = Lock()
+
+
+def get_executor(kind: str = "cpu") -> BoundedExecutor:
+    """
+    Return the process-wide bounded executor of the given kind: "cpu" for model
+    inference and "io" for blocking calls to external APIs.
+    """
+    executor = _executors.get(kind)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(kind)
+            if executor is None:
+                if kind not in EXECUTOR_LIMITS:
+                    raise ValueError(f"Unknown executor: {kind}")
+                executor = BoundedExecutor(kind, *EXECUTOR_LIMITS[kind])
+                _executors[kind] = executor
+    return executor
+
+
+async def run_in_executor(func: Callable, *args, **kwargs):
+    """
+    Run a blocking inference callable on the CPU executor without blocking the event
+    loop. The caller's context variables are propagated to the worker thread.
+    Raises `ExecutorSaturatedError` when the executor's queue is full.
+    """
+    return await asyncio.wrap_future(get_executor("cpu").submit(func, *args, **kwargs))
+
+
+async def run_in_io_executor(func: Callable, *args, **kwargs):
+    """
+    Like `run_in_executor`, on the executor for blocking calls to external APIs.
+    """
+    return await asyncio.wrap_future(get_executor("io").submit(func, *args, **kwargs))
+
+
+def check_capacity():
+    """
+    Raise `ExecutorSaturatedError` when an executor's queue is full, so new requests
+    can be turned away before they start.
+    """
+    for kind in EXECUTOR_LIMITS:
+        executor = get_executor(kind)
+        if executor.saturated:
+            with executor.lock:
+                executor.rejected += 1
+            LOG.warning(
+                f"Rejecting request, {executor.pending} tasks pending on {kind}"
+            )
+            raise ExecutorSaturatedError(kind)
+
+
+def executor_metrics() -> dict:
+    with _executors_lock:
+        executors = dict(_executors)
+    return {kind: executor.metrics() for kind, executor in executors.items()}
+
+
+def shutdown_executors():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
+
+
+def reset_executors():
+    """
+    Forget the executors inherited from the parent process after a fork, as their
+    worker threads did not survive it.
+    """
+    _executors.clear()
@@ -0,0 +1,39 @@
+from collections import deque
+from threading import Lock
+from typing import Dict
+
+
+class LatencyRecorder:
+    """
+    Rolling window of latency samples, summarised as percentiles on demand.
+    """
+
+    def __init__(self, window: int = 1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.lock = Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def summary(self) -> Dict[str, float]:
+        with self.lock:
+            ordered = sorted(self.samples)
+            count = self.count
+
+        if not ordered:
+            return {"count": count, "mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+
+        def percentile(point: int) -> float:
+            index = min(len(ordered) - 1, int(round(point / 100 * (len(ordered) - 1))))
+            return ordered[index]
+
+        return {
+            "count": count,
+            "mean": sum(ordered) / len(ordered),
+            "p50": percentile(50),
+            "p95": percentile(95),
+            "p99": percentile(99),
+        }
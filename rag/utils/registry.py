@@ -0,0 +1,126 @@
+import logging
+import os
+import time
+from threading import Lock
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from rag.utils.tracing import tracer
+
+LOG = logging.getLogger("MODEL_REGISTRY")
+
+MODEL_WARM_UP = os.getenv("RAG_MODEL_WARM_UP", "true") == "true"
+
+WARM_UP_TEXT = "Quantos dias de férias tem um trabalhador por ano?"
+
+
+class ModelRegistry:
+    """
+    Loads each model once per process, the first time it is needed.
+
+    Model wrappers register a loader under a name derived from the model they wrap,
+    so wrappers instantiated in several places share a single copy of the weights.
+    `warm_up` loads the models registered with `preload` (the ones on the query
+    path) and runs one inference through each, after which the process reports
+    itself as ready. Models registered as not `fork_safe` (ONNX Runtime sessions,
+    whose thread pools do not survive a fork) are skipped by `load`, so each worker
+    loads its own copy when it warms up.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.loaders: Dict[str, Callable] = {}
+        self.warmers: Dict[str, Optional[Callable]] = {}
+        self.preload: Dict[str, bool] = {}
+        self.fork_safe: Dict[str, bool] = {}
+        self.load_locks: Dict[str, Lock] = {}
+        self.models: Dict[str, object] = {}
+        self.load_times: Dict[str, float] = {}
+        self.ready = False
+
+    def register(
+        self,
+        name: str,
+        loader: Callable,
+        warm_up: Optional[Callable] = None,
+        preload: bool = True,
+        fork_safe: bool = True,
+    ):
+        with self.lock:
+            if name in self.loaders:
+                return
+            self.loaders[name] = loader
+            self.warmers[name] = warm_up
+            self.preload[name] = preload
+            self.fork_safe[name] = fork_safe
+            self.load_locks[name] = Lock()
+
+    def get(self, name: str):
+        model = self.models.get(name)
+        if model is not None:
+            return model
+
+        with self.load_locks[name]:
+            if name not in self.models:
+                LOG.info(f"Loading model {name}")
+                start = time.perf_counter()
+                with tracer.span("model_load", model=name):
+                    self.models[name] = self.loaders[name]()
+                self.load_times[name] = time.perf_counter() - start
+                LOG.info(f"Loaded model {name} in {self.load_times[name]:.3f}s")
+        return self.models[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self.models
+
+    def preloaded_names(self) -> List[str]:
+        with self.lock:
+            return [name for name, preload in self.preload.items() if preload]
+
+    def load(self, names: Optional[List[str]] = None):
+        """
+        Load the models without running any inference, e.g. in a parent process
+        that shares them with forked workers.
+        """
+        if names is None:
+            names = [name for name in self.preloaded_names() if self.fork_safe[name]]
+        for name in names:
+            self.get(name)
+
+    def warm_up(self, names: Optional[List[str]] = None):
+        if names is None:
+            names = self.preloaded_names()
+        for name in names:
+            model = self.get(name)
+            warmer = self.warmers.get(name)
+            if warmer:
+                try:
+                    warmer(model)
+                except Exception as e:
+                    LOG.error(f"Error warming up model {name}: {e}")
+        self.ready = True
+        LOG.info(f"Warmed up {len(names)} models")
+
+    def load_all(self):
+        for name in list(self.loaders):
+            self.get(name)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            names = list(self.loaders)
+        return {
+            "ready": self.ready,
+            "models": {
+                name: {
+                    "loaded": self.is_loaded(name),
+                    "preload": self.preload[name],
+                    "load_time_s": self.load_times.get(name),
+                }
+                for name in names
+            },
+        }
+
+
+registry = ModelRegistry()
@@ -0,0 +1,267 @@
+import fcntl
+import json
+import logging
+import os
+import time
+from threading import Lock
+from typing import Callable
+from typing import List
+from typing import Optional
+
+import numpy as np
+from rag.utils.executors import run_in_executor
+from rag.utils.metrics import LatencyRecorder
+
+LOG = logging.getLogger("SEMANTIC_CACHE")
+
+# Off by default: similar questions about different articles can share an answer
+SEMANTIC_CACHE_ENABLED = os.getenv("RAG_SEMANTIC_CACHE_ENABLED", "false") == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("RAG_SEMANTIC_CACHE_THRESHOLD", 0.92))
+SEMANTIC_CACHE_TTL = float(os.getenv("RAG_SEMANTIC_CACHE_TTL", 24 * 60 * 60))
+SEMANTIC_CACHE_SIZE = int(os.getenv("RAG_SEMANTIC_CACHE_SIZE", 1000))
+SEMANTIC_CACHE_PATH = os.getenv("RAG_SEMANTIC_CACHE_PATH", ".cache/semantic_cache")
+
+
+class SemanticCache:
+    """
+    Answer cache keyed by question embeddings instead of the exact question string.
+
+    A lookup embeds the question, takes the most similar cached question by cosine
+    similarity and serves its answer if the similarity is above `threshold`. Entries
+    expire after `ttl` seconds, the least recently used entry is evicted when the
+    cache is full, and the whole cache is dropped when `version_provider` reports a
+    different index version (i.e. the legislation was re-ingested). An entry stored
+    with a `key` only serves lookups with the same key, for questions that are
+    embedded close together but must not share answers, such as questions about
+    different articles.
+
+    The cache is saved to `persist_path` by a single process, the one holding the
+    lock on its directory, as several workers share the directory. The embeddings
+    and the entries are written to one file, whole, and then renamed, so a cache is
+    never read half written or with the embeddings of another save.
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl: float = SEMANTIC_CACHE_TTL,
+        max_entries: int = SEMANTIC_CACHE_SIZE,
+        persist_path: Optional[str] = SEMANTIC_CACHE_PATH,
+        version_provider: Optional[Callable[[], str]] = None,
+    ):
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.version_provider = version_provider
+        self.persist_lock = None
+
+        self.lock = Lock()
+        self.embeddings: Optional[np.ndarray] = None
+        self.entries: List[Optional[dict]] = [None] * max_entries
+        self.index_version = self._current_version()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lookup_latency = LatencyRecorder()
+
+        if persist_path:
+            self.load()
+
+    def _current_version(self) -> str:
+        return self.version_provider() if self.version_provider else ""
+
+    def _embed(self, question: str) -> np.ndarray:
+        embedding = np.asarray(
+            self.embedding_model.embed_query(question), dtype=np.float32
+        )
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _check_version(self):
+        version = self._current_version()
+        if version != self.index_version:
+            LOG.info("Index version changed, invalidating semantic cache")
+            self.index_version = version
+            self._clear()
+            self.invalidations += 1
+
+    def _clear(self):
+        self.embeddings = None
+        self.entries = [None] * self.max_entries
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return now - entry["created_at"] > self.ttl
+
+    def lookup(self, question: str, key: str = "") -> Optional[dict]:
+        start = time.perf_counter()
+        embedding = self._embed(question)
+        now = time.time()
+
+        with self.lock:
+            self._check_version()
+            answer = None
+            if self.embeddings is not None:
+                similarities = self.embeddings @ embedding
+                for slot in np.argsort(similarities)[::-1]:
+                    entry = self.entries[slot]
+                    if entry is None or similarities[slot] < self.threshold:
+                        break
+                    if self._is_expired(entry, now):
+                        self._evict(slot)
+                        continue
+                    if entry.get("key", "") != key:
+                        continue
+                    entry["last_access"] = now
+                    answer = entry["answer"]
+                    LOG.info(
+                        f"Semantic cache hit for '{question}' "
+                        f"(matched '{entry['question']}', {similarities[slot]:.3f})"
+                    )
+                    break
+
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        self.lookup_latency.record(time.perf_counter() - start)
+        return answer
+
+    def store(self, question: str, answer: dict, key: str = ""):
+        embedding = self._embed(question)
+        now = time.time()
+
+        with self.lock:
+            self._check_version()
+            if self.embeddings is None:
+                self.embeddings = np.zeros(
+                    (self.max_entries, embedding.shape[0]), dtype=np.float32
+                )
+            slot = self._free_slot(now)
+            self.embeddings[slot] = embedding
+            self.entries[slot] = {
+                "question": question,
+                "key": key,
+                "answer": answer,
+                "created_at": now,
+                "last_access": now,
+            }
+
+    async def alookup(self, question: str, key: str = "") -> Optional[dict]:
+        return await run_in_executor(self.lookup, question, key)
+
+    async def astore(self, question: str, answer: dict, key: str = ""):
+        await run_in_executor(self.store, question, answer, key)
+
+    def _evict(self, slot: int):
+        self.entries[slot] = None
+        self.embeddings[slot] = 0
+
+    def _free_slot(self, now: float) -> int:
+        least_recent_slot = 0
+        least_recent_access = None
+        for slot, entry in enumerate(self.entries):
+            if entry is None:
+                return slot
+            if self._is_expired(entry, now):
+                self._evict(slot)
+                return slot
+            if (
+                least_recent_access is None
+                or entry["last_access"] < least_recent_access
+            ):
+                least_recent_slot = slot
+                least_recent_access = entry["last_access"]
+
+        self._evict(least_recent_slot)
+        return least_recent_slot
+
+    def invalidate(self):
+        with self.lock:
+            self._clear()
+            self.invalidations += 1
+
+    def metrics(self) -> dict:
+        with self.lock:
+            entries = sum(entry is not None for entry in self.entries)
+            lookups = self.hits + self.misses
+            metrics = {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+        metrics["lookup_latency"] = self.lookup_latency.summary()
+        return metrics
+
+    def claim_persistence(self) -> bool:
+        """
+        Take the lock that makes this process the one saving the cache, which it
+        keeps until it exits. Returns whether this process holds it.
+        """
+        if not self.persist_path:
+            return False
+        if self.persist_lock is None:
+            os.makedirs(self.persist_path, exist_ok=True)
+            lock_file = open(os.path.join(self.persist_path, ".lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self.persist_lock = lock_file
+        return True
+
+    def release_persistence(self):
+        """
+        Forget a lock inherited from the parent process, which still holds it.
+        """
+        self.persist_lock = None
+
+    def save(self):
+        if not self.claim_persistence():
+            LOG.info("Semantic cache is saved by another process")
+            return
+        with self.lock:
+            if self.embeddings is None:
+                return
+            cache_path = os.path.join(self.persist_path, "cache.npz")
+            state = json.dumps(
+                {"index_version": self.index_version, "entries": self.entries},
+                ensure_ascii=False,
+            ).encode()
+            with open(f"{cache_path}.tmp", "wb") as f:
+                np.savez(
+                    f,
+                    embeddings=self.embeddings,
+                    state=np.frombuffer(state, dtype=np.uint8),
+                )
+            os.replace(f"{cache_path}.tmp", cache_path)
+        LOG.info(f"Semantic cache saved to {self.persist_path}")
+
+    def load(self):
+        cache_path = os.path.join(self.persist_path, "cache.npz")
+        if not os.path.exists(cache_path):
+            return
+        try:
+            with np.load(cache_path) as data:
+                state = json.loads(data["state"].tobytes().decode())
+                if state.get("index_version") != self.index_version:
+                    LOG.info("Persisted semantic cache is from another index version")
+                    return
+                embeddings = data["embeddings"]
+            entries = state.get("entries", [])[: self.max_entries]
+            with self.lock:
+                self.embeddings = np.zeros(
+                    (self.max_entries, embeddings.shape[1]), dtype=np.float32
+                )
+                self.embeddings[: len(entries)] = embeddings[: len(entries)]
+                self.entries = entries + [None] * (self.max_entries - len(entries))
+            LOG.info(f"Loaded semantic cache from {self.persist_path}")
+        except Exception as e:
+            LOG.error(f"Error loading semantic cache: {e}")
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import re
+import unicodedata
+from typing import AsyncIterator
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+LOG = logging.getLogger("SINGLE_FLIGHT")
+
+
+def normalize_question(question: str) -> str:
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = re.sub(r"\s+", " ", question).strip()
+    return question.rstrip("?!. ")
+
+
+class Flight:
+    """
+    One in-flight execution whose output is replayed to every subscriber, including
+    the ones that join after some chunks were already produced.
+    """
+
+    def __init__(self, key: str, owner: Optional[str] = None):
+        self.key = key
+        self.owner = owner
+        self.chunks: List = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.updated = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    async def subscribe(self) -> AsyncIterator:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await self.updated.wait()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent executions with the same key: the first caller starts the
+    producer in its own task and every caller, first one included, subscribes to
+    its output. The producer runs to completion even if its subscribers go away,
+    so its side effects (e.g. populating the answer cache) still happen.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(
+        self,
+        key: str,
+        factory: Callable[[], AsyncIterator],
+        owner: Optional[str] = None,
+    ) -> tuple:
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            flight.subscribers += 1
+            LOG.info(
+                f"Coalescing request {owner} into in-flight request {flight.owner}"
+            )
+            return flight, False
+
+        flight = Flight(key, owner)
+        flight.subscribers = 1
+        self.flights[key] = flight
+        self.leaders += 1
+        flight.task = asyncio.create_task(self._run(flight, factory))
+        return flight, True
+
+    async def _run(self, flight: Flight, factory: Callable[[], AsyncIterator]):
+        error = None
+        try:
+            async for chunk in factory():
+                flight.publish(chunk)
+        except BaseException as e:
+            error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            flight.finish(error)
+
+    async def stream(
+        self,
+        key: str,
+        factory: Callable[[], AsyncIterator],
+        owner: Optional[str] = None,
+    ) -> AsyncIterator:
+        flight, _ = self.join(key, factory, owner)
+        async for chunk in flight.subscribe():
+            yield chunk
+
+    async def call(self, key: str, factory: Callable, owner: Optional[str] = None):
+        async def produce():
+            yield await factory()
+
+        async for result in self.stream(key, produce, owner):
+            return result
+
+    def metrics(self) -> dict:
+        return {
+            "in_flight": len(self.flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
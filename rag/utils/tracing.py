@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from rag.utils.metrics import LatencyRecorder
+
+LOG = logging.getLogger("TRACING")
+
+TRACE_EXPORT_PATH = os.getenv("RAG_TRACE_EXPORT_PATH")
+TRACE_HISTORY_SIZE = int(os.getenv("RAG_TRACE_HISTORY_SIZE", 200))
+SERVICE_NAME = "rag_api"
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar(
+    "rag_current_trace", default=None
+)
+_current_span: ContextVar[Optional["Span"]] = ContextVar(
+    "rag_current_span", default=None
+)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def question_attributes(question: str) -> dict:
+    """
+    Attributes identifying a question in a trace without recording its text, which
+    may hold personal data.
+    """
+    return {
+        "query_hash": hashlib.sha256(question.encode("utf-8")).hexdigest()[:16],
+        "query_length": len(question),
+    }
+
+
+class Span:
+    def __init__(
+        self,
+        trace: "Trace",
+        name: str,
+        parent_span_id: Optional[str] = None,
+        attributes: Optional[dict] = None,
+    ):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self, **attributes):
+        if self.end_ns is not None:
+            return
+        self.attributes.update(attributes)
+        self.end_ns = time.time_ns()
+        self.trace.tracer.stage_latency(self.name).record(self.duration)
+
+    def to_record(self) -> dict:
+        record = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_span_id:
+            record["parentSpanId"] = self.parent_span_id
+        return record
+
+
+class Trace:
+    """
+    All the spans recorded for one request. The request id doubles as the trace id.
+    """
+
+    def __init__(self, tracer: "Tracer", request_id: str, attributes: dict):
+        self.tracer = tracer
+        self.trace_id = request_id
+        self.spans: List[Span] = []
+        self.lock = Lock()
+        self.root = self.start_span("request", **attributes)
+
+    @property
+    def attributes(self) -> dict:
+        return self.root.attributes
+
+    def start_span(self, name: str, parent: Optional[Span] = None, **attributes):
+        parent = parent or getattr(self, "root", None)
+        span = Span(
+            self,
+            name,
+            parent_span_id=parent.span_id if parent else None,
+            attributes=attributes,
+        )
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    def to_record(self) -> dict:
+        with self.lock:
+            spans = [span.to_record() for span in self.spans]
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": SERVICE_NAME},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "rag"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+class Tracer:
+    """
+    Records per-stage spans of the RAG pipeline for each request and aggregates
+    their durations into percentiles.
+
+    Spans are attached to the trace active in the current context, so pipeline code
+    only needs `with tracer.span("stage"):` and does not have to pass the trace
+    around. Outside of a trace the span is not recorded.
+    """
+
+    def __init__(self, export_path: Optional[str] = TRACE_EXPORT_PATH):
+        self.export_path = export_path
+        self.export_lock = Lock()
+        self.latencies: Dict[str, LatencyRecorder] = {}
+        self.latencies_lock = Lock()
+        self.recent_traces: deque = deque(maxlen=TRACE_HISTORY_SIZE)
+
+    def stage_latency(self, name: str) -> LatencyRecorder:
+        with self.latencies_lock:
+            if name not in self.latencies:
+                self.latencies[name] = LatencyRecorder()
+            return self.latencies[name]
+
+    def start_trace(self, request_id: Optional[str] = None, **attributes) -> Trace:
+        return Trace(self, request_id or uuid.uuid4().hex, attributes)
+
+    def finish_trace(self, trace: Trace):
+        trace.root.end()
+        self.recent_traces.append(trace)
+        LOG.info(
+            f"Request {trace.trace_id} took {trace.root.duration:.3f}s: "
+            + ", ".join(f"{span.name}={span.duration:.3f}s" for span in trace.spans[1:])
+        )
+        if self.export_path:
+            try:
+                with self.export_lock:
+                    with open(self.export_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(trace.to_record(), ensure_ascii=False))
+                        f.write("\n")
+            except Exception as e:
+                LOG.error(f"Error exporting trace {trace.trace_id}: {e}")
+
+    @contextmanager
+    def activate(self, trace: Trace):
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(trace.root)
+        try:
+            yield trace
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+
+    def current_trace(self) -> Optional[Trace]:
+        return _current_trace.get()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        trace = _current_trace.get()
+        if trace is None:
+            yield None
+            return
+
+        span = trace.start_span(name, parent=_current_span.get(), **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def get_trace(self, request_id: str) -> Optional[dict]:
+        for trace in list(self.recent_traces):
+            if trace.trace_id == request_id:
+                return trace.to_record()
+        return None
+
+    def metrics(self) -> dict:
+        with self.latencies_lock:
+            latencies = dict(self.latencies)
+        return {name: recorder.summary() for name, recorder in latencies.items()}
+
+
+tracer = Tracer()
@@ -0,0 +1,46 @@
+"""
+Gunicorn configuration for serving the RAG API with several workers.
+
+The app is imported once in the master process and its models are loaded there
+before the workers are forked, so the workers can share the pages of the weights
+copy-on-write instead of each loading its own copy. How much memory this saves per
+worker is measured with `python -m rag.benchmarks.workers`. The clients of the
+vector database and the LLM provider are recreated in each worker. Run from the
+rag_api directory:
+
+    gunicorn -c gunicorn_conf.py main:app
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv("RAG_API_BIND", "127.0.0.1:5004")
+workers = int(os.getenv("RAG_API_WORKERS", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("RAG_API_TIMEOUT", 120))
+graceful_timeout = 30
+
+
+def when_ready(server):
+    from routes.rag_api_routes import rag_service
+
+    # Only the weights are loaded here: running inference would start the torch
+    # thread pools, which are not safe to use after a fork. Each worker warms up
+    # its models on startup.
+    rag_service.load_models()
+
+    # Keep the garbage collector from writing to the headers of the objects
+    # allocated so far, which would copy their pages into every worker.
+    gc.collect()
+    gc.freeze()
+    server.log.info("Models loaded, forking workers")
+
+
+def post_fork(server, worker):
+    import torch
+    from routes.rag_api_routes import rag_service
+
+    # Split the cores between the workers instead of each one using all of them
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // workers))
+    rag_service.after_fork()
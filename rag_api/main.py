@@ -1,5 +1,9 @@
+import asyncio
+
 from config.settings import settings
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from routes.rag_api_routes import rag_service
 from routes.rag_api_routes import route as rag_api_routes
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
@@ -22,6 +26,18 @@ app.add_middleware(
 
 app.include_router(rag_api_routes, prefix="/rag", tags=["rag_api"])
 
+
+@app.on_event("startup")
+async def warm_up():
+    # Warm up in the background so the server answers readiness probes meanwhile
+    app.state.warm_up_task = asyncio.create_task(run_in_threadpool(rag_service.warm_up))
+
+
+@app.on_event("shutdown")
+def shutdown():
+    rag_service.shutdown()
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,19 +1,25 @@
 import json
 import math
+import uuid
 
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import HTTPException
+from fastapi import Request
 from fastapi import status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials
 from rag import main as rag
+from rag.utils.executors import ExecutorSaturatedError
+from rag.utils.tracing import tracer
 from services.dynamo_services import get_user_by_id
 from services.dynamo_services import update_user_fields
 from utils.exceptions import UserNotFoundException
 from utils.exceptions import LimitExceededException
 from utils.logging_config import logger
 from utils.password import SecurityUtils
+from utils.schemas import BatchQueryRequestPayload
 from utils.schemas import QueryRequestPayload
 from utils.utils import decodeJWT
 from utils.utils import JWTBearer
@@ -31,19 +37,75 @@ PLAN_QUERIES_MAP = {
     "premium_plus": math.inf,
 }
 
+# Seconds a query may spend before the answer starts streaming; optional stages
+# such as LLM reranking are skipped when they would overrun it.
+PLAN_LATENCY_BUDGET_MAP = {
+    "free": 4.0,
+    "premium": 8.0,
+    "premium_plus": 12.0,
+}
+
+BATCH_MAX_QUESTIONS = 50
+
+
+def saturated_error(error: ExecutorSaturatedError) -> str:
+    return json.dumps(
+        {
+            "error": "The service is busy, please retry later",
+            "retry_after": error.retry_after,
+        }
+    )
+
+
+@route.get("/ready")
+async def ready():
+    if not rag_service.is_ready():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Models are still loading",
+        )
+    return {"ready": True}
+
+
+@route.get("/metrics")
+async def metrics(
+    credentials: HTTPAuthorizationCredentials = Depends(JWTBearer()),
+):
+    return rag_service.metrics()
+
+
+@route.get("/traces/{request_id}")
+async def get_trace(
+    request_id: str,
+    credentials: HTTPAuthorizationCredentials = Depends(JWTBearer()),
+):
+    trace = tracer.get_trace(request_id)
+    if trace is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Trace not found for request id: {request_id}",
+        )
+    return trace
+
 
 @route.post("/query")
 async def query(
     payload: QueryRequestPayload,
+    request: Request,
     credentials: HTTPAuthorizationCredentials = Depends(JWTBearer()),
 ):
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
     try:
+        # Checked first so a rejected query does not count towards the user's plan
+        rag_service.check_capacity()
         token = credentials.credentials
         user_id = decodeJWT(token)["sub"]
 
-        logger.info(f"Received a request to query from user with id: {user_id}")
+        logger.info(
+            f"Received a request {request_id} to query from user with id: {user_id}"
+        )
 
-        user = get_user_by_id(user_id)
+        user = await run_in_threadpool(get_user_by_id, user_id)
         user_queries = int(user.weekly_queries)
         queries_for_plan = PLAN_QUERIES_MAP[user.plan]
 
@@ -64,26 +126,49 @@ async def query(
             logger.info("Processing OCR queries")
         else:
             user_queries += 1
-            update_user_fields(
+            await run_in_threadpool(
+                update_user_fields,
                 user_id=user_id,
                 email=user.email,
                 fields={"weekly_queries": str(user_queries)},
             )
 
         async def event_stream():
-            async for chunk in rag_service.stream_answer(query=payload.query, topk=5):
-                dump = json.dumps(
-                    {
-                        "response": chunk.get("answer"),
-                        "summary": chunk.get("summary"),
-                        "reference": chunk.get("references"),
-                        "field": "Direito do Trabalho",
-                    },
-                    ensure_ascii=False,
-                )
-                yield f"data: {dump}\n\n"
-
-        return StreamingResponse(event_stream(), media_type="text/event-stream")
+            try:
+                async for chunk in rag_service.stream_answer(
+                    query=payload.query,
+                    topk=5,
+                    request_id=request_id,
+                    latency_budget=PLAN_LATENCY_BUDGET_MAP.get(user.plan),
+                ):
+                    dump = json.dumps(
+                        {
+                            "response": chunk.get("answer"),
+                            "summary": chunk.get("summary"),
+                            "reference": chunk.get("references"),
+                            "field": "Direito do Trabalho",
+                        },
+                        ensure_ascii=False,
+                    )
+                    if chunk.get("type") == "metadata":
+                        yield f"event: metadata\ndata: {dump}\n\n"
+                    else:
+                        yield f"data: {dump}\n\n"
+            # The response has already started, so the rejection is sent as an
+            # event instead of a 503
+            except ExecutorSaturatedError as e:
+                logger.warning(f"Rejected request {request_id} while streaming: {e}")
+                yield f"event: error\ndata: {saturated_error(e)}\n\n"
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+                "X-Request-ID": request_id,
+            },
+        )
 
     except UserNotFoundException:
         raise HTTPException(
@@ -97,6 +182,111 @@ async def query(
             detail="Query limit exceeded",
         )
 
+    except ExecutorSaturatedError as e:
+        logger.warning(f"Rejected request {request_id}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The service is busy, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="An unexpected error occurred",
+        )
+
+
+@route.post("/batch_query")
+async def batch_query(
+    payload: BatchQueryRequestPayload,
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(JWTBearer()),
+):
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    if not payload.queries or len(payload.queries) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"A batch must have between 1 and {BATCH_MAX_QUESTIONS} queries",
+        )
+
+    try:
+        rag_service.check_capacity()
+        token = credentials.credentials
+        user_id = decodeJWT(token)["sub"]
+
+        logger.info(
+            f"Received a batch request {request_id} with {len(payload.queries)} "
+            f"queries from user with id: {user_id}"
+        )
+
+        user = await run_in_threadpool(get_user_by_id, user_id)
+        user_queries = int(user.weekly_queries)
+        queries_for_plan = PLAN_QUERIES_MAP[user.plan]
+
+        if user_queries + len(payload.queries) > queries_for_plan:
+            raise LimitExceededException("Query limit exceeded")
+
+        user_queries += len(payload.queries)
+        await run_in_threadpool(
+            update_user_fields,
+            user_id=user_id,
+            email=user.email,
+            fields={"weekly_queries": str(user_queries)},
+        )
+
+        async def result_stream():
+            try:
+                async for result in rag_service.batch_query(
+                    queries=payload.queries, topk=5, request_id=request_id
+                ):
+                    dump = json.dumps(
+                        {
+                            "index": result["index"],
+                            "query": result["query"],
+                            "response": result.get("answer"),
+                            "summary": result.get("summary"),
+                            "reference": result.get("references"),
+                            "error": result.get("error"),
+                        },
+                        ensure_ascii=False,
+                    )
+                    yield f"{dump}\n"
+            except ExecutorSaturatedError as e:
+                logger.warning(f"Rejected request {request_id} while streaming: {e}")
+                yield f"{saturated_error(e)}\n"
+
+        return StreamingResponse(
+            result_stream(),
+            media_type="application/x-ndjson",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+                "X-Request-ID": request_id,
+            },
+        )
+
+    except UserNotFoundException:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User not found with id: {user_id}",
+        )
+
+    except LimitExceededException:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Query limit exceeded",
+        )
+
+    except ExecutorSaturatedError as e:
+        logger.warning(f"Rejected request {request_id}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The service is busy, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
     except Exception as e:
         logger.error(f"An unexpected error occurred: {str(e)}")
         raise HTTPException(
@@ -1,3 +1,4 @@
+from typing import List
 from typing import Optional
 
 from pydantic import BaseModel
@@ -15,6 +16,10 @@ class QueryRequestPayload(BaseModel):
     attachments: Optional[str] = None
 
 
+class BatchQueryRequestPayload(BaseModel):
+    queries: List[str]
+
+
 class UserDataResponse(BaseModel):
     user_id: Optional[str] = None
     email: Optional[EmailStr] = None